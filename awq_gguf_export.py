@@ -3,6 +3,11 @@ import subprocess
 from awq import AutoAWQForCausalLM
 from transformers import AutoTokenizer
 
+# This saves an FP16 copy of the model with the AWQ scales applied, converts it to an F16 GGUF, then quantizes that.
+# To skip both intermediate copies, save the search results with awq_entry.py --run_awq --dump_awq awq.pt
+# and convert the original checkpoint directly:
+#   python convert_hf_to_gguf.py models/llama-2-7b --awq awq.pt --outtype q4_0
+
 # model_path = 'mistralai/Mistral-7B-v0.1'
 # quant_path = 'mistral-awq'
 model_path = 'models/llama-2-7b'
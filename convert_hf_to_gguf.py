@@ -77,6 +77,14 @@ class ModelBase:
     # subclasses should define this!
     model_arch: gguf.MODEL_ARCH
 
+    # whether modify_tensors only uses operations which NumPy arrays also have (e.g. reshape, swapaxes),
+    # in which case local safetensors are loaded as memory-mapped NumPy arrays instead of PyTorch tensors
+    numpy_tensors: bool = False
+
+    # whether modify_tensors only moves values around (reshape, permute, split, stack, rename) without any arithmetic,
+    # in which case BF16 tensors are kept as BF16 through it, and copied without rounding when written as BF16
+    dtype_passthrough: bool = False
+
     # subclasses should initialize this!
     block_count: int
     tensor_map: gguf.TensorNameMap
@@ -85,7 +93,10 @@ class ModelBase:
                  use_temp_file: bool = False, eager: bool = False,
                  metadata_override: Path | None = None, model_name: str | None = None,
                  split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False,
-                 small_first_shard: bool = False, hparams: dict[str, Any] | None = None, remote_hf_model_id: str | None = None):
+                 small_first_shard: bool = False, hparams: dict[str, Any] | None = None, remote_hf_model_id: str | None = None,
+                 thread_count: int = 1, max_mem: int = 0, streaming: bool = False, act_scales: Path | None = None,
+                 remote_fetcher: gguf.utility.RemoteFetcher | None = None, imatrix: Path | None = None,
+                 recipe: Path | None = None, awq: Path | None = None):
         if type(self) is ModelBase or \
                 type(self) is TextModel or \
                 type(self) is MmprojModel:
@@ -98,6 +109,19 @@ class ModelBase:
         self.endianess = gguf.GGUFEndian.BIG if is_big_endian else gguf.GGUFEndian.LITTLE
         self.use_temp_file = use_temp_file
         self.lazy = not eager or (remote_hf_model_id is not None)
+        self.streaming = streaming
+        self.act_scales = act_scales
+        self.imatrix: gguf.utility.IMatrixFile | None = None
+        if imatrix is not None:
+            self.imatrix = gguf.utility.IMatrixFile(imatrix)
+            logger.info(f"Loaded {len(self.imatrix)} importance matrix entries from '{imatrix}' computed on {self.imatrix.chunks_count} chunks")
+        self.recipe = gguf.QuantRecipe.load(recipe) if recipe is not None else None
+        self.awq: AWQResults | None = None
+        if awq is not None:
+            self.awq = AWQResults(awq)
+            logger.info(f"Loaded AWQ results for {len(self.awq)} ops and layers from '{awq}'")
+            # the scaled BF16 weights are not BF16 anymore
+            self.dtype_passthrough = False
         self.remote_hf_model_id = remote_hf_model_id
         if remote_hf_model_id is not None:
             self.is_safetensors = True
@@ -105,8 +129,10 @@ class ModelBase:
             def get_remote_tensors() -> Iterator[tuple[str, Tensor]]:
                 logger.info(f"Using remote model with HuggingFace id: {remote_hf_model_id}")
                 remote_tensors = gguf.utility.SafetensorRemote.get_list_tensors_hf_model(remote_hf_model_id)
+                if remote_fetcher is not None:
+                    remote_fetcher.attach(remote_tensors)
                 self.tensor_names = set(name for name in remote_tensors.keys())
-                for name, remote_tensor in gguf.utility.SafetensorRemote.get_list_tensors_hf_model(remote_hf_model_id).items():
+                for name, remote_tensor in remote_tensors.items():
                     yield (name, LazyTorchTensor.from_remote_tensor(remote_tensor))
 
             self.get_tensors = get_remote_tensors
@@ -117,6 +143,28 @@ class ModelBase:
                 self.part_names = ModelBase.get_model_part_names(self.dir_model, "pytorch_model", ".bin")
         self.hparams = ModelBase.load_hparams(self.dir_model) if hparams is None else hparams
         self.tensor_names = None
+        # 4-bit AWQ or GPTQ checkpoint, see get_int4_tensors
+        self.int4_config: dict[str, Any] | None = None
+        # type and row size of the weights already in blocks of a GGUF type, by tensor name
+        self.transcoded_qtypes: dict[str, tuple[gguf.GGMLQuantizationType, int]] = {}
+        quant_config = self.hparams.get("quantization_config")
+        if isinstance(quant_config, dict) and quant_config.get("quant_method") in ("awq", "gptq"):
+            quant_method = quant_config["quant_method"]
+            if quant_config.get("bits", 4) != 4:
+                raise ValueError(f"Only 4-bit {quant_method} checkpoints are supported, not {quant_config.get('bits')}-bit")
+            if quant_method == "awq" and str(quant_config.get("version", "gemm")).lower() != "gemm":
+                raise ValueError(f"Only the GEMM layout of AWQ checkpoints is supported, not {quant_config.get('version')!r}")
+            self.int4_config = quant_config
+            # the scales are decoded to F32 anyway
+            self.dtype_passthrough = False
+        # written by smooth_quant_llama2.py, see prepare_metadata
+        self.smoothquant: dict[str, Any] = self.hparams.get("smoothquant") or {}
+        if self.act_scales is not None and self.smoothquant.get("folded", False):
+            # dividing the activations by them again at runtime would apply them twice
+            logger.warning(f"The SmoothQuant scales are already folded into the norms of {self.dir_model}, ignoring '{self.act_scales}'")
+            self.act_scales = None
+        elif self.act_scales is not None:
+            logger.warning("The .act_scale tensors are not loaded by llama.cpp yet, the resulting file is only usable by other runtimes")
         self.metadata_override = metadata_override
         self.model_name = model_name
         self.dir_model_card = dir_model  # overridden in convert_lora_to_gguf.py
@@ -125,7 +173,11 @@ class ModelBase:
         if self.ftype == gguf.LlamaFileType.GUESSED:
             # NOTE: can't use field "torch_dtype" in config.json, because some finetunes lie.
             _, first_tensor = next(self.get_tensors())
-            if first_tensor.dtype == torch.float16:
+            if isinstance(first_tensor, (np.ndarray, gguf.LazyNumpyTensor)):
+                is_f16 = first_tensor.dtype == np.float16
+            else:
+                is_f16 = first_tensor.dtype == torch.float16
+            if is_f16:
                 logger.info(f"choosing --outtype f16 from first tensor type ({first_tensor.dtype})")
                 self.ftype = gguf.LlamaFileType.MOSTLY_F16
             else:
@@ -134,7 +186,8 @@ class ModelBase:
 
         # Configure GGUF Writer
         self.gguf_writer = gguf.GGUFWriter(path=None, arch=gguf.MODEL_ARCH_NAMES[self.model_arch], endianess=self.endianess, use_temp_file=self.use_temp_file,
-                                           split_max_tensors=split_max_tensors, split_max_size=split_max_size, dry_run=dry_run, small_first_shard=small_first_shard)
+                                           split_max_tensors=split_max_tensors, split_max_size=split_max_size, dry_run=dry_run, small_first_shard=small_first_shard,
+                                           thread_count=thread_count, max_mem=max_mem, streaming=streaming)
 
     @classmethod
     def add_prefix_to_filename(cls, path: Path, prefix: str) -> Path:
@@ -173,7 +226,9 @@ class ModelBase:
         for part_name in self.part_names:
             logger.info(f"gguf: loading model part '{part_name}'")
             ctx: ContextManager[Any]
-            if self.is_safetensors:
+            if self.is_safetensors and self.numpy_tensors:
+                ctx = gguf.utility.SafetensorsLocal(self.dir_model / part_name)
+            elif self.is_safetensors:
                 from safetensors import safe_open
                 ctx = cast(ContextManager[Any], safe_open(self.dir_model / part_name, framework="pt", device="cpu"))
             else:
@@ -183,16 +238,24 @@ class ModelBase:
                 tensor_names_from_parts.update(model_part.keys())
 
                 for name in model_part.keys():
-                    if self.is_safetensors:
-                        if self.lazy:
-                            data = model_part.get_slice(name)
-                            data = LazyTorchTensor.from_safetensors_slice(data)
+                    # with lazy evaluation, the data is only read when the tensor is materialized
+                    with gguf.profiling.profile("read", name):
+                        if isinstance(model_part, gguf.utility.SafetensorsLocal):
+                            st_tensor = model_part.tensors[name]
+                            if self.lazy:
+                                data = cast(torch.Tensor, lazy_numpy_from_safetensors(st_tensor, raw_bf16=self.dtype_passthrough))
+                            else:
+                                data = cast(torch.Tensor, st_tensor.numpy(raw_bf16=self.dtype_passthrough))
+                        elif self.is_safetensors:
+                            if self.lazy:
+                                data = model_part.get_slice(name)
+                                data = LazyTorchTensor.from_safetensors_slice(data)
+                            else:
+                                data = model_part.get_tensor(name)
                         else:
-                            data = model_part.get_tensor(name)
-                    else:
-                        data = model_part[name]
-                        if self.lazy:
-                            data = LazyTorchTensor.from_eager(data)
+                            data = model_part[name]
+                            if self.lazy:
+                                data = LazyTorchTensor.from_eager(data)
                     yield name, data
 
         # verify tensor name presence and identify potentially missing files
@@ -208,6 +271,103 @@ class ModelBase:
                                  f"Missing tensors: {missing}\n"
                                  f"Extra tensors: {extra}")
 
+    # per-input-channel activation scales of the linear layers (e.g. from SmoothQuant),
+    # named after the linear layer with an .act_scale suffix
+    def get_act_scale_tensors(self) -> Iterator[tuple[str, Tensor]]:
+        if self.act_scales is None:
+            return
+        logger.info(f"gguf: loading activation scales from '{self.act_scales}'")
+        with open(self.act_scales, "r", encoding="utf-8") as f:
+            act_scales: dict[str, Any] = json.load(f)
+        for name, scale in act_scales.items():
+            data = torch.tensor(scale, dtype=torch.float32)
+            yield name + ".act_scale", LazyTorchTensor.from_eager(data) if self.lazy else data
+
+    # The layers of 4-bit AWQ or GPTQ checkpoints (qweight, qzeros, scales and g_idx) as <layer>.weight tensors,
+    # transcoded into Q4_0 or Q4_1 blocks when their groups allow it, and dequantized to F32 otherwise
+    def get_int4_tensors(self, tensors: Iterator[tuple[str, Tensor]]) -> Iterator[tuple[str, Tensor]]:
+        if self.int4_config is None:
+            yield from tensors
+            return
+        desc_act = bool(self.int4_config.get("desc_act", False))
+        parts: dict[str, dict[str, Tensor]] = {}
+        done: set[str] = set()
+        for name, data in tensors:
+            layer, _, suffix = name.rpartition(".")
+            if suffix not in ("qweight", "qzeros", "scales", "g_idx"):
+                yield name, data
+                continue
+            if layer in done:
+                # e.g. the g_idx of a GPTQ layer without desc_act, which isn't needed
+                continue
+            layer_parts = parts.setdefault(layer, {})
+            layer_parts[suffix] = data
+            if all(p in layer_parts for p in ("qweight", "qzeros", "scales")) and (not desc_act or "g_idx" in layer_parts):
+                del parts[layer]
+                done.add(layer)
+                yield layer + ".weight", self.transcode_int4(layer + ".weight", **layer_parts)
+        for layer, layer_parts in parts.items():
+            if "qweight" in layer_parts:
+                raise ValueError(f"Missing tensors of the 4-bit layer {layer!r}, only found {sorted(layer_parts.keys())}")
+            # not from a quantized layer
+            for suffix, data in layer_parts.items():
+                yield f"{layer}.{suffix}", data
+
+    def transcode_int4(self, name: str, qweight: Tensor, qzeros: Tensor, scales: Tensor, g_idx: Tensor | None = None) -> Tensor:
+        assert self.int4_config is not None
+        quant_method = self.int4_config["quant_method"]
+        if quant_method == "awq":
+            n_in, n_out = qweight.shape[0], qweight.shape[1] * 8
+        else:
+            n_in, n_out = qweight.shape[0] * 8, qweight.shape[1]
+        group_size = int(self.int4_config.get("group_size", -1))
+        if group_size <= 0:
+            group_size = n_in
+
+        qtype: gguf.GGMLQuantizationType | None = None
+        # blocks of 32 columns within the groups, which are consecutive unless reordered by desc_act
+        if group_size % 32 == 0 and n_in % group_size == 0 and not self.int4_config.get("desc_act", False):
+            # symmetric GPTQ has zero points of 8, as Q4_0
+            qtype = gguf.GGMLQuantizationType.Q4_0 if quant_method == "gptq" and self.int4_config.get("sym", True) else gguf.GGMLQuantizationType.Q4_1
+            self.transcoded_qtypes[name] = (qtype, n_in)
+        else:
+            logger.warning(f"{name}: groups of {group_size} columns can't be transcoded into Q4 blocks, dequantizing them instead")
+        zero_offset = 0 if self.int4_config.get("checkpoint_format") == "gptq_v2" else 1
+
+        def transcode(qweight: Any, qzeros: Any, scales: Any, g_idx: Any = None) -> Any:
+            is_torch = isinstance(qweight, torch.Tensor)
+            if is_torch:
+                qweight, qzeros, scales = qweight.numpy(), qzeros.numpy(), scales.to(torch.float32).numpy()
+                g_idx = g_idx.numpy() if g_idx is not None else None
+            if quant_method == "awq":
+                packed = gguf.PackedInt4.from_awq(qweight, qzeros, scales)
+            else:
+                packed = gguf.PackedInt4.from_gptq(qweight, qzeros, scales, g_idx, zero_offset=zero_offset)
+            data = packed.to_q4(qtype) if qtype is not None else packed.dequantize()
+            return torch.from_numpy(data) if is_torch else data
+
+        args = (qweight, qzeros, scales) + (() if g_idx is None else (g_idx,))
+        if not isinstance(qweight, gguf.LazyBase):
+            return transcode(*args)
+        lazy_type: type[gguf.LazyBase] = type(qweight)
+        is_numpy = lazy_type is gguf.LazyNumpyTensor
+        dtype: Any
+        if qtype is not None:
+            shape = (n_out, n_in // gguf.GGML_QUANT_SIZES[qtype][0] * gguf.GGML_QUANT_SIZES[qtype][1])
+            dtype = np.uint8 if is_numpy else torch.uint8
+        else:
+            shape = (n_out, n_in)
+            dtype = np.float32 if is_numpy else torch.float32
+        meta = lazy_type.meta_with_dtype_and_shape(dtype, shape)
+        return cast(torch.Tensor, lazy_type(meta=meta, args=args, func=transcode))
+
+    # AWQ scales of the ops which have no weights to fold them into, named after the op with a .scales suffix
+    def get_awq_scale_tensors(self) -> Iterator[tuple[str, Tensor]]:
+        if self.awq is None:
+            return
+        for name, data in self.awq.activation_scales():
+            yield name, LazyTorchTensor.from_eager(data) if self.lazy else data
+
     def format_tensor_name(self, key: gguf.MODEL_TENSOR, bid: int | None = None, suffix: str = ".weight") -> str:
         if key not in gguf.MODEL_TENSORS[self.model_arch]:
             raise ValueError(f"Missing {key!r} for MODEL_TENSORS of {self.model_arch!r}")
@@ -256,7 +416,7 @@ class ModelBase:
     def prepare_tensors(self):
         max_name_len = max(len(s) for _, s in self.tensor_map.mapping.values()) + len(".weight,")
 
-        for name, data_torch in chain(self.generate_extra_tensors(), self.get_tensors()):
+        for name, data_torch in chain(self.generate_extra_tensors(), self.get_int4_tensors(self.get_tensors()), self.get_awq_scale_tensors(), self.get_act_scale_tensors()):
             # we don't need these
             if name.endswith((".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")):
                 continue
@@ -264,8 +424,21 @@ class ModelBase:
             old_dtype = data_torch.dtype
 
             # convert any unsupported data types to float32
-            if data_torch.dtype not in (torch.float16, torch.float32):
-                data_torch = data_torch.to(torch.float32)
+            if name in self.transcoded_qtypes:
+                # already in blocks of a GGUF type, see get_int4_tensors
+                pass
+            elif isinstance(data_torch, (np.ndarray, gguf.LazyNumpyTensor)):
+                if data_torch.dtype == gguf.BF16_BITS:
+                    old_dtype = torch.bfloat16
+                elif data_torch.dtype not in (np.float16, np.float32):
+                    data_torch = cast(torch.Tensor, data_torch.astype(np.float32))
+            elif data_torch.dtype not in (torch.float16, torch.float32):
+                if not (self.dtype_passthrough and data_torch.dtype == torch.bfloat16):
+                    data_torch = data_torch.to(torch.float32)
+
+            # folded into the tensors as they are read, before the permutations done in modify_tensors
+            if self.awq is not None and name not in self.transcoded_qtypes:
+                data_torch = self.awq.apply(name, data_torch)
 
             # use the first number-like part of the tensor name as the block id
             bid = None
@@ -274,15 +447,39 @@ class ModelBase:
                     bid = int(part)
                     break
 
-            for new_name, data_torch in (self.modify_tensors(data_torch, name, bid)):
+            if name.endswith(".act_scale"):
+                # indexed by input channel, so not affected by the weight permutations done in modify_tensors
+                new_tensors: Iterable[tuple[str, Tensor]] = [(self.map_tensor_name(name, try_suffixes=(".act_scale",)), data_torch)]
+            else:
+                with gguf.profiling.profile("modify_tensors", name):
+                    new_tensors = list(self.modify_tensors(data_torch, name, bid))
+
+            for new_name, data_torch in new_tensors:
                 # TODO: why do we squeeze here?
                 # data = data_torch.squeeze().numpy()
-                data = data_torch.numpy()
-
-                # if data ends up empty, it means data_torch was a scalar tensor -> restore
-                if len(data.shape) == 0:
+                if isinstance(data_torch, (np.ndarray, gguf.LazyNumpyTensor)):
+                    data = data_torch
+                elif data_torch.dtype == torch.bfloat16:
+                    # kept as its bits, which gguf.quants.quantize copies as-is to BF16 or decodes to F32
+                    data = data_torch.view(torch.int16).numpy().view(gguf.BF16_BITS)
+                else:
                     data = data_torch.numpy()
 
+                    # if data ends up empty, it means data_torch was a scalar tensor -> restore
+                    if len(data.shape) == 0:
+                        data = data_torch.numpy()
+
+                if name in self.transcoded_qtypes and data.dtype == np.uint8:
+                    int4_qtype, n_per_row = self.transcoded_qtypes[name]
+                    shape = gguf.quant_shape_from_byte_shape(data.shape, int4_qtype)
+                    # modify_tensors can reorder, split or stack the rows of blocks, but nothing else
+                    if shape[-1] != n_per_row:
+                        raise ValueError(f"The rows of {name} were changed by modify_tensors, its {int4_qtype.name} blocks can't be written as-is")
+                    shape_str = f"{{{', '.join(str(n) for n in reversed(shape))}}}"
+                    logger.info(f"{f'%-{max_name_len}s' % f'{new_name},'} int4 --> {int4_qtype.name}, shape = {shape_str}")
+                    self.gguf_writer.add_tensor(new_name, data, raw_dtype=int4_qtype)
+                    continue
+
                 n_dims = len(data.shape)
                 data_qtype: gguf.GGMLQuantizationType | bool = self.tensor_force_quant(name, new_name, bid, n_dims)
 
@@ -316,6 +513,11 @@ class ModelBase:
                 ):
                     data_qtype = gguf.GGMLQuantizationType.F32
 
+                # per-tensor types from the recipe, in place of the ones from --outtype
+                if isinstance(data_qtype, bool) and self.recipe is not None:
+                    if (recipe_qtype := self.recipe.qtype_for(new_name, data.shape)) is not None:
+                        data_qtype = recipe_qtype
+
                 if data_qtype is False and any(
                     self.match_model_tensor_name(new_name, key, bid)
                     for key in (
@@ -329,6 +531,17 @@ class ModelBase:
                     ):
                         # TODO: use Q4_K and Q6_K
                         data_qtype = gguf.GGMLQuantizationType.F16
+                    elif self.ftype in (
+                        gguf.LlamaFileType.MOSTLY_Q4_0,
+                        gguf.LlamaFileType.MOSTLY_Q4_1,
+                        gguf.LlamaFileType.MOSTLY_Q2_K,
+                        gguf.LlamaFileType.MOSTLY_Q3_K_S,
+                        gguf.LlamaFileType.MOSTLY_Q4_K_S,
+                        gguf.LlamaFileType.MOSTLY_Q5_K_S,
+                        gguf.LlamaFileType.MOSTLY_IQ4_NL,
+                    ) and self.match_model_tensor_name(new_name, gguf.MODEL_TENSOR.OUTPUT, bid):
+                        # same as llama-quantize
+                        data_qtype = gguf.GGMLQuantizationType.Q6_K
 
                 # No override (data_qtype is False), or wants to be quantized (data_qtype is True)
                 if isinstance(data_qtype, bool):
@@ -340,19 +553,50 @@ class ModelBase:
                         data_qtype = gguf.GGMLQuantizationType.BF16
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_Q8_0:
                         data_qtype = gguf.GGMLQuantizationType.Q8_0
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q4_0:
+                        data_qtype = gguf.GGMLQuantizationType.Q4_0
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q4_1:
+                        data_qtype = gguf.GGMLQuantizationType.Q4_1
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ1_0:
                         data_qtype = gguf.GGMLQuantizationType.TQ1_0
                     elif self.ftype == gguf.LlamaFileType.MOSTLY_TQ2_0:
                         data_qtype = gguf.GGMLQuantizationType.TQ2_0
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q2_K:
+                        data_qtype = gguf.GGMLQuantizationType.Q2_K
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q3_K_S:
+                        data_qtype = gguf.GGMLQuantizationType.Q3_K
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q4_K_S:
+                        data_qtype = gguf.GGMLQuantizationType.Q4_K
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q5_K_S:
+                        data_qtype = gguf.GGMLQuantizationType.Q5_K
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q6_K:
+                        data_qtype = gguf.GGMLQuantizationType.Q6_K
+                    elif self.ftype == gguf.LlamaFileType.MOSTLY_IQ4_NL:
+                        data_qtype = gguf.GGMLQuantizationType.IQ4_NL
                     else:
                         raise ValueError(f"Unknown file type: {self.ftype.name}")
 
+                # importance of the columns, for the types which use it in their scale search
+                imatrix = self.imatrix.get(new_name, data.shape) if self.imatrix is not None else None
+
                 try:
-                    data = gguf.quants.quantize(data, data_qtype)
+                    with gguf.profiling.profile("quantize", new_name):
+                        data = gguf.quants.quantize(data, data_qtype, imatrix=imatrix)
                 except gguf.QuantError as e:
-                    logger.warning("%s, %s", e, "falling back to F16")
-                    data_qtype = gguf.GGMLQuantizationType.F16
-                    data = gguf.quants.quantize(data, data_qtype)
+                    # same fallbacks as llama-quantize when the row size isn't a multiple of the block size
+                    fallback_qtype = {
+                        gguf.GGMLQuantizationType.Q2_K: gguf.GGMLQuantizationType.IQ4_NL,
+                        gguf.GGMLQuantizationType.Q3_K: gguf.GGMLQuantizationType.IQ4_NL,
+                        gguf.GGMLQuantizationType.Q4_K: gguf.GGMLQuantizationType.Q5_0,
+                        gguf.GGMLQuantizationType.Q5_K: gguf.GGMLQuantizationType.Q5_1,
+                        gguf.GGMLQuantizationType.Q6_K: gguf.GGMLQuantizationType.Q8_0,
+                    }.get(data_qtype, gguf.GGMLQuantizationType.F16)
+                    if data.shape[-1] % gguf.GGML_QUANT_SIZES[fallback_qtype][0] != 0:
+                        fallback_qtype = gguf.GGMLQuantizationType.F16
+                    logger.warning("%s, falling back to %s", e, fallback_qtype.name)
+                    data_qtype = fallback_qtype
+                    with gguf.profiling.profile("quantize", new_name):
+                        data = gguf.quants.quantize(data, data_qtype, imatrix=imatrix)
 
                 shape = gguf.quant_shape_from_byte_shape(data.shape, data_qtype) if data.dtype == np.uint8 else data.shape
 
@@ -364,6 +608,25 @@ class ModelBase:
 
                 self.gguf_writer.add_tensor(new_name, data, raw_dtype=data_qtype)
 
+        if self.recipe is not None:
+            for rule in self.recipe.unused_rules():
+                logger.warning(f"Recipe rule {rule.to_dict()} did not match any tensor")
+
+        if self.awq is not None:
+            self.awq.check_all_used()
+
+    def log_size_estimate(self):
+        # from the tensor info, before any tensor data is written (with lazy evaluation, before anything is converted)
+        kv_data = self.gguf_writer.kv_data[0]
+        expert_count = kv_data.get(gguf.Keys.LLM.EXPERT_COUNT.format(arch=self.gguf_writer.arch))
+        expert_used_count = kv_data.get(gguf.Keys.LLM.EXPERT_USED_COUNT.format(arch=self.gguf_writer.arch))
+        estimate = gguf.SizeEstimate.from_tensors(
+            ((name, ti.shape, ti.nbytes) for tensors in self.gguf_writer.tensors for name, ti in tensors.items()),
+            expert_count=expert_count.value if expert_count is not None else 0,
+            expert_used_count=expert_used_count.value if expert_used_count is not None else 0,
+        )
+        estimate.log_summary()
+
     def set_type(self):
         self.gguf_writer.add_type(gguf.GGUFType.MODEL)
 
@@ -396,17 +659,59 @@ class ModelBase:
         logger.info("Set model quantization version")
         self.gguf_writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
 
+        if self.imatrix is not None:
+            # same as llama-quantize --imatrix
+            self.gguf_writer.add_string(gguf.Keys.Quantize.IMATRIX_FILE, str(self.imatrix.path))
+            if self.imatrix.dataset:
+                self.gguf_writer.add_string(gguf.Keys.Quantize.IMATRIX_DATASET, self.imatrix.dataset)
+            self.gguf_writer.add_int32(gguf.Keys.Quantize.IMATRIX_N_ENTRIES, len(self.imatrix))
+            self.gguf_writer.add_int32(gguf.Keys.Quantize.IMATRIX_N_CHUNKS, self.imatrix.chunks_count)
+
+        if "alpha" in self.smoothquant:
+            # the smoothed weights alone, without the activation scales, only give the right results when they are folded
+            self.gguf_writer.add_float32(gguf.Keys.Quantize.SMOOTHQUANT_ALPHA, float(self.smoothquant["alpha"]))
+            self.gguf_writer.add_bool(gguf.Keys.Quantize.SMOOTHQUANT_FOLDED, bool(self.smoothquant.get("folded", False)))
+
     def write_vocab(self):
         raise NotImplementedError("write_vocab() must be implemented in subclasses")
 
     def write(self):
+        if self.streaming:
+            self.write_streaming()
+            return
         self.prepare_tensors()
         self.prepare_metadata(vocab_only=False)
+        self.log_size_estimate()
         self.gguf_writer.write_header_to_file(path=self.fname_out)
         self.gguf_writer.write_kv_data_to_file()
         self.gguf_writer.write_tensors_to_file(progress=True)
         self.gguf_writer.close()
 
+    def write_streaming(self):
+        # The tensor info has to be written before the tensor data, so the tensors are prepared twice:
+        # first lazily to only get their names, types and shapes, and then again to write their data
+        # directly to the output file, without having to keep all of them until the end.
+        # NOTE: modify_tensors and generate_extra_tensors are also called twice, so they must not have other side effects.
+        # The second pass logs the same things as the first one, so the first one is quiet.
+        lazy, logger_disabled = self.lazy, logger.disabled
+        self.lazy = True
+        logger.disabled = True
+        try:
+            self.prepare_tensors()
+        finally:
+            self.lazy = lazy
+            logger.disabled = logger_disabled
+        self.prepare_metadata(vocab_only=False)
+        self.log_size_estimate()
+        self.gguf_writer.write_header_to_file(path=self.fname_out)
+        self.gguf_writer.write_kv_data_to_file()
+        self.gguf_writer.write_ti_data_to_file()
+        self.prepare_tensors()
+        unwritten = [name for tensors in self.gguf_writer.tensors for name in tensors.keys()]
+        if len(unwritten) > 0:
+            raise ValueError(f"Tensors were not written in the second pass: {unwritten}")
+        self.gguf_writer.close()
+
     @staticmethod
     def get_model_part_names(dir_model: Path, prefix: str, suffix: str) -> list[str]:
         part_names: list[str] = []
@@ -1814,7 +2119,7 @@ class StableLMModel(TextModel):
             ename = f"model.layers.{bid}.self_attn.{layer_name}.norms.{xid}.weight"
             datas.append(norms[ename])
             del norms[ename]
-        data_torch = torch.stack(datas, dim=0)
+        data_torch = stack_tensors(datas)
 
         merged_name = f"model.layers.{bid}.self_attn.{layer_name}.weight"
         new_name = self.map_tensor_name(merged_name)
@@ -1846,6 +2151,8 @@ class StableLMModel(TextModel):
 class LlamaModel(TextModel):
     model_arch = gguf.MODEL_ARCH.LLAMA
     undo_permute = True
+    numpy_tensors = True
+    dtype_passthrough = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1956,7 +2263,7 @@ class LlamaModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"layers.{bid}.feed_forward.experts.{wid}.weight"
 
@@ -2114,6 +2421,7 @@ class SmolVLMModel(MmprojModel):
 class Llama4Model(LlamaModel):
     model_arch = gguf.MODEL_ARCH.LLAMA4
     undo_permute = False
+    numpy_tensors = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -2443,7 +2751,7 @@ class GrokModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"transformer.decoder_layer.{bid}.moe.{wid}.weight"
 
@@ -3022,7 +3330,7 @@ class Qwen2MoeModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
 
@@ -3323,7 +3631,7 @@ class PhiMoeModel(Phi3MiniModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.block_sparse_moe.experts.{w_name}.weight"
 
@@ -4672,7 +4980,7 @@ class OlmoeModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
 
@@ -4946,7 +5254,7 @@ class ArcticModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"layers.{bid}.feed_forward.experts.{wid}.weight"
 
@@ -5037,7 +5345,7 @@ class DeepseekModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
 
@@ -5145,7 +5453,7 @@ class DeepseekV2Model(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
 
@@ -5910,6 +6218,7 @@ class GraniteModel(LlamaModel):
 class GraniteMoeModel(GraniteModel):
     """Conversion for IBM's GraniteMoeForCausalLM"""
     model_arch = gguf.MODEL_ARCH.GRANITE_MOE
+    numpy_tensors = False
 
     def set_gguf_parameters(self):
         """GraniteMoeShared uses GraniteMoe parameters plus the following:
@@ -6025,7 +6334,7 @@ class BailingMoeModel(TextModel):
                         datas.append(self._experts[bid][ename])
                         del self._experts[bid][ename]
 
-                    data_torch = torch.stack(datas, dim=0)
+                    data_torch = stack_tensors(datas)
 
                     merged_name = f"model.layers.{bid}.mlp.experts.{w_name}.weight"
 
@@ -6168,6 +6477,10 @@ class LazyTorchTensor(gguf.LazyBase):
     _dtype_map: dict[torch.dtype, type] = {
         torch.float16: np.float16,
         torch.float32: np.float32,
+        # for the bits of BF16 tensors
+        torch.int16: np.int16,
+        # for the blocks of transcoded 4-bit tensors
+        torch.uint8: np.uint8,
     }
 
     # used for safetensors slices
@@ -6231,6 +6544,115 @@ class LazyTorchTensor(gguf.LazyBase):
         return cls._wrap_fn(func)(*args, **kwargs)
 
 
+def stack_tensors(tensors: Sequence[Tensor]) -> Tensor:
+    """
+    Same as torch.stack(tensors, dim=0), for PyTorch tensors and NumPy arrays (lazy or not).
+
+    With lazy tensors, the stacked result is preallocated and each input is only evaluated when it is copied into it,
+    and then freed, so that stacking the experts of a layer needs the memory of the result and of one expert,
+    instead of twice the memory of the result.
+    """
+    first = tensors[0]
+    is_numpy = isinstance(first, (np.ndarray, gguf.LazyNumpyTensor))
+    if not isinstance(first, gguf.LazyBase):
+        return cast(torch.Tensor, np.stack(tensors, axis=0)) if is_numpy else torch.stack(list(tensors), dim=0)
+
+    lazy_type: type[gguf.LazyBase] = type(first)
+    # a NumPy or a PyTorch dtype, depending on the lazy type
+    dtype: Any = first.dtype
+    shape = (len(tensors), *first.shape)
+    for t in tensors:
+        assert type(t) is type(first) and t.dtype == dtype and tuple(t.shape) == shape[1:]
+
+    def fill(pending: gguf.LazyPending) -> Any:
+        out = np.empty(shape, dtype=dtype) if is_numpy else torch.empty(shape, dtype=dtype)
+        for i, t in enumerate(pending.tensors):
+            pending.tensors[i] = None
+            out[i] = lazy_type.to_eager(t)
+            del t
+        return out
+
+    meta = lazy_type.meta_with_dtype_and_shape(dtype, shape)
+    return cast(torch.Tensor, lazy_type(meta=meta, args=(gguf.LazyPending(list(tensors)),), func=fill))
+
+
+def lazy_numpy_from_safetensors(st_tensor: gguf.utility.LocalTensor, raw_bf16: bool = False) -> gguf.LazyNumpyTensor:
+    meta = gguf.LazyNumpyTensor.meta_with_dtype_and_shape(st_tensor.numpy_dtype(raw_bf16), st_tensor.shape)
+    return gguf.LazyNumpyTensor(meta=meta, args=(st_tensor,), func=lambda t: t.numpy(raw_bf16))
+
+
+class AWQResults:
+    """
+    Search results of llm-awq (awq_entry.py --run_awq --dump_awq), folded into the tensors of the original checkpoint
+    as they are read, like its apply_awq does to the model in memory.
+
+    Each scale entry divides the outputs of an op (a norm, or the last rows of a linear layer)
+    and multiplies the input channels of the linear layers which follow it, which leaves the model unchanged
+    while making the salient channels of their weights easier to quantize.
+    The weights are then clipped to the maximum magnitude found for each output row and group.
+    """
+
+    def __init__(self, path: Path):
+        results: dict[str, Any] = torch.load(str(path), map_location="cpu", weights_only=True)
+        # by the name of the op, e.g. model.layers.0.input_layernorm
+        self.out_scales: dict[str, Tensor] = {}
+        # by the name of the weight, e.g. model.layers.0.self_attn.q_proj.weight
+        self.in_scales: dict[str, Tensor] = {}
+        self.clips: dict[str, Tensor] = {}
+        for prev_op_name, layer_names, scales in results.get("scale", []):
+            scales = scales.to(torch.float32)
+            self.out_scales[prev_op_name] = scales
+            for layer_name in layer_names:
+                self.in_scales[layer_name + ".weight"] = scales
+        for layer_name, max_val in results.get("clip", []):
+            self.clips[layer_name + ".weight"] = max_val.to(torch.float32)
+        self.used: set[str] = set()
+        self.activation_ops: set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.out_scales) + len(self.clips)
+
+    def apply(self, name: str, data: Tensor) -> Tensor:
+        """The tensor of the given checkpoint name with the scales and the clipping applied, lazily if it is lazy."""
+        is_numpy = isinstance(data, (np.ndarray, gguf.LazyNumpyTensor))
+
+        def like_data(t: Tensor) -> Any:
+            return t.numpy() if is_numpy else t
+
+        op_name, _, suffix = name.rpartition(".")
+        if suffix in ("weight", "bias") and (scales := self.out_scales.get(op_name)) is not None:
+            self.used.add(op_name)
+            # only the last outputs when the op has more of them than the next layers have inputs (e.g. a fused QKV)
+            divisor = torch.cat([torch.ones(data.shape[0] - scales.shape[0]), scales])
+            data = data / like_data(divisor.reshape(-1, *([1] * (len(data.shape) - 1))))
+        if (scales := self.in_scales.get(name)) is not None:
+            self.used.add(name)
+            data = data * like_data(scales)
+        if (max_val := self.clips.get(name)) is not None:
+            self.used.add(name)
+            # (rows, groups, 1)
+            max_val = like_data(max_val)
+            shape = data.shape
+            data = data.reshape(*max_val.shape[:2], -1).clip(-max_val, max_val).reshape(shape)
+        return data
+
+    def activation_scales(self) -> Iterator[tuple[str, Tensor]]:
+        """
+        Scales of the ops without weights (e.g. the GELU of MPT), as <op>.scales tensors dividing their outputs.
+        Only known once all the tensors of the checkpoint went through apply.
+        """
+        for op_name, scales in self.out_scales.items():
+            if op_name not in self.used:
+                self.activation_ops.add(op_name)
+                yield op_name + ".scales", scales
+
+    def check_all_used(self):
+        # a scale applied on only one side would change the model, which is worse than not applying AWQ at all
+        unused = sorted(set(self.in_scales.keys()).union(self.clips.keys(), self.out_scales.keys()) - self.used - self.activation_ops)
+        if len(unused) > 0:
+            raise ValueError(f"AWQ results for {len(unused)} tensors not found in the model: {unused[:8]}")
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Convert a huggingface model to a GGML compatible file")
@@ -6243,8 +6665,8 @@ def parse_args() -> argparse.Namespace:
         help="path to write to; default: based on input. {ftype} will be replaced by the outtype.",
     )
     parser.add_argument(
-        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "tq1_0", "tq2_0", "auto"], default="f16",
-        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, tq1_0 or tq2_0 for ternary, and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
+        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "q4_0", "q4_1", "tq1_0", "tq2_0", "q2_k", "q3_k", "q4_k", "q5_k", "q6_k", "iq4_nl", "auto"], default="f16",
+        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, q4_0 or q4_1 for Q4_0 or Q4_1, tq1_0 or tq2_0 for ternary, q2_k to q6_k or iq4_nl for k-quants (q4_0 to iq4_nl with a Q6_K output tensor), and auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
     )
     parser.add_argument(
         "--bigendian", action="store_true",
@@ -6299,6 +6721,48 @@ def parse_args() -> argparse.Namespace:
         "--remote", action="store_true",
         help="(Experimental) Read safetensors file remotely without downloading to disk. Config and tokenizer files will still be downloaded. To use this feature, you need to specify Hugging Face model repo name instead of a local directory. For example: 'HuggingFaceTB/SmolLM2-1.7B-Instruct'. Note: To access gated repo, set HF_TOKEN environment variable to your Hugging Face token.",
     )
+    parser.add_argument(
+        "--remote-jobs", type=int, default=8,
+        help="number of parallel range requests when reading a remote model (default: 8)",
+    )
+    parser.add_argument(
+        "--remote-cache", type=Path, default=None,
+        help="directory caching the downloaded blocks of a remote model, so that converting it again does not download anything",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="number of threads used to materialize and quantize tensors in parallel while writing (only with lazy evaluation)",
+    )
+    parser.add_argument(
+        "--max-mem", type=str, default="0",
+        help="memory budget N(K|M|G) for the tensors being materialized in parallel; 0 means no limit",
+    )
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="write the tensor data as it is converted instead of keeping it until the end, by preparing the tensors in two passes (one tensor at a time, so not with --threads or --max-mem)",
+    )
+    parser.add_argument(
+        "--act-scales", type=Path, default=None,
+        help="JSON file of per-channel activation scales for each linear layer (e.g. smoothquant_scales.json), written as F32 <tensor>.act_scale tensors; "
+             "these are not loaded by llama.cpp, and are skipped when smooth_quant_llama2.py already folded them into the norms",
+    )
+    parser.add_argument(
+        "--recipe", type=Path, default=None,
+        help="JSON file of rules choosing the type of each tensor (by regex, tensor kind and layer range, with fallbacks), in place of --outtype for the tensors it matches; see gguf.QuantRecipe",
+    )
+    parser.add_argument(
+        "--imatrix", type=Path, default=None,
+        help="importance matrix file from llama-imatrix, used like llama-quantize --imatrix in the scale search of the quantized output types",
+    )
+    parser.add_argument(
+        "--awq", type=Path, default=None,
+        help="AWQ search results from llm-awq (awq_entry.py --run_awq --dump_awq), whose scales and clipping are applied to the weights as they are read, "
+             "to quantize the original checkpoint in one pass with e.g. --outtype q4_0",
+    )
+    parser.add_argument(
+        "--profile", type=Path, default=None,
+        help="record the time, bytes and memory usage of each conversion stage of each tensor into a Chrome trace file (for chrome://tracing or https://ui.perfetto.dev), and log a summary per stage",
+    )
     parser.add_argument(
         "--mmproj", action="store_true",
         help="(Experimental) Export multimodal projector (mmproj) for vision models. This will only work on some vision models. A prefix 'mmproj-' will be added to the output file name.",
@@ -6374,8 +6838,17 @@ def main() -> None:
         "f16": gguf.LlamaFileType.MOSTLY_F16,
         "bf16": gguf.LlamaFileType.MOSTLY_BF16,
         "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
+        "q4_0": gguf.LlamaFileType.MOSTLY_Q4_0,
+        "q4_1": gguf.LlamaFileType.MOSTLY_Q4_1,
         "tq1_0": gguf.LlamaFileType.MOSTLY_TQ1_0,
         "tq2_0": gguf.LlamaFileType.MOSTLY_TQ2_0,
+        # not the same mixes as the llama-quantize types of the same name, every eligible tensor uses the same type
+        "q2_k": gguf.LlamaFileType.MOSTLY_Q2_K,
+        "q3_k": gguf.LlamaFileType.MOSTLY_Q3_K_S,
+        "q4_k": gguf.LlamaFileType.MOSTLY_Q4_K_S,
+        "q5_k": gguf.LlamaFileType.MOSTLY_Q5_K_S,
+        "q6_k": gguf.LlamaFileType.MOSTLY_Q6_K,
+        "iq4_nl": gguf.LlamaFileType.MOSTLY_IQ4_NL,
         "auto": gguf.LlamaFileType.GUESSED,
     }
 
@@ -6384,6 +6857,15 @@ def main() -> None:
         logger.error("Error: Cannot use temp file when splitting")
         sys.exit(1)
 
+    if args.use_temp_file and args.stream:
+        logger.error("Error: Cannot use temp file when streaming")
+        sys.exit(1)
+
+    if args.stream and (args.threads > 1 or args.max_mem != "0"):
+        # in the second pass, each tensor is written as soon as it is converted
+        logger.error("Error: Cannot use --threads or --max-mem when streaming")
+        sys.exit(1)
+
     if args.outfile is not None:
         fname_out = args.outfile
     elif args.remote:
@@ -6398,6 +6880,14 @@ def main() -> None:
         if "mmproj" not in fname_out.name:
             fname_out = ModelBase.add_prefix_to_filename(fname_out, "mmproj-")
 
+    act_scales = args.act_scales if not args.mmproj else None
+
+    profiler = gguf.profiling.enable() if args.profile is not None else None
+
+    remote_fetcher = None
+    if args.remote:
+        remote_fetcher = gguf.utility.RemoteFetcher(max_workers=args.remote_jobs, cache_dir=args.remote_cache)
+
     with torch.inference_mode():
         output_type = ftype_map[args.outtype]
         model_type = ModelType.MMPROJ if args.mmproj else ModelType.TEXT
@@ -6417,7 +6907,10 @@ def main() -> None:
                                      split_max_tensors=args.split_max_tensors,
                                      split_max_size=split_str_to_n_bytes(args.split_max_size), dry_run=args.dry_run,
                                      small_first_shard=args.no_tensor_first_split,
-                                     remote_hf_model_id=str(args.model) if args.remote else None)
+                                     remote_hf_model_id=str(args.model) if args.remote else None,
+                                     thread_count=args.threads, max_mem=split_str_to_n_bytes(args.max_mem),
+                                     streaming=args.stream, act_scales=act_scales, remote_fetcher=remote_fetcher,
+                                     imatrix=args.imatrix, recipe=args.recipe, awq=args.awq if not args.mmproj else None)
 
         if args.vocab_only:
             logger.info("Exporting model vocab...")
@@ -6429,6 +6922,15 @@ def main() -> None:
             out_path = f"{model_instance.fname_out.parent}{os.sep}" if is_split else model_instance.fname_out
             logger.info(f"Model successfully exported to {out_path}")
 
+    if remote_fetcher is not None:
+        remote_fetcher.close()
+
+    if profiler is not None:
+        gguf.profiling.disable()
+        profiler.write_chrome_trace(args.profile)
+        logger.info(f"Conversion profile written to {args.profile}")
+        profiler.log_summary()
+
 
 if __name__ == '__main__':
     main()
@@ -3,8 +3,11 @@
 SmoothQuant GGUF Converter
 Converts HuggingFace model with SmoothQuant scaling factors to GGUF format
 Includes both weight migration and activation scaling factors for complete W8A8 SmoothQuant
+Unless they are folded into the RMSNorms, the scaling factors are stored as F32 tensors next to the weights,
+e.g. blk.0.attn_q.act_scale, which llama.cpp does not load yet
 """
 
+import os
 import sys
 import json
 import argparse
@@ -37,99 +40,49 @@ def main():
     
     print(f"📊 Loaded {len(smoothquant_scales)} layer scaling factors")
     
-    # 3. Convert to GGUF using original script
+    # Scales folded into the RMSNorms (the default of smooth_quant_llama2.py) are already part of the weights
+    with open(model_dir / "config.json", 'r') as f:
+        folded = json.load(f).get("smoothquant", {}).get("folded", False)
+
+    # 3. Convert to GGUF, with unfolded scales written as per-layer F32 <tensor>.act_scale tensors
     print("🔄 Converting to GGUF with HF script...")
     
     cmd = [
-        sys.executable, "convert_hf_to_gguf.py",
+        sys.executable, str(Path(__file__).parent / "convert_hf_to_gguf.py"),
         str(model_dir),
         "--outfile", str(output_path),
-        "--outtype", args.outtype
+        "--outtype", args.outtype,
     ]
-    
+    if folded:
+        print("✅ Scales are folded into the RMSNorms, no activation scale tensors are needed")
+    else:
+        print("⚠️  The activation scale tensors are not loaded by llama.cpp yet")
+        cmd += ["--act-scales", str(scales_file)]
+
     result = subprocess.run(cmd, capture_output=False)
     if result.returncode != 0:
         print("❌ GGUF conversion failed")
         sys.exit(1)
     
-    print("✅ Basic GGUF conversion completed")
-    
-    # 4. Add SmoothQuant metadata to GGUF
-    print("🔧 Adding SmoothQuant scaling factors to GGUF...")
-    
-    # Import GGUF after subprocess to avoid conflicts
-    import gguf
-    
-    # Re-open GGUF to add SmoothQuant metadata
-    with open(output_path, 'r+b') as f:
-        reader = gguf.GGUFReader(output_path, 'r')
-        
-        # Create new writer to append metadata
-        writer = gguf.GGUFWriter(output_path.with_suffix('.tmp.gguf'), None)
-        
-        # Copy existing metadata
-        for field in reader.fields.values():
-            if field.name.startswith("general."):
-                writer.add_string(field.name, field.parts[0])
-            elif field.name.startswith("tokenizer."):
-                if field.types[0] == gguf.GGUFValueType.STRING:
-                    writer.add_string(field.name, field.parts[0])
-                elif field.types[0] == gguf.GGUFValueType.ARRAY:
-                    writer.add_array(field.name, field.parts)
-        
-        # Add SmoothQuant metadata
-        writer.add_string("smoothquant.enabled", "true")
-        writer.add_string("smoothquant.version", "1.0")
-        
-        # Convert scales to flat format for GGUF
-        scale_data = []
-        layer_names = []
-        
-        for layer_name, scales in smoothquant_scales.items():
-            layer_names.append(layer_name)
-            scale_data.extend(scales)
-        
-        writer.add_array("smoothquant.layer_names", layer_names)
-        writer.add_array("smoothquant.scales", scale_data)
-        
-        print(f"📝 Added {len(layer_names)} layers with {len(scale_data)} total scale values")
-        
-        # Copy tensors
-        for tensor in reader.tensors:
-            writer.add_tensor(tensor.name, tensor.data, tensor.tensor_type)
-        
-        writer.close()
-        reader.close()
-    
-    # Replace original with updated file
-    output_path.unlink()
-    output_path.with_suffix('.tmp.gguf').rename(output_path)
-    
     print(f"🎉 Complete SmoothQuant GGUF created: {output_path}")
     print(f"📏 File size: {output_path.stat().st_size / 1024**3:.2f} GiB")
     
-    # Verify metadata
-    print("🔍 Verifying SmoothQuant metadata...")
-    reader = gguf.GGUFReader(output_path, 'r')
+    # 4. Verify the scale tensors
+    print("🔍 Verifying SmoothQuant scale tensors...")
     
-    has_smoothquant = False
-    for field_name in reader.fields:
-        if field_name.startswith("smoothquant."):
-            has_smoothquant = True
-            field = reader.fields[field_name]
-            if field_name == "smoothquant.enabled":
-                print(f"  ✅ {field_name}: {field.parts[0]}")
-            elif field_name == "smoothquant.layer_names":
-                print(f"  ✅ {field_name}: {len(field.parts)} layers")
-            elif field_name == "smoothquant.scales":
-                print(f"  ✅ {field_name}: {len(field.parts)} scale values")
+    if 'NO_LOCAL_GGUF' not in os.environ:
+        sys.path.insert(1, str(Path(__file__).parent / 'gguf-py'))
+    import gguf
     
-    if has_smoothquant:
-        print("✅ SmoothQuant metadata successfully embedded!")
+    reader = gguf.GGUFReader(output_path, 'r', lazy=True)
+    n_scales = sum(1 for tensor in reader.tensors if tensor.name.endswith(".act_scale"))
+    expected = 0 if folded else len(smoothquant_scales)
+
+    if n_scales == expected:
+        print(f"✅ {n_scales} activation scale tensors successfully embedded!")
     else:
-        print("❌ Warning: SmoothQuant metadata not found in output file")
-    
-    reader.close()
+        print(f"❌ Warning: found {n_scales} activation scale tensors, expected {expected}")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -2,8 +2,12 @@ from .constants import *
 from .lazy import *
 from .gguf_reader import *
 from .gguf_writer import *
+from .gguf_patch import *
 from .quants import *
 from .tensor_mapping import *
 from .vocab import *
 from .utility import *
 from .metadata import *
+from .hashing import *
+from .quant_recipe import *
+from .packed_int4 import *
@@ -24,6 +24,7 @@ class Keys:
         QUANTIZATION_VERSION       = "general.quantization_version"
         ALIGNMENT                  = "general.alignment"
         FILE_TYPE                  = "general.file_type"
+        PADDING                    = "general.padding" # slack for patching the metadata in place
 
         # Authorship Metadata
         NAME                       = "general.name"
@@ -219,6 +220,14 @@ class Keys:
         TYPE       = "adapter.type"
         LORA_ALPHA = "adapter.lora.alpha"
 
+    class Quantize:
+        IMATRIX_FILE       = "quantize.imatrix.file"
+        IMATRIX_DATASET    = "quantize.imatrix.dataset"
+        IMATRIX_N_ENTRIES  = "quantize.imatrix.entries_count"
+        IMATRIX_N_CHUNKS   = "quantize.imatrix.chunks_count"
+        SMOOTHQUANT_ALPHA  = "quantize.smoothquant.alpha"
+        SMOOTHQUANT_FOLDED = "quantize.smoothquant.folded"
+
     class Clip:
         PROJECTOR_TYPE      = "clip.projector_type"
         HAS_VISION_ENCODER  = "clip.has_vision_encoder"
@@ -0,0 +1,188 @@
+#
+# Changing the metadata of a GGUF file without rewriting its tensor data.
+#
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+from typing import Iterable, Mapping
+
+from .constants import GGUF_MAGIC, GGUFEndian, GGUFValueType, Keys
+from .gguf_reader import GGUFReader, LazyReaderFields
+from .gguf_writer import GGUFValue, GGUFWriter
+
+logger = logging.getLogger(__name__)
+
+
+def _padding_kv_size(n: int) -> int:
+    # key length and data, value type, array item type and count, then the padding itself
+    return 8 + len(Keys.General.PADDING.encode("utf-8")) + 4 + 4 + 8 + n
+
+
+def _build_kv_data(
+    reader: GGUFReader, packer: GGUFWriter, set_values: Mapping[str, GGUFValue], remove: Iterable[str],
+) -> tuple[bytes, int]:
+    assert isinstance(reader.fields, LazyReaderFields)
+    remove = set(remove)
+    remove.add(Keys.General.PADDING)
+
+    # fields are in file order, the end of each is the start of the next one
+    names = [name for name in reader.fields if not name.startswith("GGUF.")]
+    offsets = [reader.fields.offset(name) for name in names] + [reader.tensor_info_offset]
+
+    kv_data = bytearray()
+    n_kv = 0
+    for i, name in enumerate(names):
+        if name in remove:
+            continue
+        val = set_values.get(name)
+        if val is None:
+            # unchanged, copy as-is
+            kv_data += reader.data[offsets[i]:offsets[i + 1]].tobytes()
+        else:
+            kv_data += packer._pack_val(name, GGUFValueType.STRING, add_vtype=False)
+            kv_data += packer._pack_val(val.value, val.type, add_vtype=True)
+        n_kv += 1
+
+    for name, val in set_values.items():
+        if name in reader.fields or name in remove:
+            continue
+        kv_data += packer._pack_val(name, GGUFValueType.STRING, add_vtype=False)
+        kv_data += packer._pack_val(val.value, val.type, add_vtype=True)
+        n_kv += 1
+
+    return bytes(kv_data), n_kv
+
+
+def _copy_range(src: int, dst: int, count: int, src_offset: int, dst_offset: int) -> None:
+    # Copy in the kernel when possible (reflinks on some filesystems), otherwise with a plain buffered copy
+    if hasattr(os, "copy_file_range"):
+        try:
+            while count > 0:
+                n = os.copy_file_range(src, dst, count, src_offset, dst_offset)
+                if n == 0:
+                    raise EOFError("unexpected end of file while copying tensor data")
+                count -= n
+                src_offset += n
+                dst_offset += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    if hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst, dst_offset, os.SEEK_SET)
+            while count > 0:
+                n = os.sendfile(dst, src, src_offset, count)
+                if n == 0:
+                    raise EOFError("unexpected end of file while copying tensor data")
+                count -= n
+                src_offset += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    with os.fdopen(os.dup(src), "rb") as fsrc, os.fdopen(os.dup(dst), "r+b") as fdst:
+        fsrc.seek(src_offset)
+        fdst.seek(dst_offset)
+        while count > 0:
+            buf = fsrc.read(min(count, 16 * 1024 * 1024))
+            if not buf:
+                raise EOFError("unexpected end of file while copying tensor data")
+            fdst.write(buf)
+            count -= len(buf)
+
+
+def patch_metadata(
+    path: os.PathLike[str] | str, set_values: Mapping[str, GGUFValue] | None = None, remove: Iterable[str] = (),
+    output: os.PathLike[str] | str | None = None, reserve: int = 0,
+) -> bool:
+    """Set or remove metadata keys of a GGUF file.
+
+    When there is no output (or it is the same file), the header, KV data and tensor info are rewritten in place
+    if they still fit before the tensor data, using the alignment padding or the slack reserved with
+    GGUFWriter(metadata_reserve=...). Otherwise, the file is copied with the tensor data copied by the kernel,
+    and `reserve` bytes of slack are added for the next time.
+
+    The copy only replaces the output once complete, but the in-place rewrite is not atomic:
+    if it is interrupted, the header of the file is left corrupt (the tensor data is never touched).
+
+    Returns whether the file was patched in place.
+    """
+    path = Path(path)
+    set_values = dict(set_values or {})
+    remove = list(remove)
+    in_place = output is None or (Path(output).exists() and Path(output).samefile(path))
+
+    if Keys.General.ALIGNMENT in set_values or Keys.General.ALIGNMENT in remove:
+        raise ValueError("Changing the alignment would move the tensor data")
+
+    reader = GGUFReader(path, "r", lazy=True)
+    # only used to pack the KV data, with the endianness of the file
+    arch = reader.fields[Keys.General.ARCHITECTURE].contents() if Keys.General.ARCHITECTURE in reader.fields else ""
+    packer = GGUFWriter(None, arch, endianess=reader.endianess)
+    order = "<" if reader.endianess == GGUFEndian.LITTLE else ">"
+    version = int(reader.fields["GGUF.version"].parts[0][0])
+    n_tensors = len(reader.tensors)
+    alignment = reader.alignment
+    data_offset = reader.data_offset
+    file_size = len(reader.data)
+
+    kv_data, n_kv = _build_kv_data(reader, packer, set_values, remove)
+    ti_data = reader.data[reader.tensor_info_offset:reader.tensor_info_end].tobytes()
+    reader.close()
+
+    def header(n_kv: int) -> bytes:
+        return struct.pack("<I", GGUF_MAGIC) + struct.pack(f"{order}IQQ", version, n_tensors, n_kv)
+
+    def padding_kv(n: int) -> bytes:
+        return (packer._pack_val(Keys.General.PADDING, GGUFValueType.STRING, add_vtype=False)
+                + packer._pack_val(bytes(n), GGUFValueType.ARRAY, add_vtype=True))
+
+    meta_size = len(header(n_kv)) + len(kv_data) + len(ti_data)
+
+    if in_place:
+        gap = data_offset - meta_size
+        meta = None
+        if 0 <= gap < alignment:
+            # fits in the alignment padding
+            meta = header(n_kv) + kv_data + ti_data + bytes(gap)
+        elif gap >= _padding_kv_size(0):
+            # fill the whole gap, so that the tensor data still starts at the same aligned offset
+            meta = header(n_kv + 1) + kv_data + padding_kv(gap - _padding_kv_size(0)) + ti_data
+        if meta is not None:
+            assert len(meta) == data_offset
+            with open(path, "r+b") as f:
+                f.write(meta)
+                # only report success once the new header is on disk
+                f.flush()
+                os.fsync(f.fileno())
+            logger.info(f"Patched the metadata of {path} in place")
+            return True
+        logger.info(f"New metadata of {path} does not fit in place, copying the file")
+
+    if reserve > 0:
+        meta = header(n_kv + 1) + kv_data + padding_kv(reserve) + ti_data
+    else:
+        meta = header(n_kv) + kv_data + ti_data
+    meta += bytes(GGUFWriter.ggml_pad(len(meta), alignment) - len(meta))
+
+    out_path = path if output is None else Path(output)
+    # write next to the destination, and only replace it once complete
+    fd, tmp_name = tempfile.mkstemp(dir=out_path.parent, prefix=f".{out_path.name}.", suffix=".tmp")
+    try:
+        with open(path, "rb") as fsrc, os.fdopen(fd, "r+b") as fdst:
+            fdst.write(meta)
+            fdst.flush()
+            _copy_range(fsrc.fileno(), fdst.fileno(), file_size - data_offset, data_offset, len(meta))
+        shutil.copymode(out_path if out_path.exists() else path, tmp_name)
+        os.replace(tmp_name, out_path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return False
@@ -6,9 +6,11 @@ from __future__ import annotations
 
 import logging
 import os
+import struct
 import sys
 from collections import OrderedDict
-from typing import Any, Literal, NamedTuple, TypeVar, Union
+from collections.abc import Iterator, Mapping, Sequence
+from typing import Any, Literal, NamedTuple, TypeVar, Union, overload
 
 import numpy as np
 import numpy.typing as npt
@@ -36,6 +38,91 @@ logger = logging.getLogger(__name__)
 READER_SUPPORTED_VERSIONS = [2, GGUF_VERSION]
 
 
+class ReaderArrayParts(Sequence[npt.NDArray[Any]]):
+    # Parts of an array of strings or of numbers, without one NumPy view per element.
+    # Per-element parts are made on demand and are indexed like the equivalent list,
+    # so that code using ReaderField.parts and ReaderField.data keeps working.
+
+    def __init__(
+        self, prefix: list[npt.NDArray[Any]], values: npt.NDArray[Any],
+        offsets: npt.NDArray[np.int64] | None = None, lengths: npt.NDArray[np.int64] | None = None,
+        len_dtype: np.dtype[Any] | None = None,
+    ):
+        # Parts before the first element, like the array type and length.
+        self.prefix = prefix
+        # For numeric arrays, all the elements. For string arrays, the raw bytes
+        # of all the elements, including their length prefixes.
+        self.values = values
+        # For string arrays, the offset into values of the data of each string, and its length.
+        self.offsets = offsets
+        self.lengths = lengths
+        self.len_dtype = len_dtype
+        self.n_elements = len(values) if offsets is None else len(offsets)
+        self.parts_per_element = 1 if offsets is None else 2
+
+    def with_prefix(self, prefix: list[npt.NDArray[Any]]) -> ReaderArrayParts:
+        return ReaderArrayParts(prefix + self.prefix, self.values, self.offsets, self.lengths, self.len_dtype)
+
+    def _element_part(self, idx: int) -> npt.NDArray[Any]:
+        if self.offsets is None:
+            return self.values[idx:idx + 1]
+        assert self.lengths is not None and self.len_dtype is not None
+        elem, is_data = divmod(idx, 2)
+        offs = int(self.offsets[elem])
+        if is_data:
+            return self.values[offs:offs + int(self.lengths[elem])]
+        return self.values[offs - 8:offs].view(self.len_dtype)
+
+    def __len__(self) -> int:
+        return len(self.prefix) + self.n_elements * self.parts_per_element
+
+    @overload
+    def __getitem__(self, idx: int) -> npt.NDArray[Any]: ...
+    @overload
+    def __getitem__(self, idx: slice) -> list[npt.NDArray[Any]]: ...
+
+    def __getitem__(self, idx: int | slice) -> npt.NDArray[Any] | list[npt.NDArray[Any]]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('part index out of range')
+        if idx < len(self.prefix):
+            return self.prefix[idx]
+        return self._element_part(idx - len(self.prefix))
+
+    def __iter__(self) -> Iterator[npt.NDArray[Any]]:
+        yield from self.prefix
+        for idx in range(self.n_elements * self.parts_per_element):
+            yield self._element_part(idx)
+
+    # Same as byte-swapping each part in place, without making a view per element
+    def byteswap(self) -> None:
+        for part in self.prefix:
+            part.byteswap(inplace=True)
+        if self.offsets is None:
+            self.values.byteswap(inplace=True)
+            return
+        if self.n_elements > 0:
+            # the 8 bytes of each length prefix, reversed
+            idx = (self.offsets - 8)[:, None] + np.arange(8)
+            self.values[idx] = self.values[idx[:, ::-1]]
+
+    def contents(self, index_or_slice: int | slice = slice(None)) -> Any:
+        if self.offsets is None:
+            return self.values[index_or_slice].tolist()
+        assert self.lengths is not None
+        buf = self.values.data
+        if isinstance(index_or_slice, int):
+            offs = int(self.offsets[index_or_slice])
+            return str(buf[offs:offs + int(self.lengths[index_or_slice])], encoding = 'utf-8')
+        return [
+            str(buf[offs:offs + slen], encoding = 'utf-8')
+            for offs, slen in zip(self.offsets[index_or_slice].tolist(), self.lengths[index_or_slice].tolist())
+        ]
+
+
 class ReaderField(NamedTuple):
     # Offset to start of this field.
     offset: int
@@ -45,12 +132,13 @@ class ReaderField(NamedTuple):
 
     # Data parts. Some types have multiple components, such as strings
     # that consist of a length followed by the string data.
-    parts: list[npt.NDArray[Any]] = []
+    # Arrays of strings or numbers use a ReaderArrayParts instead of a list.
+    parts: Sequence[npt.NDArray[Any]] = []
 
     # Indexes into parts that we can call the actual data. For example
     # an array of strings will be populated with indexes to the actual
     # string data.
-    data: list[int] = [-1]
+    data: Sequence[int] = [-1]
 
     types: list[GGUFValueType] = []
 
@@ -60,6 +148,9 @@ class ReaderField(NamedTuple):
             main_type = self.types[0]
 
             if main_type == GGUFValueType.ARRAY:
+                if isinstance(self.parts, ReaderArrayParts):
+                    return self.parts.contents(index_or_slice)
+
                 sub_type = self.types[-1]
 
                 if sub_type == GGUFValueType.STRING:
@@ -108,10 +199,75 @@ class ReaderTensor(NamedTuple):
     field: ReaderField
 
 
+# Key/value fields which are only decoded when they are accessed
+class LazyReaderFields(Mapping[str, ReaderField]):
+    def __init__(self, reader: GGUFReader):
+        self._reader = reader
+        self._offsets: dict[str, int] = {}
+        self._fields: dict[str, ReaderField] = {}
+
+    def _push(self, name: str, offset: int, field: ReaderField | None = None) -> None:
+        if name in self._offsets:
+            logger.warning(f'Duplicate key {name} at offset {offset}')
+            name = name + '_{}'.format(offset)
+        self._offsets[name] = offset
+        if field is not None:
+            self._fields[name] = field
+
+    def __getitem__(self, key: str) -> ReaderField:
+        field = self._fields.get(key)
+        if field is None:
+            field, _ = self._reader._build_field(self._offsets[key])
+            self._fields[key] = field
+        return field
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._offsets
+
+    # Offset of a field, without decoding it
+    def offset(self, key: str) -> int:
+        return self._offsets[key]
+
+
+# Tensors which are only built when they are accessed
+class LazyReaderTensors(Sequence[ReaderTensor]):
+    def __init__(self, reader: GGUFReader, offsets: list[int]):
+        self._reader = reader
+        self._offsets = offsets
+        self._tensors: list[ReaderTensor | None] = [None] * len(offsets)
+
+    @overload
+    def __getitem__(self, idx: int) -> ReaderTensor: ...
+    @overload
+    def __getitem__(self, idx: slice) -> list[ReaderTensor]: ...
+
+    def __getitem__(self, idx: int | slice) -> ReaderTensor | list[ReaderTensor]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        tensor = self._tensors[idx]
+        if tensor is None:
+            field = self._reader._get_tensor_info_field(self._offsets[idx])
+            tensor = self._reader._build_tensor(self._reader.data_offset, field)
+            self._tensors[idx] = tensor
+        return tensor
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+
 class GGUFReader:
     # I - same as host, S - swapped
     byte_order: Literal['I', 'S'] = 'I'
     alignment: int = GGUF_DEFAULT_ALIGNMENT
+    # The tensor infos are in [tensor_info_offset, tensor_info_end), followed by padding up to data_offset
+    tensor_info_offset: int
+    tensor_info_end: int
     data_offset: int
 
     # Note: Internal helper, API may change.
@@ -129,8 +285,12 @@ class GGUFReader:
         GGUFValueType.BOOL:    np.bool_,
     }
 
-    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r', 'r+', 'c'] = 'r'):
+    # With lazy=True, only the offsets of the fields and tensors are read when opening the file,
+    # and they are decoded when they are first accessed.
+    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r', 'r+', 'c'] = 'r', lazy: bool = False):
         self.data = np.memmap(path, mode = mode)
+        self._buf = self.data.data
+        self.lazy = lazy
         offs = 0
 
         # Check for GGUF magic
@@ -157,8 +317,11 @@ class GGUFReader:
             host_endian = GGUFEndian.BIG
             swapped_endian = GGUFEndian.LITTLE
         self.endianess = swapped_endian if self.byte_order == "S" else host_endian
-        self.fields: OrderedDict[str, ReaderField] = OrderedDict()
-        self.tensors: list[ReaderTensor] = []
+        # for reading sizes with struct, which is much faster than making a NumPy view for each
+        self._struct_order = '=' if self.byte_order == 'I' else ('>' if sys.byteorder == 'little' else '<')
+        self.fields: Mapping[str, ReaderField] = LazyReaderFields(self) if lazy else OrderedDict()
+        self.tensors: Sequence[ReaderTensor] = []
+        self._tensor_index: dict[str, int] = {}
         offs += self._push_field(ReaderField(offs, 'GGUF.version', [temp_version], [0], [GGUFValueType.UINT32]))
 
         # Check tensor count and kv count
@@ -166,10 +329,17 @@ class GGUFReader:
         offs += self._push_field(ReaderField(offs, 'GGUF.tensor_count', [temp_counts[:1]], [0], [GGUFValueType.UINT64]))
         offs += self._push_field(ReaderField(offs, 'GGUF.kv_count', [temp_counts[1:]], [0], [GGUFValueType.UINT64]))
         tensor_count, kv_count = temp_counts
-        offs = self._build_fields(offs, kv_count)
+        if lazy:
+            offs = self._index_fields(offs, kv_count)
+            self.tensor_info_offset = offs
+            offs, tensor_offsets = self._index_tensor_info(offs, tensor_count)
+        else:
+            offs = self._build_fields(offs, kv_count)
 
-        # Build Tensor Info Fields
-        offs, tensors_fields = self._build_tensor_info(offs, tensor_count)
+            # Build Tensor Info Fields
+            self.tensor_info_offset = offs
+            offs, tensors_fields = self._build_tensor_info(offs, tensor_count)
+        self.tensor_info_end = offs
         new_align = self.fields.get('general.alignment')
         if new_align is not None:
             if new_align.types != [GGUFValueType.UINT32]:
@@ -179,7 +349,10 @@ class GGUFReader:
         if padding != 0:
             offs += self.alignment - padding
         self.data_offset = offs
-        self._build_tensors(offs, tensors_fields)
+        if lazy:
+            self.tensors = LazyReaderTensors(self, tensor_offsets)
+        else:
+            self._build_tensors(offs, tensors_fields)
 
     _DT = TypeVar('_DT', bound = npt.DTypeLike)
 
@@ -191,6 +364,21 @@ class GGUFReader:
     def get_tensor(self, idx: int) -> ReaderTensor:
         return self.tensors[idx]
 
+    # Fetch a tensor by name.
+    def get_tensor_by_name(self, name: str) -> Union[ReaderTensor, None]:
+        idx = self._tensor_index.get(name)
+        return self.tensors[idx] if idx is not None else None
+
+    # Release the memory map, which is unmapped once the arrays taken from the reader (e.g. tensor data) are gone.
+    # With lazy=True, the fields and tensors refer back to the reader, so it isn't freed when its last reference is.
+    # The reader can't be used afterwards.
+    def close(self) -> None:
+        self._buf.release()
+        self.fields = OrderedDict()
+        self.tensors = []
+        self._tensor_index = {}
+        del self.data
+
     def _get(
         self, offset: int, dtype: npt.DTypeLike, count: int = 1, override_order: None | Literal['I', 'S', '<'] = None,
     ) -> npt.NDArray[Any]:
@@ -201,14 +389,16 @@ class GGUFReader:
         return arr.view(arr.dtype.newbyteorder(self.byte_order if override_order is None else override_order))
 
     def _push_field(self, field: ReaderField, skip_sum: bool = False) -> int:
-        if field.name in self.fields:
+        if isinstance(self.fields, LazyReaderFields):
+            self.fields._push(field.name, field.offset, field)
+        elif field.name in self.fields:
             # TODO: add option to generate error on duplicate keys
             # raise KeyError(f'Duplicate {field.name} already in list at offset {field.offset}')
 
             logger.warning(f'Duplicate key {field.name} at offset {field.offset}')
-            self.fields[field.name + '_{}'.format(field.offset)] = field
+            self.fields[field.name + '_{}'.format(field.offset)] = field  # type: ignore
         else:
-            self.fields[field.name] = field
+            self.fields[field.name] = field  # type: ignore
         return 0 if skip_sum else sum(int(part.nbytes) for part in field.parts)
 
     def _get_str(self, offset: int) -> tuple[npt.NDArray[np.uint64], npt.NDArray[np.uint8]]:
@@ -217,7 +407,7 @@ class GGUFReader:
 
     def _get_field_parts(
         self, orig_offs: int, raw_type: int,
-    ) -> tuple[int, list[npt.NDArray[Any]], list[int], list[GGUFValueType]]:
+    ) -> tuple[int, Sequence[npt.NDArray[Any]], Sequence[int], list[GGUFValueType]]:
         offs = orig_offs
         types: list[GGUFValueType] = []
         gtype = GGUFValueType(raw_type)
@@ -239,6 +429,20 @@ class GGUFReader:
             alen = self._get(offs, np.uint64)
             offs += int(alen.nbytes)
             aparts: list[npt.NDArray[Any]] = [raw_itype, alen]
+            count = int(alen[0])
+            itype = GGUFValueType(raw_itype[0])
+            # Fast paths for arrays of strings or numbers, which can be huge (e.g. tokenizer.ggml.tokens)
+            nptype = self.gguf_scalar_to_np.get(itype)
+            if nptype is not None:
+                values = self._get(offs, nptype, count)
+                types.append(itype)
+                return int(offs - orig_offs + values.nbytes), ReaderArrayParts(aparts, values), range(2, 2 + count), types
+            if itype == GGUFValueType.STRING:
+                offsets, lengths, end_offs = self._scan_string_array(offs, count)
+                values = self.data[offs:end_offs]
+                string_parts = ReaderArrayParts(aparts, values, offsets, lengths, np.dtype(np.uint64).newbyteorder(self.byte_order))
+                types.append(itype)
+                return end_offs - orig_offs, string_parts, range(3, 3 + 2 * count, 2), types
             data_idxs: list[int] = []
             # FIXME: Handle multi-dimensional arrays properly instead of flattening
             for idx in range(alen[0]):
@@ -283,27 +487,109 @@ class GGUFReader:
             [1, 3, 4, 5],
         )
 
+    def _build_field(self, orig_offs: int) -> tuple[ReaderField, int]:
+        offs = orig_offs
+        kv_klen, kv_kdata = self._get_str(offs)
+        offs += int(kv_klen.nbytes + kv_kdata.nbytes)
+        raw_kv_type = self._get(offs, np.uint32)
+        offs += int(raw_kv_type.nbytes)
+        parts: list[npt.NDArray[Any]] = [kv_klen, kv_kdata, raw_kv_type]
+        idxs_offs = len(parts)
+        field_size, field_parts, field_idxs, field_types = self._get_field_parts(offs, raw_kv_type[0])
+        data: Sequence[int]
+        if isinstance(field_parts, ReaderArrayParts):
+            assert isinstance(field_idxs, range)
+            all_parts: Sequence[npt.NDArray[Any]] = field_parts.with_prefix(parts)
+            data = range(field_idxs.start + idxs_offs, field_idxs.stop + idxs_offs, field_idxs.step)
+        else:
+            all_parts = parts + list(field_parts)
+            data = [idx + idxs_offs for idx in field_idxs]
+        field = ReaderField(
+            orig_offs,
+            str(bytes(kv_kdata), encoding = 'utf-8'),
+            all_parts,
+            data,
+            field_types,
+        )
+        return field, offs + field_size
+
     def _build_fields(self, offs: int, count: int) -> int:
+        for _ in range(count):
+            field, offs = self._build_field(offs)
+            self._push_field(field, skip_sum = True)
+        return offs
+
+    def _unpack(self, fmt: str, offset: int) -> tuple[Any, ...]:
+        return struct.unpack_from(self._struct_order + fmt, self._buf, offset)
+
+    # Offsets and lengths of the data of each string in an array, in a single pass over the length prefixes
+    def _scan_string_array(self, offs: int, count: int) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64], int]:
+        offsets: list[int] = []
+        lengths: list[int] = []
+        unpack_len = struct.Struct(self._struct_order + 'Q').unpack_from
+        buf = self._buf
+        end = offs
+        for _ in range(count):
+            slen = unpack_len(buf, end)[0]
+            end += 8
+            offsets.append(end - offs)
+            lengths.append(slen)
+            end += slen
+        return np.array(offsets, dtype = np.int64), np.array(lengths, dtype = np.int64), end
+
+    # Size of a field value, without decoding it
+    def _get_field_size(self, offs: int, raw_type: int) -> int:
+        gtype = GGUFValueType(raw_type)
+        if gtype == GGUFValueType.STRING:
+            return 8 + self._unpack('Q', offs)[0]
+        nptype = self.gguf_scalar_to_np.get(gtype)
+        if nptype is not None:
+            return np.dtype(nptype).itemsize
+        if gtype == GGUFValueType.ARRAY:
+            raw_itype, alen = self._unpack('IQ', offs)
+            size = 12
+            nptype = self.gguf_scalar_to_np.get(GGUFValueType(raw_itype))
+            if nptype is not None:
+                return size + alen * np.dtype(nptype).itemsize
+            if raw_itype == GGUFValueType.STRING:
+                unpack_len = struct.Struct(self._struct_order + 'Q').unpack_from
+                end = offs + size
+                for _ in range(alen):
+                    end += 8 + unpack_len(self._buf, end)[0]
+                return end - offs
+            for _ in range(alen):
+                size += self._get_field_size(offs + size, raw_itype)
+            return size
+        raise ValueError(f'Unknown/unhandled field type {gtype}')
+
+    def _index_fields(self, offs: int, count: int) -> int:
+        assert isinstance(self.fields, LazyReaderFields)
         for _ in range(count):
             orig_offs = offs
-            kv_klen, kv_kdata = self._get_str(offs)
-            offs += int(kv_klen.nbytes + kv_kdata.nbytes)
-            raw_kv_type = self._get(offs, np.uint32)
-            offs += int(raw_kv_type.nbytes)
-            parts: list[npt.NDArray[Any]] = [kv_klen, kv_kdata, raw_kv_type]
-            idxs_offs = len(parts)
-            field_size, field_parts, field_idxs, field_types = self._get_field_parts(offs, raw_kv_type[0])
-            parts += field_parts
-            self._push_field(ReaderField(
-                orig_offs,
-                str(bytes(kv_kdata), encoding = 'utf-8'),
-                parts,
-                [idx + idxs_offs for idx in field_idxs],
-                field_types,
-            ), skip_sum = True)
-            offs += field_size
+            klen = self._unpack('Q', offs)[0]
+            name = str(self._buf[offs + 8:offs + 8 + klen], encoding = 'utf-8')
+            offs += 8 + klen
+            raw_kv_type = self._unpack('I', offs)[0]
+            offs += 4
+            offs += self._get_field_size(offs, raw_kv_type)
+            self.fields._push(name, orig_offs)
         return offs
 
+    def _index_tensor_info(self, offs: int, count: int) -> tuple[int, list[int]]:
+        offsets = []
+        for idx in range(count):
+            offsets.append(offs)
+            name_len = self._unpack('Q', offs)[0]
+            tensor_name = str(self._buf[offs + 8:offs + 8 + name_len], encoding = 'utf-8')
+            if tensor_name in self._tensor_index:
+                raise ValueError(f'Found duplicated tensor with name {tensor_name}')
+            self._tensor_index[tensor_name] = idx
+            offs += 8 + name_len
+            n_dims = self._unpack('I', offs)[0]
+            # dims, type and offset
+            offs += 4 + 8 * n_dims + 4 + 8
+        return offs, offsets
+
     def _build_tensor_info(self, offs: int, count: int) -> tuple[int, list[ReaderField]]:
         tensor_fields = []
         for _ in range(count):
@@ -313,55 +599,59 @@ class GGUFReader:
         return offs, tensor_fields
 
     def _build_tensors(self, start_offs: int, fields: list[ReaderField]) -> None:
-        tensors = []
-        tensor_names = set() # keep track of name to prevent duplicated tensors
+        tensors: list[ReaderTensor] = []
+        tensor_index: dict[str, int] = {} # keep track of name to prevent duplicated tensors
         for field in fields:
-            _name_len, name_data, _n_dims, dims, raw_dtype, offset_tensor = field.parts
             # check if there's any tensor having same name already in the list
-            tensor_name = str(bytes(name_data), encoding = 'utf-8')
-            if tensor_name in tensor_names:
-                raise ValueError(f'Found duplicated tensor with name {tensor_name}')
-            tensor_names.add(tensor_name)
-            ggml_type = GGMLQuantizationType(raw_dtype[0])
-            n_elems = int(np.prod(dims))
-            np_dims = tuple(reversed(dims.tolist()))
-            block_size, type_size = GGML_QUANT_SIZES[ggml_type]
-            n_bytes = n_elems * type_size // block_size
-            data_offs = int(start_offs + offset_tensor[0])
-            item_type: npt.DTypeLike
-            if ggml_type == GGMLQuantizationType.F16:
-                item_count = n_elems
-                item_type = np.float16
-            elif ggml_type == GGMLQuantizationType.F32:
-                item_count = n_elems
-                item_type = np.float32
-            elif ggml_type == GGMLQuantizationType.F64:
-                item_count = n_elems
-                item_type = np.float64
-            elif ggml_type == GGMLQuantizationType.I8:
-                item_count = n_elems
-                item_type = np.int8
-            elif ggml_type == GGMLQuantizationType.I16:
-                item_count = n_elems
-                item_type = np.int16
-            elif ggml_type == GGMLQuantizationType.I32:
-                item_count = n_elems
-                item_type = np.int32
-            elif ggml_type == GGMLQuantizationType.I64:
-                item_count = n_elems
-                item_type = np.int64
-            else:
-                item_count = n_bytes
-                item_type = np.uint8
-                np_dims = quant_shape_to_byte_shape(np_dims, ggml_type)
-            tensors.append(ReaderTensor(
-                name = tensor_name,
-                tensor_type = ggml_type,
-                shape = dims,
-                n_elements = n_elems,
-                n_bytes = n_bytes,
-                data_offset = data_offs,
-                data = self._get(data_offs, item_type, item_count).reshape(np_dims),
-                field = field,
-            ))
+            if field.name in tensor_index:
+                raise ValueError(f'Found duplicated tensor with name {field.name}')
+            tensor_index[field.name] = len(tensors)
+            tensors.append(self._build_tensor(start_offs, field))
         self.tensors = tensors
+        self._tensor_index = tensor_index
+
+    def _build_tensor(self, start_offs: int, field: ReaderField) -> ReaderTensor:
+        _name_len, _name_data, _n_dims, dims, raw_dtype, offset_tensor = field.parts
+        tensor_name = field.name
+        ggml_type = GGMLQuantizationType(raw_dtype[0])
+        n_elems = int(np.prod(dims))
+        np_dims = tuple(reversed(dims.tolist()))
+        block_size, type_size = GGML_QUANT_SIZES[ggml_type]
+        n_bytes = n_elems * type_size // block_size
+        data_offs = int(start_offs + offset_tensor[0])
+        item_type: npt.DTypeLike
+        if ggml_type == GGMLQuantizationType.F16:
+            item_count = n_elems
+            item_type = np.float16
+        elif ggml_type == GGMLQuantizationType.F32:
+            item_count = n_elems
+            item_type = np.float32
+        elif ggml_type == GGMLQuantizationType.F64:
+            item_count = n_elems
+            item_type = np.float64
+        elif ggml_type == GGMLQuantizationType.I8:
+            item_count = n_elems
+            item_type = np.int8
+        elif ggml_type == GGMLQuantizationType.I16:
+            item_count = n_elems
+            item_type = np.int16
+        elif ggml_type == GGMLQuantizationType.I32:
+            item_count = n_elems
+            item_type = np.int32
+        elif ggml_type == GGMLQuantizationType.I64:
+            item_count = n_elems
+            item_type = np.int64
+        else:
+            item_count = n_bytes
+            item_type = np.uint8
+            np_dims = quant_shape_to_byte_shape(np_dims, ggml_type)
+        return ReaderTensor(
+            name = tensor_name,
+            tensor_type = ggml_type,
+            shape = dims,
+            n_elements = n_elems,
+            n_bytes = n_bytes,
+            data_offset = data_offs,
+            data = self._get(data_offs, item_type, item_count).reshape(np_dims),
+            field = field,
+        )
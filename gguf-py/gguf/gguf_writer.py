@@ -5,12 +5,14 @@ import os
 import shutil
 import struct
 import tempfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from enum import Enum, auto
 from math import prod
 from pathlib import Path
 from io import BufferedWriter
-from typing import IO, Any, Sequence, Mapping
+from typing import IO, Any, Iterable, Iterator, Sequence, Mapping
 from string import ascii_letters, digits
 
 import numpy as np
@@ -29,6 +31,8 @@ from .constants import (
     ExpertGatingFuncType,
 )
 
+from . import profiling
+from .lazy import LazyBase
 from .quants import quant_shape_from_byte_shape
 
 logger = logging.getLogger(__name__)
@@ -81,9 +85,14 @@ class GGUFWriter:
         GGUFValueType.BOOL:    "?",
     }
 
+    # for packing arrays of numbers in bulk, the byte order is set when packing
+    _array_value_dtypes = {vtype: np.dtype(fmt) for vtype, fmt in _simple_value_packing.items()}
+    _dtype_array_value_types = {dtype: vtype for vtype, dtype in _array_value_dtypes.items()}
+
     def __init__(
         self, path: os.PathLike[str] | str | None, arch: str, use_temp_file: bool = False, endianess: GGUFEndian = GGUFEndian.LITTLE,
-        split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False, small_first_shard: bool = False
+        split_max_tensors: int = 0, split_max_size: int = 0, dry_run: bool = False, small_first_shard: bool = False,
+        thread_count: int = 1, max_mem: int = 0, streaming: bool = False, metadata_reserve: int = 0,
     ):
         self.fout = None
         self.path = Path(path) if path else None
@@ -98,6 +107,13 @@ class GGUFWriter:
         self.split_max_size = split_max_size
         self.dry_run = dry_run
         self.small_first_shard = small_first_shard
+        self.thread_count = thread_count
+        self.max_mem = max_mem
+        self.streaming = streaming
+        # bytes of slack after the KV data, so that the metadata can later be changed without rewriting the tensor data
+        self.metadata_reserve = metadata_reserve
+        if self.streaming and self.use_temp_file:
+            raise ValueError("Can't use a temp file when streaming the tensor data")
         logger.info("gguf: This GGUF file is for {0} Endian only".format(
             "Big" if self.endianess == GGUFEndian.BIG else "Little",
         ))
@@ -220,6 +236,9 @@ class GGUFWriter:
 
         self.add_shard_kv_data()
 
+        if self.metadata_reserve > 0:
+            self.kv_data[0][Keys.General.PADDING] = GGUFValue(bytes(self.metadata_reserve), GGUFValueType.ARRAY)
+
         for fout, tensors, kv_data in zip(self.fout, self.tensors, self.kv_data):
             fout.write(self._pack("<I", GGUF_MAGIC, skip_pack_prefix = True))
             fout.write(self._pack("I", GGUF_VERSION))
@@ -370,6 +389,17 @@ class GGUFWriter:
         self, name: str, tensor: np.ndarray[Any, Any], raw_shape: Sequence[int] | None = None,
         raw_dtype: GGMLQuantizationType | None = None,
     ) -> None:
+        shape: Sequence[int] = raw_shape if raw_shape is not None else tensor.shape
+
+        if self.streaming:
+            # First pass: only record the shape and type, the data is given again once the tensor info is written.
+            # Second pass: write the data directly at its final offset in the output file.
+            if self.state is WriterState.NO_FILE:
+                self.add_tensor_info(name, shape, tensor.dtype, tensor.nbytes, raw_dtype=raw_dtype)
+            else:
+                self.write_tensor_data(tensor, name=name)
+            return
+
         if self.endianess == GGUFEndian.BIG:
             tensor.byteswap(inplace=True)
         if self.use_temp_file and self.temp_file is None:
@@ -377,7 +407,6 @@ class GGUFWriter:
             fp.seek(0)
             self.temp_file = fp
 
-        shape: Sequence[int] = raw_shape if raw_shape is not None else tensor.shape
         self.add_tensor_info(name, shape, tensor.dtype, tensor.nbytes, raw_dtype=raw_dtype)
 
         if self.temp_file is None:
@@ -392,35 +421,46 @@ class GGUFWriter:
         if pad != 0:
             fp.write(bytes([0] * pad))
 
-    def write_tensor_data(self, tensor: np.ndarray[Any, Any]) -> None:
+    def write_tensor_data(self, tensor: np.ndarray[Any, Any], name: str | None = None) -> None:
         if self.state is not WriterState.TI_DATA and self.state is not WriterState.WEIGHTS:
             raise ValueError(f'Expected output file to contain tensor info or weights, got {self.state}')
         assert self.fout is not None
 
-        if self.endianess == GGUFEndian.BIG:
-            tensor.byteswap(inplace=True)
-
         file_id = -1
         for i, tensors in enumerate(self.tensors):
             if len(tensors) > 0:
                 file_id = i
                 break
 
+        if file_id < 0:
+            raise ValueError(f'No more tensor info to write data for, got {name!r}')
+
         fout = self.fout[file_id]
 
         # pop the first tensor info
-        # TODO: cleaner way to get the first key
-        first_tensor_name = [name for name, _ in zip(self.tensors[file_id].keys(), range(1))][0]
+        first_tensor_name = next(iter(self.tensors[file_id].keys()))
+        if name is not None and name != first_tensor_name:
+            raise ValueError(f'Expected data for tensor {first_tensor_name!r}, got {name!r}')
         ti = self.tensors[file_id].pop(first_tensor_name)
         assert ti.nbytes == tensor.nbytes
 
-        self.write_padding(fout, fout.tell())
-        tensor.tofile(fout)
-        self.write_padding(fout, tensor.nbytes)
+        # materialize lazy tensors before modifying them in-place
+        with profiling.profile("materialize", name, nbytes=ti.nbytes):
+            tensor = LazyBase.to_eager(tensor)
+        if self.endianess == GGUFEndian.BIG:
+            tensor.byteswap(inplace=True)
+
+        with profiling.profile("write", name, nbytes=tensor.nbytes):
+            self.write_padding(fout, fout.tell())
+            tensor.tofile(fout)
+            self.write_padding(fout, tensor.nbytes)
 
         self.state = WriterState.WEIGHTS
 
     def write_tensors_to_file(self, *, progress: bool = False) -> None:
+        if self.streaming:
+            raise ValueError("When streaming, the tensor data is written by add_tensor after write_ti_data_to_file")
+
         self.write_ti_data_to_file()
 
         assert self.fout is not None
@@ -441,23 +481,27 @@ class GGUFWriter:
                     shard_bar = tqdm(desc=f"Shard (0/{len(self.fout)})", total=None, unit="byte", unit_scale=True)
                 bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
 
+            # relying on the fact that Python dicts preserve insertion order (since 3.7)
+            materialized = self._materialize_tensors(item for tensors in self.tensors for item in tensors.items())
+
             for i, (fout, tensors) in enumerate(zip(self.fout, self.tensors)):
                 if shard_bar is not None:
                     shard_bar.set_description(f"Shard ({i + 1}/{len(self.fout)})")
                     total = sum(ti.nbytes for ti in tensors.values())
                     shard_bar.reset(total=(total if total > 0 else None))
 
-                # relying on the fact that Python dicts preserve insertion order (since 3.7)
-                for ti in tensors.values():
-                    assert ti.tensor is not None  # can only iterate once over the tensors
-                    assert ti.tensor.nbytes == ti.nbytes
-                    ti.tensor.tofile(fout)
+                for name, ti in tensors.items():
+                    done_ti, tensor = next(materialized)
+                    assert done_ti is ti
+                    assert tensor.nbytes == ti.nbytes
+                    with profiling.profile("write", name, nbytes=ti.nbytes):
+                        tensor.tofile(fout)
+                        self.write_padding(fout, ti.nbytes)
                     if shard_bar is not None:
                         shard_bar.update(ti.nbytes)
                     if bar is not None:
                         bar.update(ti.nbytes)
-                    self.write_padding(fout, ti.nbytes)
-                    ti.tensor = None
+                    del tensor
         else:
             self.temp_file.seek(0)
 
@@ -467,6 +511,47 @@ class GGUFWriter:
 
         self.state = WriterState.WEIGHTS
 
+    def _materialize_tensors(self, tensor_infos: Iterable[tuple[str, TensorInfo]]) -> Iterator[tuple[TensorInfo, np.ndarray[Any, Any]]]:
+        # Evaluates the (possibly lazy) tensors, yielding them in the same order as given.
+        # With more than one thread, the next tensors are evaluated in the background
+        # while the previous ones are written, as long as the memory budget allows it.
+        def evaluate(name: str, ti: TensorInfo) -> np.ndarray[Any, Any]:
+            assert ti.tensor is not None  # can only iterate once over the tensors
+            with profiling.profile("materialize", name, nbytes=ti.nbytes):
+                tensor = LazyBase.to_eager(ti.tensor)
+            # release the lazy graph (and its intermediate results) as soon as possible
+            ti.tensor = None
+            return tensor
+
+        if self.thread_count <= 1:
+            for name, ti in tensor_infos:
+                yield ti, evaluate(name, ti)
+            return
+
+        pending: deque[tuple[TensorInfo, Future[np.ndarray[Any, Any]], int]] = deque()
+        mem_in_flight = 0
+        remaining = iter(tensor_infos)
+        next_item: tuple[str, TensorInfo] | None = next(remaining, None)
+
+        with ThreadPoolExecutor(max_workers=self.thread_count, thread_name_prefix="gguf-writer") as executor:
+            while next_item is not None or len(pending) > 0:
+                # keep the workers busy, but don't let them get too far ahead of the writer
+                while next_item is not None and len(pending) < 2 * self.thread_count:
+                    next_name, next_ti = next_item
+                    cost = LazyBase.eager_nbytes(next_ti.tensor)
+                    # always allow at least one tensor in flight, even when it's bigger than the budget
+                    if self.max_mem > 0 and len(pending) > 0 and mem_in_flight + cost > self.max_mem:
+                        break
+                    pending.append((next_ti, executor.submit(evaluate, next_name, next_ti), cost))
+                    mem_in_flight += cost
+                    next_item = next(remaining, None)
+
+                ti, future, cost = pending.popleft()
+                tensor = future.result()
+                yield ti, tensor
+                del tensor
+                mem_in_flight -= cost
+
     def flush(self) -> None:
         assert self.fout is not None
         for fout in self.fout:
@@ -1037,7 +1122,15 @@ class GGUFWriter:
             kv_data += encoded_val
         elif vtype == GGUFValueType.ARRAY:
 
-            if not isinstance(val, Sequence):
+            ltype: GGUFValueType
+            if isinstance(val, np.ndarray):
+                if val.ndim != 1:
+                    raise ValueError(f"Invalid GGUF metadata array, expecting 1 dimension, got {val.ndim}")
+                ltype_from_dtype = self._dtype_array_value_types.get(val.dtype.newbyteorder("="))
+                if ltype_from_dtype is None:
+                    raise ValueError(f"Invalid GGUF metadata array, unsupported dtype {val.dtype}")
+                ltype = ltype_from_dtype
+            elif not isinstance(val, Sequence):
                 raise ValueError("Invalid GGUF metadata array, expecting sequence")
 
             if len(val) == 0:
@@ -1045,18 +1138,48 @@ class GGUFWriter:
 
             if isinstance(val, bytes):
                 ltype = GGUFValueType.UINT8
-            else:
+            elif not isinstance(val, np.ndarray):
+                # check the type of each distinct Python type only once
                 ltype = GGUFValueType.get_type(val[0])
-                if not all(GGUFValueType.get_type(i) is ltype for i in val[1:]):
+                samples = dict(zip(map(type, val), val))
+                if not all(GGUFValueType.get_type(i) is ltype for i in samples.values()):
                     raise ValueError("All items in a GGUF array should be of the same type")
             kv_data += self._pack("I", ltype)
             kv_data += self._pack("Q", len(val))
-            for item in val:
-                kv_data += self._pack_val(item, ltype, add_vtype=False)
+            if isinstance(val, bytes):
+                # already packed, e.g. the metadata padding
+                kv_data += val
+            elif ltype in self._array_value_dtypes:
+                kv_data += self._pack_numeric_array(val, ltype)
+            elif ltype == GGUFValueType.STRING:
+                kv_data += self._pack_string_array(val)
+            else:
+                for item in val:
+                    kv_data += self._pack_val(item, ltype, add_vtype=False)
         else:
             raise ValueError("Invalid GGUF metadata value type or value")
 
-        return kv_data
+        return bytes(kv_data)
+
+    def _pack_numeric_array(self, val: Sequence[Any] | np.ndarray, ltype: GGUFValueType) -> bytes:
+        dtype = self._array_value_dtypes[ltype]
+        if dtype.kind != "b":
+            dtype = dtype.newbyteorder("<" if self.endianess == GGUFEndian.LITTLE else ">")
+        if isinstance(val, np.ndarray):
+            return val.astype(dtype, copy=False).tobytes()
+        if dtype.kind in "iu":
+            # out of range values are an error, like with struct.pack
+            values = np.array(val, dtype=np.int64)
+            info = np.iinfo(dtype)
+            if values.min() < info.min or values.max() > info.max:
+                raise ValueError(f"Value out of range for a GGUF array of {ltype.name}")
+            return values.astype(dtype).tobytes()
+        return np.array(val, dtype=dtype).tobytes()
+
+    def _pack_string_array(self, val: Sequence[str | bytes | bytearray]) -> bytes:
+        pack_len = struct.Struct(("<" if self.endianess == GGUFEndian.LITTLE else ">") + "Q").pack
+        encoded = [v.encode("utf-8") if isinstance(v, str) else v for v in val]
+        return b"".join(pack_len(len(e)) + e for e in encoded)
 
     @staticmethod
     def format_n_bytes_to_str(num: int) -> str:
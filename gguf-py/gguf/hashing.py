@@ -0,0 +1,272 @@
+#
+# Hashing of files and of ranges of files on a thread pool, with an optional on-disk cache of the digests.
+# hashlib releases the GIL while hashing large buffers, so the threads do run in parallel.
+#
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Iterable, Mapping, Sequence
+
+logger = logging.getLogger(__name__)
+
+# hashed at most this many bytes at a time, so that huge ranges don't need to be mapped all at once
+HASH_CHUNK_SIZE = 64 * 1024 * 1024
+
+HasherFactory = Callable[[], "hashlib._Hash"]
+
+
+class HashCache:
+    """Digests persisted in a JSON sidecar file.
+
+    Entries are keyed by the absolute path of the hashed file, and are dropped when its size or mtime changes.
+    Within a file, digests are keyed by the hashed range and the hash name.
+    """
+
+    def __init__(self, path: os.PathLike[str] | str | None):
+        self.path = Path(path) if path is not None else None
+        self._lock = threading.Lock()
+        self._entries: dict[str, dict[str, Any]] = {}
+        self._dirty = False
+        if self.path is not None and self.path.is_file():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable hash cache {self.path}: {e}")
+
+    @staticmethod
+    def _file_key(file: Path) -> tuple[str, int, int]:
+        st = file.stat()
+        return str(file.resolve()), st.st_size, st.st_mtime_ns
+
+    def get(self, file: Path, key: str) -> str | None:
+        if self.path is None:
+            return None
+        name, size, mtime = self._file_key(file)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry["size"] != size or entry["mtime_ns"] != mtime:
+                return None
+            return entry["digests"].get(key)
+
+    def put(self, file: Path, key: str, digest: str) -> None:
+        if self.path is None:
+            return
+        name, size, mtime = self._file_key(file)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry["size"] != size or entry["mtime_ns"] != mtime:
+                entry = self._entries[name] = {"size": size, "mtime_ns": mtime, "digests": {}}
+            entry["digests"][key] = digest
+            self._dirty = True
+
+    def save(self) -> None:
+        if self.path is None or not self._dirty:
+            return
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"Could not save the hash cache {self.path}: {e}")
+
+
+def _default_thread_count() -> int:
+    return os.cpu_count() or 1
+
+
+def _update_from_ranges(hasher: hashlib._Hash, buf: mmap.mmap | memoryview, ranges: Iterable[tuple[int, int]]) -> None:
+    view = memoryview(buf)
+    try:
+        for offset, length in ranges:
+            end = offset + length
+            while offset < end:
+                n = min(end - offset, HASH_CHUNK_SIZE)
+                hasher.update(view[offset:offset + n])
+                offset += n
+    finally:
+        view.release()
+
+
+def _open_map(file: Path) -> mmap.mmap | None:
+    with open(file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def hash_ranges(
+    file: os.PathLike[str] | str, ranges: Sequence[tuple[int, int]], hashers: Mapping[str, HasherFactory],
+    thread_count: int | None = None, cache: HashCache | None = None,
+    on_done: Callable[[int], None] | None = None,
+) -> list[dict[str, str]]:
+    """Hex digests of each (offset, length) range of a file, for each of the hashers, computed in parallel.
+
+    on_done is called with the index of each range once its digests are known.
+    """
+    file = Path(file)
+    results: list[dict[str, str]] = [{} for _ in ranges]
+    todo: list[int] = []
+    for i, (offset, length) in enumerate(ranges):
+        for name in hashers:
+            digest = cache.get(file, f"{offset}:{length}:{name}") if cache is not None else None
+            if digest is None:
+                todo.append(i)
+                results[i] = {}
+                break
+            results[i][name] = digest
+        else:
+            if on_done is not None:
+                on_done(i)
+
+    if todo:
+        buf = _open_map(file)
+        try:
+            def work(i: int) -> int:
+                offset, length = ranges[i]
+                for name, factory in hashers.items():
+                    hasher = factory()
+                    if buf is not None:
+                        _update_from_ranges(hasher, buf, [(offset, length)])
+                    results[i][name] = hasher.hexdigest()
+                    if cache is not None:
+                        cache.put(file, f"{offset}:{length}:{name}", results[i][name])
+                return i
+
+            # largest first, for a better balance between the threads
+            todo.sort(key=lambda i: -ranges[i][1])
+            with ThreadPoolExecutor(max_workers=thread_count or _default_thread_count()) as executor:
+                for i in executor.map(work, todo):
+                    if on_done is not None:
+                        on_done(i)
+        finally:
+            if buf is not None:
+                buf.close()
+
+    return results
+
+
+def hash_concatenated_ranges(
+    file: os.PathLike[str] | str, ranges: Sequence[tuple[int, int]], hashers: Mapping[str, HasherFactory],
+    cache: HashCache | None = None, cache_key: str = "ranges",
+) -> dict[str, str]:
+    """Hex digests of the concatenation of ranges of a file, for each of the hashers.
+
+    A single digest can't be split between threads, so the hashers run in parallel with each other instead.
+    """
+    file = Path(file)
+    if cache is not None:
+        cached = {name: cache.get(file, f"{cache_key}:{name}") for name in hashers}
+        if all(digest is not None for digest in cached.values()):
+            return cached  # type: ignore[return-value]
+
+    buf = _open_map(file)
+    try:
+        def work(name: str) -> str:
+            hasher = hashers[name]()
+            if buf is not None:
+                _update_from_ranges(hasher, buf, ranges)
+            return hasher.hexdigest()
+
+        with ThreadPoolExecutor(max_workers=len(hashers) or 1) as executor:
+            digests = dict(zip(hashers, executor.map(work, hashers)))
+    finally:
+        if buf is not None:
+            buf.close()
+
+    if cache is not None:
+        for name, digest in digests.items():
+            cache.put(file, f"{cache_key}:{name}", digest)
+    return digests
+
+
+def hash_ranges_and_concatenation(
+    file: os.PathLike[str] | str, ranges: Sequence[tuple[int, int]],
+    range_hashers: Mapping[str, HasherFactory], concat_hashers: Mapping[str, HasherFactory],
+    thread_count: int | None = None, cache: HashCache | None = None, cache_key: str = "ranges",
+    on_done: Callable[[int], None] | None = None,
+) -> tuple[list[dict[str, str]], dict[str, str]]:
+    """Hex digests of each range like hash_ranges, and of their concatenation like hash_concatenated_ranges,
+    with each range read only once.
+
+    The ranges are read in order, and each chunk is given to all the hashers which still need it in parallel.
+    """
+    file = Path(file)
+    results: list[dict[str, str]] = [{} for _ in ranges]
+    missing: list[list[str]] = []
+    for i, (offset, length) in enumerate(ranges):
+        for name in range_hashers:
+            digest = cache.get(file, f"{offset}:{length}:{name}") if cache is not None else None
+            if digest is not None:
+                results[i][name] = digest
+        missing.append([name for name in range_hashers if name not in results[i]])
+
+    concat_digests: dict[str, str] = {}
+    if cache is not None:
+        for name in concat_hashers:
+            digest = cache.get(file, f"{cache_key}:{name}")
+            if digest is not None:
+                concat_digests[name] = digest
+    concat = {name: factory() for name, factory in concat_hashers.items() if name not in concat_digests}
+
+    if len(concat) == 0 and all(len(names) == 0 for names in missing):
+        if on_done is not None:
+            for i in range(len(ranges)):
+                on_done(i)
+        return results, concat_digests
+
+    buf = _open_map(file)
+    view = memoryview(buf) if buf is not None else None
+    try:
+        with ThreadPoolExecutor(max_workers=thread_count or _default_thread_count()) as executor:
+            for i, (offset, length) in enumerate(ranges):
+                hashers = {name: range_hashers[name]() for name in missing[i]}
+                active = list(hashers.values()) + list(concat.values())
+                end = offset + length
+                while view is not None and len(active) > 0 and offset < end:
+                    chunk = view[offset:min(end, offset + HASH_CHUNK_SIZE)]
+                    # the chunk is read from the file by the first hasher, and is then in the page cache for the others
+                    for _ in executor.map(lambda hasher: hasher.update(chunk), active):
+                        pass
+                    chunk.release()
+                    offset += HASH_CHUNK_SIZE
+                for name, hasher in hashers.items():
+                    results[i][name] = hasher.hexdigest()
+                    if cache is not None:
+                        cache.put(file, f"{ranges[i][0]}:{ranges[i][1]}:{name}", results[i][name])
+                if on_done is not None:
+                    on_done(i)
+    finally:
+        if view is not None:
+            view.release()
+        if buf is not None:
+            buf.close()
+
+    for name, hasher in concat.items():
+        concat_digests[name] = hasher.hexdigest()
+        if cache is not None:
+            cache.put(file, f"{cache_key}:{name}", concat_digests[name])
+    return results, concat_digests
+
+
+def hash_files(
+    files: Sequence[os.PathLike[str] | str], hasher: HasherFactory, name: str,
+    thread_count: int | None = None, cache: HashCache | None = None,
+) -> list[str]:
+    """Hex digest of each whole file, with the files hashed in parallel."""
+    def work(file: os.PathLike[str] | str) -> str:
+        path = Path(file)
+        size = path.stat().st_size
+        return hash_concatenated_ranges(path, [(0, size)], {name: hasher}, cache=cache, cache_key="file")[name]
+
+    with ThreadPoolExecutor(max_workers=thread_count or _default_thread_count()) as executor:
+        return list(executor.map(work, files))
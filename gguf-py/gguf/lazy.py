@@ -2,11 +2,14 @@ from __future__ import annotations
 from abc import ABC, ABCMeta, abstractmethod
 
 import logging
+import threading
 from typing import Any, Callable
 
 import numpy as np
 from numpy.typing import DTypeLike
 
+from . import profiling
+
 
 logger = logging.getLogger(__name__)
 
@@ -75,15 +78,18 @@ class LazyBase(ABC, metaclass=LazyMeta):
     _data: Any | None
     _args: tuple
     _kwargs: dict[str, Any]
-    _func: Callable[[Any], Any] | None
+    _func: Callable[..., Any] | None
+    # held while evaluating, so that a node shared between tensors materialized by different threads is only evaluated once
+    _lock: threading.Lock
 
-    def __init__(self, *, meta: Any, data: Any | None = None, args: tuple = (), kwargs: dict[str, Any] | None = None, func: Callable[[Any], Any] | None = None):
+    def __init__(self, *, meta: Any, data: Any | None = None, args: tuple = (), kwargs: dict[str, Any] | None = None, func: Callable[..., Any] | None = None):
         super().__init__()
         self._meta = meta
         self._data = data
         self._args = args
         self._kwargs = kwargs if kwargs is not None else {}
         self._func = func
+        self._lock = threading.Lock()
         assert self._func is not None or self._data is not None
 
     def __init_subclass__(cls) -> None:
@@ -106,8 +112,20 @@ class LazyBase(ABC, metaclass=LazyMeta):
         else:
             return o
 
+    @staticmethod
+    def _has_lazy(o: Any) -> bool:
+        # also looks into nested lists and tuples, and into pending lazy tensors
+        if isinstance(o, LazyBase):
+            return True
+        elif isinstance(o, (list, tuple)):
+            return any(LazyBase._has_lazy(item) for item in o)
+        elif isinstance(o, LazyPending):
+            return LazyBase._has_lazy(o.tensors)
+        else:
+            return False
+
     @classmethod
-    def _wrap_fn(cls, fn: Callable, *, use_self: LazyBase | None = None, meta_noop: bool | DTypeLike | tuple[DTypeLike, Callable[[tuple[int, ...]], tuple[int, ...]]] = False) -> Callable[[Any], Any]:
+    def _wrap_fn(cls, fn: Callable, *, use_self: LazyBase | None = None, meta_noop: bool | DTypeLike | tuple[DTypeLike, Callable[[tuple[int, ...]], tuple[int, ...]]] = False) -> Callable[..., Any]:
         def wrapped_fn(*args, **kwargs):
             if kwargs is None:
                 kwargs = {}
@@ -165,19 +183,59 @@ class LazyBase(ABC, metaclass=LazyMeta):
 
             # NOTE: there's a recursion limit in Python (usually 1000)
 
-            assert _t._func is not None
-            _t._args = cls._recurse_apply(_t._args, simple_to_eager)
-            _t._data = _t._func(*_t._args, **_t._kwargs)
-            # sanity check
-            assert _t._data is not None
-            assert _t._data.dtype == _t._meta.dtype
-            assert _t._data.shape == _t._meta.shape
-
-            return _t._data
+            # another thread may already be evaluating this node, in which case its result is reused.
+            # The arguments are only locked after their parent, so there can't be a deadlock.
+            with _t._lock:
+                if _t._data is not None:
+                    return _t._data
+
+                assert _t._func is not None
+                profiled = profiling._profiler is not None
+                # leaves read the source data, other nodes compute from their (already evaluated) arguments
+                is_leaf = profiled and not cls._has_lazy(_t._args)
+                _t._args = cls._recurse_apply(_t._args, simple_to_eager)
+                if not profiled:
+                    data = _t._func(*_t._args, **_t._kwargs)
+                else:
+                    func_name = getattr(_t._func, "__qualname__", repr(_t._func))
+                    stage = "lazy_read" if is_leaf else "lazy_quantize" if "quantize" in func_name else "lazy_compute"
+                    with profiling.profile(stage, func_name) as span:
+                        data = _t._func(*_t._args, **_t._kwargs)
+                        span["nbytes"] = int(getattr(data, "nbytes", 0))
+                # sanity check
+                assert data is not None
+                assert data.dtype == _t._meta.dtype
+                assert data.shape == _t._meta.shape
+
+                _t._data = data
+                return data
 
         # recurse into lists and/or tuples, keeping their structure
         return cls._recurse_apply(t, simple_to_eager)
 
+    @classmethod
+    def eager_nbytes(cls, t: Any) -> int:
+        # Upper bound of the memory needed to evaluate t,
+        # assuming no intermediate result is freed before the end.
+        # Already-evaluated nodes are not counted, since their memory is already allocated.
+        total = 0
+        seen: set[int] = set()
+        stack: list[Any] = [t]
+        # NOTE: not recursive, because lazy graphs can be deep
+        while len(stack) > 0:
+            o = stack.pop()
+            if isinstance(o, (list, tuple)):
+                stack.extend(o)
+            elif isinstance(o, LazyPending):
+                stack.extend(o.tensors)
+            elif isinstance(o, LazyBase):
+                if id(o) in seen or o._data is not None:
+                    continue
+                seen.add(id(o))
+                total += int(getattr(o._meta, "nbytes", 0))
+                stack.extend(o._args)
+        return total
+
     @classmethod
     def eager_to_meta(cls, t: Any) -> Any:
         return cls.meta_with_dtype_and_shape(t.dtype, t.shape)
@@ -198,6 +256,14 @@ class LazyBase(ABC, metaclass=LazyMeta):
             return TypeError(f"{type(t)!r} is not compatible with {cls._tensor_type!r}")
 
 
+class LazyPending:
+    """Lazy tensors passed as-is to the function of a lazy node, instead of being evaluated before it is called,
+    so that the function can evaluate them (and free them) one at a time."""
+
+    def __init__(self, tensors: list[Any]):
+        self.tensors = tensors
+
+
 class LazyNumpyTensor(LazyBase):
     _tensor_type = np.ndarray
 
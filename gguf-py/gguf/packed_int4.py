@@ -0,0 +1,111 @@
+#
+# 4-bit weights of AWQ and GPTQ checkpoints (qweight, qzeros and scales), transcoded into Q4_0 or Q4_1 blocks.
+# Each group of input columns has a scale and a zero point, so when the groups are made of whole blocks,
+# the 4-bit values are copied as they are instead of being dequantized and rounded again.
+#
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+
+from .constants import GGML_QUANT_SIZES, GGMLQuantizationType
+from .quants import QuantError
+
+
+# position within each group of 8 of the value in bits 4*i to 4*i+3 of the 32-bit words of AutoAWQ (GEMM)
+AWQ_PACK_ORDER = (0, 2, 4, 6, 1, 3, 5, 7)
+
+
+def unpack_int4(packed: np.ndarray, axis: int = -1, order: Sequence[int] = tuple(range(8))) -> np.ndarray:
+    """
+    The 4-bit values packed 8 per 32-bit word along the given axis, as uint8.
+    order[i] is the position within its group of 8 of the value in bits 4*i to 4*i+3 of each word.
+    """
+    words = np.moveaxis(packed.view(np.uint32), axis, -1)
+    nibbles = ((words[..., None] >> np.arange(0, 32, 4, dtype=np.uint32)) & np.uint32(0xF)).astype(np.uint8)
+    values = np.empty_like(nibbles)
+    values[..., list(order)] = nibbles
+    return np.moveaxis(values.reshape(*values.shape[:-2], -1), -1, axis)
+
+
+@dataclass
+class PackedInt4:
+    """
+    4-bit weights with a scale and a zero point for each group of input columns: w = (q - zeros) * scales
+
+    Example:
+        packed = PackedInt4.from_awq(qweight, qzeros, scales)
+        data = packed.to_q4(GGMLQuantizationType.Q4_1)  # or packed.dequantize()
+    """
+    # (n_out, n_in), from 0 to 15
+    q: np.ndarray
+    # (n_out, n_groups)
+    zeros: np.ndarray
+    scales: np.ndarray
+    # group of each input column, only when they are not consecutive (e.g. GPTQ with desc_act)
+    g_idx: np.ndarray | None = None
+
+    @classmethod
+    def from_awq(cls, qweight: np.ndarray, qzeros: np.ndarray, scales: np.ndarray) -> PackedInt4:
+        """From the tensors of an AutoAWQ GEMM layer: qweight (n_in, n_out / 8), qzeros (n_groups, n_out / 8) and scales (n_groups, n_out)."""
+        q = unpack_int4(qweight, axis=1, order=AWQ_PACK_ORDER)
+        zeros = unpack_int4(qzeros, axis=1, order=AWQ_PACK_ORDER)
+        return cls(np.ascontiguousarray(q.T), np.ascontiguousarray(zeros.T), np.ascontiguousarray(scales.T))
+
+    @classmethod
+    def from_gptq(cls, qweight: np.ndarray, qzeros: np.ndarray, scales: np.ndarray, g_idx: np.ndarray | None = None,
+                  zero_offset: int = 1) -> PackedInt4:
+        """
+        From the tensors of a GPTQ layer: qweight (n_in / 8, n_out), qzeros (n_groups, n_out / 8), scales (n_groups, n_out)
+        and optionally g_idx (n_in).
+        The zero points are stored minus one by AutoGPTQ (checkpoint_format "gptq"), but not in "gptq_v2" (zero_offset=0).
+        """
+        q = unpack_int4(qweight, axis=0)
+        zeros = unpack_int4(qzeros, axis=1).astype(np.int16) + zero_offset
+        n_in, n_groups = q.shape[0], scales.shape[0]
+        if g_idx is not None and n_in % n_groups == 0 and np.array_equal(g_idx, np.arange(n_in) // (n_in // n_groups)):
+            # the usual order, which doesn't need to be kept
+            g_idx = None
+        return cls(np.ascontiguousarray(q.T), np.ascontiguousarray(zeros.T), np.ascontiguousarray(scales.T), g_idx)
+
+    def to_q4(self, qtype: GGMLQuantizationType) -> np.ndarray:
+        """
+        The rows as blocks of qtype, with the same 4-bit values.
+        Q4_0 needs all zero points to be 8, and is then exact.
+        With Q4_1, the minimum of each block (-zero * scale) is rounded to F16.
+        Raises QuantError when the groups can't be split into blocks.
+        """
+        n_out, n_in = self.q.shape
+        n_groups = self.scales.shape[1]
+        block_size, _ = GGML_QUANT_SIZES[qtype]
+        if self.g_idx is not None or n_in % n_groups != 0 or (n_in // n_groups) % block_size != 0:
+            raise QuantError(f"Groups of {n_in // n_groups} columns can't be transcoded into {qtype.name} blocks of {block_size}")
+        blocks_per_group = n_in // n_groups // block_size
+
+        # the low 4 bits of each byte are the first half of the block, the high 4 bits the second half
+        q = self.q.reshape(n_out, -1, 2, block_size // 2)
+        qs = q[..., 0, :] | (q[..., 1, :] << np.uint8(4))
+        d = np.repeat(self.scales.astype(np.float16), blocks_per_group, axis=1)[..., None]
+
+        if qtype == GGMLQuantizationType.Q4_0:
+            if np.any(self.zeros != 8):
+                raise QuantError("Q4_0 needs zero points of 8")
+            blocks = [d.view(np.uint8), qs]
+        elif qtype == GGMLQuantizationType.Q4_1:
+            mins = -self.scales.astype(np.float32) * self.zeros.astype(np.float32)
+            m = np.repeat(mins.astype(np.float16), blocks_per_group, axis=1)[..., None]
+            blocks = [d.view(np.uint8), m.view(np.uint8), qs]
+        else:
+            raise QuantError(f"Can't transcode 4-bit weights into {qtype.name}")
+
+        return np.concatenate(blocks, axis=-1).reshape(n_out, -1)
+
+    def dequantize(self) -> np.ndarray:
+        """The weights as F32, (n_out, n_in)."""
+        n_in = self.q.shape[1]
+        g_idx = self.g_idx if self.g_idx is not None else np.arange(n_in) // (n_in // self.scales.shape[1])
+        scales = self.scales.astype(np.float32)[:, g_idx]
+        zeros = self.zeros.astype(np.float32)[:, g_idx]
+        return (self.q.astype(np.float32) - zeros) * scales
@@ -0,0 +1,147 @@
+#
+# Optional instrumentation of the conversion pipeline.
+# Time spans of each stage, per tensor, with the bytes they read or wrote and the memory usage of the process,
+# exported as a Chrome trace (to open with chrome://tracing or https://ui.perfetto.dev) with a summary per stage.
+# Nothing is recorded unless a Profiler is enabled.
+#
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, ContextManager, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+def current_rss() -> int:
+    """Resident set size of the process in bytes, or 0 when it can't be known."""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def peak_rss() -> int:
+    """Peak resident set size of the process in bytes, or 0 when it can't be known."""
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on macOS, in kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Profiler:
+    """Records time spans of the stages of a conversion, from any thread.
+
+    Each span records its wall time, the number of bytes it read or produced (when given),
+    and the resident memory of the process when it ended.
+    Spans of different stages can be nested, e.g. the evaluation of lazy tensors within their materialization.
+
+    Example:
+        profiler = profiling.enable()
+        with profiling.profile("quantize", name, nbytes=data.nbytes):
+            data = quantize(data, qtype)
+        profiling.disable()
+        profiler.write_chrome_trace("convert.trace.json")
+    """
+
+    def __init__(self):
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._events: list[dict[str, Any]] = []
+        self._thread_names: dict[int, str] = {}
+
+    @contextlib.contextmanager
+    def span(self, stage: str, name: str | None = None, **args: Any) -> Iterator[dict[str, Any]]:
+        # the arguments can still be changed through the yielded dict, e.g. to set nbytes once it is known
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            args["rss"] = current_rss()
+            tid = threading.get_ident()
+            event = {
+                "name": name if name is not None else stage, "cat": stage, "ph": "X",
+                "ts": (start - self._t0) * 1e6, "dur": (end - start) * 1e6,
+                "pid": os.getpid(), "tid": tid, "args": args,
+            }
+            with self._lock:
+                self._events.append(event)
+                if tid not in self._thread_names:
+                    self._thread_names[tid] = threading.current_thread().name
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        """Number of spans, total time, total bytes and highest memory usage of each stage."""
+        stages: dict[str, dict[str, Any]] = {}
+        with self._lock:
+            events = list(self._events)
+        for event in events:
+            stage = stages.setdefault(event["cat"], {"count": 0, "seconds": 0.0, "nbytes": 0, "max_rss": 0})
+            stage["count"] += 1
+            stage["seconds"] += event["dur"] / 1e6
+            stage["nbytes"] += int(event["args"].get("nbytes", 0))
+            stage["max_rss"] = max(stage["max_rss"], event["args"]["rss"])
+        return stages
+
+    def chrome_trace(self) -> dict[str, Any]:
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        pid = os.getpid()
+        trace: list[dict[str, Any]] = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in thread_names.items()
+        ]
+        trace.extend(events)
+        # memory usage over time, as a counter track
+        trace.extend(
+            {"name": "rss", "ph": "C", "ts": e["ts"] + e["dur"], "pid": pid, "args": {"bytes": e["args"]["rss"]}}
+            for e in sorted(events, key=lambda e: e["ts"] + e["dur"])
+        )
+        return {
+            "traceEvents": trace,
+            "displayTimeUnit": "ms",
+            "otherData": {"summary": self.summary(), "peak_rss": peak_rss()},
+        }
+
+    def write_chrome_trace(self, path: os.PathLike[str] | str) -> None:
+        with open(Path(path), "w", encoding="utf-8") as f:
+            json.dump(self.chrome_trace(), f)
+
+    def log_summary(self) -> None:
+        for stage, s in sorted(self.summary().items(), key=lambda item: -item[1]["seconds"]):
+            logger.info(f"{stage:<16} {s['count']:>6} spans {s['seconds']:>10.3f} s {s['nbytes'] / 1e6:>12.1f} MB, max RSS {s['max_rss'] / 1e6:.1f} MB")
+        logger.info(f"peak RSS: {peak_rss() / 1e6:.1f} MB")
+
+
+_profiler: Profiler | None = None
+
+
+def enable() -> Profiler:
+    """Start recording the spans of all threads into a new Profiler."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable() -> None:
+    global _profiler
+    _profiler = None
+
+
+def profile(stage: str, name: str | None = None, **args: Any) -> ContextManager[dict[str, Any]]:
+    """Span of the given stage in the enabled Profiler, if any."""
+    if _profiler is None:
+        return contextlib.nullcontext(args)
+    return _profiler.span(stage, name, **args)
@@ -0,0 +1,375 @@
+#
+# Per-tensor quantization types for mixed-precision conversions,
+# an estimate of the size of the result before converting anything,
+# and the choice of the types of each tensor from their quantization error under a size budget.
+#
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Mapping, Sequence
+
+import numpy as np
+
+from .constants import GGML_QUANT_SIZES, GGUF_DEFAULT_ALIGNMENT, GGMLQuantizationType, MODEL_TENSOR, TENSOR_NAMES
+from .quants import dequantize, quantize
+
+logger = logging.getLogger(__name__)
+
+
+def parse_qtype(name: str) -> GGMLQuantizationType:
+    """Quantization type from its name, case-insensitive (e.g. "q4_0", "Q4_K", "f16")."""
+    try:
+        return GGMLQuantizationType[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown quantization type {name!r}")
+
+
+def tensor_block_id(name: str) -> int | None:
+    """The first number-like part of the tensor name (e.g. 3 for blk.3.attn_q.weight), like convert_hf_to_gguf.py"""
+    for part in name.split("."):
+        if part.isdecimal():
+            return int(part)
+    return None
+
+
+def _parse_layers(spec: str | int | Sequence[int | str]) -> frozenset[int]:
+    # "0-3,10" or 5 or [0, 1, "28-31"]
+    if isinstance(spec, int):
+        return frozenset((spec,))
+    parts = spec.split(",") if isinstance(spec, str) else spec
+    layers: set[int] = set()
+    for part in parts:
+        if isinstance(part, int):
+            layers.add(part)
+            continue
+        first, sep, last = part.strip().partition("-")
+        try:
+            layers.update(range(int(first), int(last if sep else first) + 1))
+        except ValueError:
+            raise ValueError(f"Invalid layer range {part!r}")
+    return frozenset(layers)
+
+
+def _format_layers(layers: frozenset[int]) -> str:
+    ranges: list[str] = []
+    for layer in sorted(layers):
+        if ranges and ranges[-1].rpartition("-")[2] == str(layer - 1):
+            ranges[-1] = f"{ranges[-1].partition('-')[0]}-{layer}"
+        else:
+            ranges.append(str(layer))
+    return ",".join(ranges)
+
+
+def _parse_tensors(spec: str | Sequence[str]) -> tuple[MODEL_TENSOR, ...]:
+    # either names of MODEL_TENSOR (e.g. "ATTN_Q") or the base names of the GGUF tensors (e.g. "attn_q")
+    names = [spec] if isinstance(spec, str) else list(spec)
+    tensors: list[MODEL_TENSOR] = []
+    for name in names:
+        if name.upper() in MODEL_TENSOR.__members__:
+            tensors.append(MODEL_TENSOR[name.upper()])
+            continue
+        found = [t for t, tensor_name in TENSOR_NAMES.items() if tensor_name.rpartition(".")[2] == name]
+        if len(found) == 0:
+            raise ValueError(f"Unknown tensor {name!r}")
+        tensors.extend(found)
+    return tuple(tensors)
+
+
+def _can_quantize(qtype: GGMLQuantizationType) -> bool:
+    try:
+        quantize(np.zeros(GGML_QUANT_SIZES[qtype][0], dtype=np.float32), qtype)
+    except NotImplementedError:
+        return False
+    return True
+
+
+@dataclass
+class QuantRecipeRule:
+    # the type of the matching tensors, then the types to use instead when their rows don't fit its blocks
+    qtypes: tuple[GGMLQuantizationType, ...]
+    # regular expression searched in the GGUF tensor name, like llama-quantize --tensor-type
+    pattern: re.Pattern[str] | None = None
+    tensors: tuple[MODEL_TENSOR, ...] = ()
+    layers: frozenset[int] | None = None
+    # number of tensors this rule was used for
+    n_matched: int = field(default=0, compare=False)
+
+    def matches(self, name: str, bid: int | None) -> bool:
+        if self.layers is not None and (bid is None or bid not in self.layers):
+            return False
+        if len(self.tensors) > 0 and not any(
+            name == TENSOR_NAMES[t].format(bid=bid) + ".weight"
+            for t in self.tensors
+            if bid is not None or "{bid}" not in TENSOR_NAMES[t]
+        ):
+            return False
+        if self.pattern is not None and self.pattern.search(name) is None:
+            return False
+        return True
+
+    @classmethod
+    def from_dict(cls, rule: Mapping[str, Any]) -> QuantRecipeRule:
+        unknown = set(rule.keys()) - {"pattern", "tensor", "layers", "type", "fallback"}
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in recipe rule {dict(rule)}")
+        if "type" not in rule:
+            raise ValueError(f"Missing type in recipe rule {dict(rule)}")
+        fallback = rule.get("fallback", [])
+        qtypes = tuple(parse_qtype(t) for t in [rule["type"], *([fallback] if isinstance(fallback, str) else fallback)])
+        for qtype in qtypes:
+            if not _can_quantize(qtype):
+                raise ValueError(f"Quantization to {qtype.name} is not implemented in gguf-py")
+        return cls(
+            qtypes=qtypes,
+            pattern=re.compile(rule["pattern"]) if "pattern" in rule else None,
+            tensors=_parse_tensors(rule["tensor"]) if "tensor" in rule else (),
+            layers=_parse_layers(rule["layers"]) if "layers" in rule else None,
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        rule: dict[str, Any] = {}
+        if self.pattern is not None:
+            rule["pattern"] = self.pattern.pattern
+        if len(self.tensors) > 0:
+            rule["tensor"] = [t.name for t in self.tensors]
+        if self.layers is not None:
+            rule["layers"] = _format_layers(self.layers)
+        rule["type"] = self.qtypes[0].name.lower()
+        if len(self.qtypes) > 1:
+            rule["fallback"] = [t.name.lower() for t in self.qtypes[1:]]
+        return rule
+
+
+class QuantRecipe:
+    """
+    Quantization type of each tensor, chosen by the first matching rule.
+
+    The rules are stored as JSON, for example:
+        {
+            "rules": [
+                {"tensor": ["attn_q", "attn_k", "attn_v", "attn_output"], "type": "q8_0"},
+                {"tensor": "output", "type": "f16"},
+                {"pattern": "ffn_(gate|up|down)", "layers": "0-1", "type": "q8_0"},
+                {"pattern": "ffn_", "type": "q4_0", "fallback": ["q5_0", "q8_0"]}
+            ]
+        }
+
+    A rule matches the tensors which satisfy all of its conditions:
+    "pattern" is a regular expression searched in the GGUF tensor name (like llama-quantize --tensor-type),
+    "tensor" is one or more MODEL_TENSOR names or GGUF base names (e.g. "ATTN_Q" or "attn_q"),
+    and "layers" is a list of blocks (e.g. "0-3,28-31" or [0, 1, 2]).
+    When the rows of a tensor are not a multiple of the block size of "type",
+    the first "fallback" type which fits is used instead.
+    """
+
+    def __init__(self, rules: Iterable[QuantRecipeRule] = ()):
+        self.rules = list(rules)
+
+    @classmethod
+    def from_dict(cls, recipe: Mapping[str, Any]) -> QuantRecipe:
+        return cls(QuantRecipeRule.from_dict(rule) for rule in recipe.get("rules", []))
+
+    @classmethod
+    def load(cls, path: os.PathLike[str] | str) -> QuantRecipe:
+        with open(Path(path), "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"rules": [rule.to_dict() for rule in self.rules]}
+
+    def save(self, path: os.PathLike[str] | str) -> None:
+        with open(Path(path), "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
+
+    def qtype_for(self, name: str, shape: Sequence[int]) -> GGMLQuantizationType | None:
+        """Type of the tensor with the given GGUF name and (NumPy) shape, or None when no rule matches it."""
+        bid = tensor_block_id(name)
+        for rule in self.rules:
+            if rule.matches(name, bid):
+                rule.n_matched += 1
+                for qtype in rule.qtypes:
+                    if shape[-1] % GGML_QUANT_SIZES[qtype][0] == 0:
+                        return qtype
+                # none of them fits, the caller has to fall back to something else
+                return rule.qtypes[0]
+        return None
+
+    def unused_rules(self) -> list[QuantRecipeRule]:
+        return [rule for rule in self.rules if rule.n_matched == 0]
+
+
+def tensor_bytes_per_token(name: str, shape: Sequence[int], nbytes: int, expert_ratio: float = 1.0, tied_embeddings: bool = False) -> float:
+    """
+    Bytes of the tensor read to generate one token.
+    Decoding is limited by memory bandwidth, so this is what the throughput depends on.
+    """
+    if name == "token_embd.weight" and not tied_embeddings:
+        # only the row of the token is read
+        return nbytes / shape[0] if len(shape) > 0 and shape[0] > 0 else 0.0
+    if "_exps." in name:
+        # only the used experts are read
+        return nbytes * expert_ratio
+    return float(nbytes)
+
+
+# the tensors llama-quantize keeps as they are, whatever the requested type (see src/llama-quant.cpp)
+_UNQUANTIZED_TENSOR_PARTS = ("_norm", "ffn_gate_inp", "position_embd", "token_types", "ssm_conv1d", "time_mix_", "attn_rel_b")
+
+
+def is_quantizable(name: str, shape: Sequence[int]) -> bool:
+    """Whether llama-quantize would quantize the tensor with the given GGUF name and (NumPy) shape."""
+    return name.endswith(".weight") and len(shape) >= 2 and not any(part in name for part in _UNQUANTIZED_TENSOR_PARTS)
+
+
+@dataclass
+class QuantErrorStats:
+    qtype: GGMLQuantizationType
+    # sum of the weights of the values (their number without an imatrix)
+    sum_w: float
+    # weighted sum of the squared errors
+    sum_err2: float
+    # weighted sum of the squared values
+    sum_x2: float
+
+    @property
+    def rmse(self) -> float:
+        return math.sqrt(self.sum_err2 / self.sum_w) if self.sum_w > 0 else 0.0
+
+    @property
+    def relative_error(self) -> float:
+        """Weighted squared error relative to the weighted squared values, i.e. 1 / SNR"""
+        return self.sum_err2 / self.sum_x2 if self.sum_x2 > 0 else 0.0
+
+    @property
+    def snr_db(self) -> float:
+        return 10 * math.log10(self.sum_x2 / self.sum_err2) if self.sum_err2 > 0 else math.inf
+
+
+def measure_quant_error(data: np.ndarray, qtype: GGMLQuantizationType, imatrix: np.ndarray | None = None) -> QuantErrorStats:
+    """
+    Error of the round-trip of data through qtype.
+
+    imatrix is the importance of each column, with one row per matrix of data like for quantize,
+    and weighs both the squared errors and the squared values.
+    """
+    data = data.astype(np.float32, copy=False)
+    restored = dequantize(quantize(data, qtype, imatrix=imatrix), qtype).reshape(data.shape)
+    err2 = np.square(data - restored, dtype=np.float64)
+    x2 = np.square(data, dtype=np.float64)
+    if imatrix is None:
+        return QuantErrorStats(qtype, float(data.size), float(err2.sum()), float(x2.sum()))
+    # (n_matrices, rows, n_per_row) to apply the weights of each matrix
+    w = imatrix.astype(np.float64).reshape(imatrix.shape[0], 1, data.shape[-1])
+    err2 = err2.reshape(imatrix.shape[0], -1, data.shape[-1])
+    x2 = x2.reshape(err2.shape)
+    return QuantErrorStats(qtype, float((w * err2.shape[1]).sum()), float((w * err2).sum()), float((w * x2).sum()))
+
+
+def allocate_qtypes(options: Sequence[Sequence[tuple[float, float]]], budget: float) -> list[int]:
+    """
+    Choose one of the (cost, error) options of each tensor, to minimize the total error with the total cost within budget.
+
+    This multiple-choice knapsack is solved greedily: each tensor starts at its cheapest option,
+    then the upgrades with the highest error reduction per added cost are taken while they fit.
+    Only the options on the lower convex hull of each tensor are considered, so that the upgrades of a tensor
+    come by decreasing efficiency. What is left of the budget then goes to the upgrades which still fit.
+
+    Returns the index of the chosen option of each tensor.
+    Raises ValueError when even the cheapest options don't fit in the budget.
+    """
+    hulls: list[list[int]] = []
+    for opts in options:
+        if len(opts) == 0:
+            raise ValueError("Each tensor needs at least one option")
+        hull: list[int] = []
+        for i in sorted(range(len(opts)), key=lambda i: opts[i]):
+            cost, error = opts[i]
+            if len(hull) > 0 and error >= opts[hull[-1]][1]:
+                # dominated, as expensive as the last one or more and no better
+                continue
+            # keep the gains per cost decreasing
+            while len(hull) >= 2 and _gain(opts[hull[-2]], opts[hull[-1]]) <= _gain(opts[hull[-1]], opts[i]):
+                hull.pop()
+            hull.append(i)
+        hulls.append(hull)
+
+    total = sum(opts[hull[0]][0] for opts, hull in zip(options, hulls))
+    if total > budget:
+        raise ValueError(f"The budget of {budget:g} is too small, the cheapest options already cost {total:g}")
+
+    choice = [0] * len(hulls)
+    heap = [(-_gain(options[t][hull[0]], options[t][hull[1]]), t) for t, hull in enumerate(hulls) if len(hull) > 1]
+    heapq.heapify(heap)
+    while len(heap) > 0:
+        _, t = heapq.heappop(heap)
+        opts, hull = options[t], hulls[t]
+        current, upgrade = opts[hull[choice[t]]], opts[hull[choice[t] + 1]]
+        if total + upgrade[0] - current[0] > budget:
+            # the next upgrades of this tensor are even more expensive, but those of the others may still fit
+            continue
+        total += upgrade[0] - current[0]
+        choice[t] += 1
+        if choice[t] + 1 < len(hull):
+            heapq.heappush(heap, (-_gain(upgrade, opts[hull[choice[t] + 1]]), t))
+    chosen = [hull[c] for hull, c in zip(hulls, choice)]
+
+    # spend what is left of the budget on the best upgrades which still fit, including those off the hulls
+    while True:
+        best: tuple[float, int, int] | None = None
+        for t, opts in enumerate(options):
+            current = opts[chosen[t]]
+            for i, (cost, error) in enumerate(opts):
+                if error < current[1] and total + cost - current[0] <= budget and (best is None or current[1] - error > best[0]):
+                    best = (current[1] - error, t, i)
+        if best is None:
+            return chosen
+        _, t, i = best
+        total += options[t][i][0] - options[t][chosen[t]][0]
+        chosen[t] = i
+
+
+def _gain(a: tuple[float, float], b: tuple[float, float]) -> float:
+    # error reduction per added cost from option a to option b
+    return (a[1] - b[1]) / (b[0] - a[0]) if b[0] > a[0] else math.inf
+
+
+@dataclass
+class SizeEstimate:
+    n_tensors: int
+    # tensor data, with the alignment padding of each tensor
+    total_bytes: int
+    # bytes of the tensors of each block, and of the other tensors at None
+    layer_bytes: dict[int | None, int]
+    bytes_per_token: float
+
+    @classmethod
+    def from_tensors(cls, tensors: Iterable[tuple[str, Sequence[int], int]], expert_count: int = 0, expert_used_count: int = 0,
+                     alignment: int = GGUF_DEFAULT_ALIGNMENT) -> SizeEstimate:
+        """From the name, (NumPy) shape and size in bytes of each tensor."""
+        tensors = list(tensors)
+        names = set(name for name, _, _ in tensors)
+        tied_embeddings = "output.weight" not in names
+        expert_ratio = expert_used_count / expert_count if expert_count > 0 and expert_used_count > 0 else 1.0
+        total_bytes = 0
+        layer_bytes: dict[int | None, int] = {}
+        bytes_per_token = 0.0
+        for name, shape, nbytes in tensors:
+            total_bytes += nbytes + (-nbytes % alignment)
+            bid = tensor_block_id(name)
+            layer_bytes[bid] = layer_bytes.get(bid, 0) + nbytes
+            bytes_per_token += tensor_bytes_per_token(name, shape, nbytes, expert_ratio, tied_embeddings)
+        return cls(n_tensors=len(tensors), total_bytes=total_bytes, layer_bytes=layer_bytes, bytes_per_token=bytes_per_token)
+
+    def log_summary(self) -> None:
+        for bid, nbytes in sorted(self.layer_bytes.items(), key=lambda item: -1 if item[0] is None else item[0]):
+            logger.info(f"{'other' if bid is None else f'blk.{bid}':<10} {nbytes / 1e6:>12.2f} MB")
+        logger.info(f"Estimated size: {self.total_bytes / 1e6:.2f} MB of tensor data in {self.n_tensors} tensors, "
+                    f"{self.bytes_per_token / 1e6:.2f} MB read per generated token")
@@ -1,8 +1,14 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
 from typing import Any, Callable, Sequence
 from math import log2, ceil
 
+import os
+import threading
+
 from numpy.typing import DTypeLike
 
 from .constants import GGML_QUANT_SIZES, GGMLQuantizationType, QK_K
@@ -25,16 +31,151 @@ def quant_shape_from_byte_shape(shape: Sequence[int], quant_type: GGMLQuantizati
     return (*shape[:-1], shape[-1] // type_size * block_size)
 
 
-# This is faster than np.vectorize and np.apply_along_axis because it works on more than one row at a time
+# Multi-byte fields of the blocks of each type, as (offset, item size, count),
+# which need to be byte-swapped when changing the byte order of the tensor data.
+# Also includes the byte arrays which ggml reads as wider integers (e.g. qh of Q5_0 as an uint32).
+_BYTESWAP_FIELDS: dict[GGMLQuantizationType, tuple[tuple[int, int, int], ...]] = {
+    GGMLQuantizationType.F32:     ((0, 4, 1),),
+    GGMLQuantizationType.F16:     ((0, 2, 1),),
+    GGMLQuantizationType.Q4_0:    ((0, 2, 1),),
+    GGMLQuantizationType.Q4_1:    ((0, 2, 2),),
+    GGMLQuantizationType.Q5_0:    ((0, 2, 1), (2, 4, 1)),
+    GGMLQuantizationType.Q5_1:    ((0, 2, 2), (4, 4, 1)),
+    GGMLQuantizationType.Q8_0:    ((0, 2, 1),),
+    GGMLQuantizationType.Q8_1:    ((0, 4, 2),),
+    GGMLQuantizationType.Q2_K:    ((QK_K // 16 + QK_K // 4, 2, 2),),
+    GGMLQuantizationType.Q3_K:    ((QK_K // 8 + QK_K // 4 + 12, 2, 1),),
+    GGMLQuantizationType.Q4_K:    ((0, 2, 2),),
+    GGMLQuantizationType.Q5_K:    ((0, 2, 2),),
+    GGMLQuantizationType.Q6_K:    ((QK_K // 2 + QK_K // 4 + QK_K // 16, 2, 1),),
+    GGMLQuantizationType.Q8_K:    ((0, 4, 1), (4 + QK_K, 2, QK_K // 16)),
+    GGMLQuantizationType.IQ2_XXS: ((0, 2, 1), (2, 2, QK_K // 8)),
+    GGMLQuantizationType.IQ2_XS:  ((0, 2, 1), (2, 2, QK_K // 8)),
+    GGMLQuantizationType.IQ3_XXS: ((0, 2, 1), (2 + QK_K // 4, 4, QK_K // 32)),
+    GGMLQuantizationType.IQ1_S:   ((0, 2, 1), (2 + QK_K // 8, 2, QK_K // 32)),
+    GGMLQuantizationType.IQ4_NL:  ((0, 2, 1),),
+    GGMLQuantizationType.IQ3_S:   ((0, 2, 1),),
+    GGMLQuantizationType.IQ2_S:   ((0, 2, 1),),
+    GGMLQuantizationType.IQ4_XS:  ((0, 2, 2),),
+    GGMLQuantizationType.I8:      (),
+    GGMLQuantizationType.I16:     ((0, 2, 1),),
+    GGMLQuantizationType.I32:     ((0, 4, 1),),
+    GGMLQuantizationType.I64:     ((0, 8, 1),),
+    GGMLQuantizationType.F64:     ((0, 8, 1),),
+    GGMLQuantizationType.IQ1_M:   ((QK_K // 8 + QK_K // 16, 2, QK_K // 64),),
+    GGMLQuantizationType.BF16:    ((0, 2, 1),),
+    GGMLQuantizationType.TQ1_0:   ((4 * 13, 2, 1),),
+    GGMLQuantizationType.TQ2_0:   ((64, 2, 1),),
+}
+
+
+def can_byteswap(qtype: GGMLQuantizationType) -> bool:
+    # whether byteswap_tensor_data knows the layout of the blocks of qtype
+    return qtype in _BYTESWAP_FIELDS
+
+
+def byteswap_tensor_data(data: np.ndarray, qtype: GGMLQuantizationType) -> None:
+    # Change the byte order of the tensor data in place, with one strided operation per field of the blocks
+    fields = _BYTESWAP_FIELDS.get(qtype)
+    if fields is None:
+        raise NotImplementedError(f"Byte-swapping of {qtype.name} is not implemented")
+    if not data.flags.c_contiguous:
+        raise ValueError("Tensor data must be contiguous to be byte-swapped in place")
+    type_size = GGML_QUANT_SIZES[qtype][1]
+    raw = data.reshape(-1).view(np.uint8)
+    if raw.size % type_size != 0:
+        raise ValueError(f"Tensor data size ({raw.size}) is not a multiple of {qtype.name} type size ({type_size})")
+    blocks = raw.reshape(-1, type_size)
+    for offset, item_size, count in fields:
+        field = blocks[:, offset:offset + item_size * count].view(f"u{item_size}")
+        field.byteswap(inplace=True)
+
+
+def _get_cache_size(level: int = 2, fallback: int = 1 << 20) -> int:
+    # per-core cache size in bytes, from sysfs when available
+    cache_dir = Path("/sys/devices/system/cpu/cpu0/cache")
+    try:
+        for index in cache_dir.glob("index*"):
+            if int((index / "level").read_text()) != level or (index / "type").read_text().strip() == "Instruction":
+                continue
+            size = (index / "size").read_text().strip().upper()
+            multiplier = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}.get(size[-1:], 1)
+            return int(size.rstrip("KMG")) * multiplier
+    except (OSError, ValueError):
+        pass
+    return fallback
+
+
+def _get_cpu_count() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+_thread_count = _get_cpu_count()
+# the temporaries made while (de)quantizing a chunk are a few times bigger than its input
+_chunk_nbytes = _get_cache_size() // 4
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def set_thread_count(n_threads: int) -> None:
+    """Set the number of threads used to (de)quantize large arrays. 0 means all available cores."""
+    global _thread_count, _executor
+    with _executor_lock:
+        _thread_count = n_threads if n_threads > 0 else _get_cpu_count()
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def get_thread_count() -> int:
+    """The number of threads used to (de)quantize large arrays."""
+    return _thread_count
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_thread_count, thread_name_prefix="gguf-quants")
+        return _executor
+
+
+# This is faster than np.vectorize and np.apply_along_axis because it works on more than one row at a time.
+# The rows are split in chunks which fit in the cache, and when there are enough of them,
+# the chunks are processed in parallel (NumPy releases the GIL in most of its kernels).
 def _apply_over_grouped_rows(func: Callable[[np.ndarray], np.ndarray], arr: np.ndarray, otype: DTypeLike, oshape: tuple[int, ...]) -> np.ndarray:
     rows = arr.reshape((-1, arr.shape[-1]))
     osize = 1
     for dim in oshape:
         osize *= dim
     out = np.empty(shape=osize, dtype=otype)
-    # compute over groups of 16 rows (arbitrary, but seems good for performance)
-    n_groups = (rows.shape[0] // 16) or 1
-    np.concatenate([func(group).ravel() for group in np.array_split(rows, n_groups)], axis=0, out=out)
+    n_rows = rows.shape[0]
+    if n_rows == 0 or osize == 0:
+        return out.reshape(oshape)
+    out_rows = out.reshape((n_rows, -1))
+
+    # rows per chunk, so that the input of each chunk fits in the cache of a core,
+    # but without leaving cores idle when there are few rows
+    chunk_rows = max(1, _chunk_nbytes // max(1, rows[0].nbytes))
+    if _thread_count > 1:
+        chunk_rows = min(chunk_rows, -(-n_rows // _thread_count))
+    n_chunks = -(-n_rows // chunk_rows)
+
+    def process_chunk(i: int) -> None:
+        start = i * chunk_rows
+        end = min(start + chunk_rows, n_rows)
+        out_rows[start:end] = func(rows[start:end]).reshape((end - start, -1))
+
+    if n_chunks == 1 or _thread_count <= 1:
+        for i in range(n_chunks):
+            process_chunk(i)
+    else:
+        # propagate exceptions from the workers
+        for f in [_get_executor().submit(process_chunk, i) for i in range(n_chunks)]:
+            f.result()
+
     return out.reshape(oshape)
 
 
@@ -47,19 +188,259 @@ def np_roundf(n: np.ndarray) -> np.ndarray:
     return np.sign(n) * b
 
 
+# The following helpers are ports of the reference implementations in ggml-quants.c.
+# To get bit-exact results, all the arithmetic is done in float32 in the same order as in C,
+# and vectorized over groups of values instead of over the values of a group.
+
+# sum over the last axis in sequential order, like a C loop (np.sum uses pairwise summation)
+def _seq_sum(a: np.ndarray) -> np.ndarray:
+    return np.cumsum(a, axis=-1, dtype=np.float32)[..., -1:]
+
+
+# same as nearest_int in ggml-quants.c (round half to even), but kept as float32
+def _nearest_int(a: np.ndarray) -> np.ndarray:
+    return np.rint(a).astype(np.float32, copy=False)
+
+
+# index of the nearest value (rounding ties up) in the sorted values, like best_index_int8 in ggml-quants.c
+def _best_index(values: np.ndarray, x: np.ndarray) -> np.ndarray:
+    mu = np.searchsorted(values, x, side="right").clip(1, len(values) - 1)
+    return np.where(x - values[mu - 1] < values[mu] - x, mu - 1, mu)
+
+
+# same as make_qx_quants in ggml-quants.c with rmse_type == 1, with or without importance weights
+def _make_qx_quants(x: np.ndarray, nmax: int, weights: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    ax = abs(x)
+    imax = ax.argmax(axis=-1, keepdims=True)
+    max = np.take_along_axis(x, imax, axis=-1)
+    all_zero = np.take_along_axis(ax, imax, axis=-1) < np.float32(1e-15)
+    w = x * x if weights is None else weights
+    wx = w * x
+
+    def quants(iscale: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        L = _nearest_int(iscale * x).clip(-nmax, nmax - 1)
+        return L, _seq_sum(wx * L), _seq_sum(w * L * L)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        L, sumlx, suml2 = quants(np.float32(-nmax) / max)
+        scale = np.where(suml2 != 0, sumlx / suml2, np.float32(0))
+        best = scale * sumlx
+        for i in range(-9, 10):
+            if i == 0:
+                continue
+            iscale = -(np.float32(nmax) + np.float32(0.1) * np.float32(i)) / max
+            this_L, sumlx, suml2 = quants(iscale)
+            better = (suml2 > 0) & (sumlx * sumlx > best * suml2)
+            L = np.where(better, this_L, L)
+            scale = np.where(better, sumlx / suml2, scale)
+            best = np.where(better, scale * sumlx, best)
+
+    L = np.where(all_zero, np.float32(0), L + np.float32(nmax))
+    scale = np.where(all_zero, np.float32(0), scale)
+    return scale, L
+
+
+# same as make_q3_quants in ggml-quants.c with do_rmse
+def _make_q3_quants(x: np.ndarray, nmax: int) -> tuple[np.ndarray, np.ndarray]:
+    ax = abs(x)
+    imax = ax.argmax(axis=-1, keepdims=True)
+    max = np.take_along_axis(x, imax, axis=-1)
+    all_zero = np.take_along_axis(ax, imax, axis=-1) < np.float32(1e-15)
+    w = x * x
+    wx = w * x
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        L = _nearest_int((np.float32(-nmax) / max) * x).clip(-nmax, nmax - 1)
+        sumlx = _seq_sum(wx * L)
+        suml2 = _seq_sum(w * L * L)
+        # each group stops iterating once none of its values change
+        active = np.ones_like(all_zero)
+        for _ in range(5):
+            changed = np.zeros_like(all_zero)
+            for i in range(x.shape[-1]):
+                xi, wi, wxi, Li = x[..., i:i + 1], w[..., i:i + 1], wx[..., i:i + 1], L[..., i:i + 1]
+                slx = sumlx - wxi * Li
+                sl2 = suml2 - wi * Li * Li
+                better = active & (slx > 0)
+                new_l = _nearest_int(xi * sl2 / slx).clip(-nmax, nmax - 1)
+                better &= new_l != Li
+                slx = slx + wxi * new_l
+                sl2 = sl2 + wi * new_l * new_l
+                better &= (sl2 > 0) & (slx * slx * suml2 > sumlx * sumlx * sl2)
+                L[..., i:i + 1] = np.where(better, new_l, Li)
+                sumlx = np.where(better, slx, sumlx)
+                suml2 = np.where(better, sl2, suml2)
+                changed |= better
+            active &= changed
+            if not active.any():
+                break
+        scale = sumlx / suml2
+
+    L = np.where(all_zero, np.float32(0), L + np.float32(nmax))
+    scale = np.where(all_zero, np.float32(0), scale)
+    return scale, L
+
+
+# same as make_qkx2_quants in ggml-quants.c, returns (scale, L, the_min)
+def _make_qkx2_quants(x: np.ndarray, weights: np.ndarray, nmax: int, rmin: float, rdelta: float, nstep: int, use_mad: bool) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    min = np.minimum(x.min(axis=-1, keepdims=True), np.float32(0))
+    max = x.max(axis=-1, keepdims=True)
+    sum_w = _seq_sum(weights)
+    sum_x = _seq_sum(weights * x)
+    degenerate = max == min
+
+    def error(scale: np.ndarray, L: np.ndarray, min: np.ndarray) -> np.ndarray:
+        diff = scale * L + min - x
+        diff = abs(diff) if use_mad else diff * diff
+        return _seq_sum(weights * diff)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        iscale = np.float32(nmax) / (max - min)
+        scale = np.float32(1) / iscale
+        L = _nearest_int(iscale * (x - min)).clip(0, nmax)
+        best_mad = error(scale, L, min)
+        for i in range(nstep + 1 if nstep >= 1 else 0):
+            # NOTE: min is updated when a better scale is found, like in the reference implementation
+            iscale = (np.float32(rmin) + np.float32(rdelta) * np.float32(i) + np.float32(nmax)) / (max - min)
+            Laux = _nearest_int(iscale * (x - min)).clip(0, nmax)
+            wl = weights * Laux
+            sum_l = _seq_sum(wl)
+            sum_l2 = _seq_sum(wl * Laux)
+            sum_xl = _seq_sum(wl * x)
+            D = sum_w * sum_l2 - sum_l * sum_l
+            this_scale = (sum_w * sum_xl - sum_x * sum_l) / D
+            this_min = (sum_l2 * sum_x - sum_l * sum_xl) / D
+            positive_min = this_min > 0
+            this_min = np.where(positive_min, np.float32(0), this_min)
+            this_scale = np.where(positive_min, sum_xl / sum_l2, this_scale)
+            mad = error(this_scale, Laux, this_min)
+            better = (D > 0) & (mad < best_mad)
+            L = np.where(better, Laux, L)
+            best_mad = np.where(better, mad, best_mad)
+            scale = np.where(better, this_scale, scale)
+            min = np.where(better, this_min, min)
+
+    L = np.where(degenerate, np.float32(0), L)
+    scale = np.where(degenerate, np.float32(0), scale)
+    return scale, L, -min
+
+
+# same as make_qp_quants in ggml-quants.c, for the non-negative scales and mins of the sub-blocks of k-quants
+def _make_qp_quants(x: np.ndarray, nmax: int, weights: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    max = np.maximum(x.max(axis=-1, keepdims=True), np.float32(0))
+    all_zero = max == 0
+    wx = weights * x
+
+    def mse(iscale: np.ndarray) -> np.ndarray:
+        L = np.minimum(_nearest_int(iscale * x), np.float32(nmax))
+        diff = x - (np.float32(1) / iscale) * L
+        return _seq_sum(weights * diff * diff)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        iscale = np.float32(nmax) / max
+        best_mse = mse(iscale)
+        for i in range(-4, 5):
+            if i == 0:
+                continue
+            this_iscale = (np.float32(0.1) * np.float32(i) + np.float32(nmax)) / max
+            this_mse = mse(this_iscale)
+            better = this_mse < best_mse
+            best_mse = np.where(better, this_mse, best_mse)
+            iscale = np.where(better, this_iscale, iscale)
+
+        L = np.minimum(_nearest_int(iscale * x), np.float32(nmax))
+        sumlx = _seq_sum(wx * L)
+        suml2 = _seq_sum(weights * L * L)
+        # each group stops iterating once none of its values change
+        active = ~all_zero
+        for _ in range(5):
+            changed = np.zeros_like(all_zero)
+            for i in range(x.shape[-1]):
+                xi, wi, wxi, Li = x[..., i:i + 1], weights[..., i:i + 1], wx[..., i:i + 1], L[..., i:i + 1]
+                slx = sumlx - wxi * Li
+                sl2 = suml2 - wi * Li * Li
+                better = active & (slx > 0) & (sl2 > 0)
+                new_l = np.minimum(_nearest_int(xi * sl2 / slx), np.float32(nmax))
+                better &= new_l != Li
+                slx = slx + wxi * new_l
+                sl2 = sl2 + wi * new_l * new_l
+                better &= slx * slx * suml2 > sumlx * sumlx * sl2
+                L[..., i:i + 1] = np.where(better, new_l, Li)
+                sumlx = np.where(better, slx, sumlx)
+                suml2 = np.where(better, sl2, suml2)
+                changed |= better
+            active &= changed
+            if not active.any():
+                break
+        scale = sumlx / suml2
+
+    L = np.where(all_zero, np.float32(0), L)
+    scale = np.where(all_zero, np.float32(0), scale)
+    return scale, L
+
+
+# Importance of each value, from the importance matrix qw of the columns of the rows, like in ggml-quants.c:
+# qw[j] * sqrtf(sigma2 + x[j]*x[j]), where sigma2 is the mean square of the group of x[j] multiplied by factor
+def _importance_weights(rows: np.ndarray, qw: np.ndarray, group_size: int, factor: float) -> np.ndarray:
+    x = rows.reshape((rows.shape[0], -1, group_size))
+    sigma2 = np.float32(factor) * _seq_sum(x * x) / np.float32(group_size)
+    return (qw.reshape((1, -1, group_size)) * np.sqrt(sigma2 + x * x)).reshape(rows.shape)
+
+
 class QuantError(Exception): ...
 
 
 _type_traits: dict[GGMLQuantizationType, type[__Quant]] = {}
 
 
-def quantize(data: np.ndarray, qtype: GGMLQuantizationType) -> np.ndarray:
+# NumPy has no BF16 type, so BF16 tensors which are only moved around (reshaped, permuted, stacked)
+# can be kept as their raw bits with this opaque 2-byte type, which doesn't allow any arithmetic.
+# quantize() writes them out as-is when the target type is BF16, and decodes them to F32 otherwise.
+BF16_BITS = np.dtype((np.void, 2))
+
+
+def _bf16_bits_to_bytes(data: np.ndarray) -> np.ndarray:
+    if not data.flags.c_contiguous:
+        data = data.copy(order="C")
+    return data.view(np.uint8)
+
+
+def _bf16_bits_to_f32(data: np.ndarray) -> np.ndarray:
+    return (data.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
+_bf16_bits_to_bytes_lazy = LazyNumpyTensor._wrap_fn(
+    _bf16_bits_to_bytes,
+    meta_noop=(np.uint8, lambda shape: (*shape[:-1], shape[-1] * 2))
+)
+_bf16_bits_to_f32_lazy = LazyNumpyTensor._wrap_fn(
+    _bf16_bits_to_f32,
+    meta_noop=(np.float32, lambda shape: shape)
+)
+
+
+def quantize(data: np.ndarray, qtype: GGMLQuantizationType, imatrix: np.ndarray | None = None) -> np.ndarray:
+    """
+    Quantize the rows of data (the last axis) to qtype.
+
+    imatrix is the importance of each column (e.g. from llama-imatrix, see IMatrixFile),
+    with either one row for the whole tensor or one row for each matrix of a stacked tensor (e.g. for each expert).
+    Q4_0 to Q5_1, Q2_K to Q6_K and IQ4_NL use it for their scale search, with the same result as llama-quantize --imatrix,
+    and the other types ignore it.
+    """
+    if data.dtype == BF16_BITS:
+        is_lazy = isinstance(data, LazyNumpyTensor)
+        if qtype == GGMLQuantizationType.BF16:
+            # no rounding needed, only a copy of the bits
+            return _bf16_bits_to_bytes_lazy(data) if is_lazy else _bf16_bits_to_bytes(data)
+        data = _bf16_bits_to_f32_lazy(data) if is_lazy else _bf16_bits_to_f32(data)
+
     if qtype == GGMLQuantizationType.F32:
         return data.astype(np.float32, copy=False)
     elif qtype == GGMLQuantizationType.F16:
         return data.astype(np.float16, copy=False)
     elif (q := _type_traits.get(qtype)) is not None:
-        return q.quantize(data)
+        return q.quantize(data, imatrix=imatrix)
     else:
         raise NotImplementedError(f"Quantization for {qtype.name} is not yet implemented")
 
@@ -134,12 +515,24 @@ class __Quant(ABC):
         raise NotImplementedError
 
     @classmethod
-    def quantize_rows(cls, rows: np.ndarray) -> np.ndarray:
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray | None:
+        # Weight of each value of the rows for the scale search, from the importance qw of each column.
+        # Types which support importance weights override this,
+        # and then get them in the second argument of quantize_blocks.
+        # The others ignore them, like in ggml-quants.c.
+        return None
+
+    @classmethod
+    def quantize_rows(cls, rows: np.ndarray, qw: np.ndarray | None = None) -> np.ndarray:
         rows = rows.astype(np.float32, copy=False)
         shape = rows.shape
         n_blocks = rows.size // cls.block_size
+        weights = cls.importance_weights(rows.reshape((-1, shape[-1])), qw) if qw is not None else None
         blocks = rows.reshape((n_blocks, cls.block_size))
-        blocks = cls.quantize_blocks(blocks)
+        if weights is not None:
+            blocks = cls.quantize_blocks(blocks, weights.reshape((n_blocks, cls.block_size)))  # type: ignore[call-arg]
+        else:
+            blocks = cls.quantize_blocks(blocks)
         assert blocks.dtype == np.uint8
         assert blocks.shape[-1] == cls.type_size
         return blocks.reshape(cls.__shape_to_bytes(shape))
@@ -164,8 +557,18 @@ class __Quant(ABC):
         return quant_shape_from_byte_shape(shape, cls.qtype)
 
     @classmethod
-    def __quantize_array(cls, array: np.ndarray) -> np.ndarray:
-        return _apply_over_grouped_rows(cls.quantize_rows, arr=array, otype=np.uint8, oshape=cls.__shape_to_bytes(array.shape))
+    def __quantize_array(cls, array: np.ndarray, imatrix: np.ndarray | None = None) -> np.ndarray:
+        oshape = cls.__shape_to_bytes(array.shape)
+        if imatrix is None:
+            return _apply_over_grouped_rows(cls.quantize_rows, arr=array, otype=np.uint8, oshape=oshape)
+        # each matrix (e.g. each expert) has its own importance of the columns
+        n_per_row = array.shape[-1]
+        qw = imatrix.reshape((-1, n_per_row))
+        matrices = array.reshape((qw.shape[0], -1, n_per_row))
+        out = np.empty((qw.shape[0], matrices.shape[1], oshape[-1]), dtype=np.uint8)
+        for i in range(qw.shape[0]):
+            out[i] = _apply_over_grouped_rows(partial(cls.quantize_rows, qw=qw[i]), arr=matrices[i], otype=np.uint8, oshape=out[i].shape)
+        return out.reshape(oshape)
 
     @classmethod
     def __dequantize_array(cls, array: np.ndarray) -> np.ndarray:
@@ -173,7 +576,7 @@ class __Quant(ABC):
         return _apply_over_grouped_rows(cls.dequantize_rows, arr=array, otype=np.float32, oshape=cls.__shape_from_bytes(array.shape))
 
     @classmethod
-    def __quantize_lazy(cls, lazy_tensor: LazyNumpyTensor, /) -> Any:
+    def __quantize_lazy(cls, lazy_tensor: LazyNumpyTensor, /, **kwargs: Any) -> Any:
         pass
 
     @classmethod
@@ -185,13 +588,24 @@ class __Quant(ABC):
         return tensor.shape[-1] % cls.block_size == 0
 
     @classmethod
-    def quantize(cls, tensor: np.ndarray | LazyNumpyTensor) -> np.ndarray:
+    def quantize(cls, tensor: np.ndarray | LazyNumpyTensor, imatrix: np.ndarray | None = None) -> np.ndarray:
         if not cls.can_quantize(tensor):
             raise QuantError(f"Can't quantize tensor with shape {tensor.shape} to {cls.qtype.name}")
+        kwargs: dict[str, Any] = {}
+        if imatrix is not None:
+            imatrix = np.asarray(imatrix, dtype=np.float32)
+            n_per_row = tensor.shape[-1]
+            n_rows = 1
+            for dim in tensor.shape[:-1]:
+                n_rows *= dim
+            n_matrices = imatrix.size // n_per_row if n_per_row > 0 else 0
+            if n_matrices == 0 or imatrix.size != n_matrices * n_per_row or n_rows % n_matrices != 0:
+                raise ValueError(f"Importance matrix of size {imatrix.size} doesn't match the columns of a tensor with shape {tensor.shape}")
+            kwargs["imatrix"] = imatrix
         if isinstance(tensor, LazyNumpyTensor):
-            return cls.__quantize_lazy(tensor)
+            return cls.__quantize_lazy(tensor, **kwargs)
         else:
-            return cls.__quantize_array(tensor)
+            return cls.__quantize_array(tensor, **kwargs)
 
     @classmethod
     def dequantize(cls, tensor: np.ndarray | LazyNumpyTensor) -> np.ndarray:
@@ -219,17 +633,26 @@ class BF16(__Quant, qtype=GGMLQuantizationType.BF16):
 
 class Q4_0(__Quant, qtype=GGMLQuantizationType.Q4_0):
     @classmethod
-    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=rows.shape[-1], factor=1)
+
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
         n_blocks = blocks.shape[0]
 
-        imax = abs(blocks).argmax(axis=-1, keepdims=True)
-        max = np.take_along_axis(blocks, imax, axis=-1)
+        if weights is not None:
+            # same as quantize_row_q4_0_impl in ggml-quants.c
+            d, L = _make_qx_quants(blocks, nmax=8, weights=weights)
+            qs = L.astype(np.uint8)
+        else:
+            imax = abs(blocks).argmax(axis=-1, keepdims=True)
+            max = np.take_along_axis(blocks, imax, axis=-1)
 
-        d = max / -8
-        with np.errstate(divide="ignore"):
-            id = np.where(d == 0, 0, 1 / d)
-        # FIXME: Q4_0's reference rounding is cursed and depends on FMA
-        qs = np.trunc((np.float64(blocks) * np.float64(id)) + np.float64(8.5), dtype=np.float32).astype(np.uint8).clip(0, 15)
+            d = max / -8
+            with np.errstate(divide="ignore"):
+                id = np.where(d == 0, 0, 1 / d)
+            # FIXME: Q4_0's reference rounding is cursed and depends on FMA
+            qs = np.trunc((np.float64(blocks) * np.float64(id)) + np.float64(8.5), dtype=np.float32).astype(np.uint8).clip(0, 15)
 
         qs = qs.reshape((n_blocks, 2, cls.block_size // 2))
         qs = qs[..., 0, :] | (qs[..., 1, :] << np.uint8(4))
@@ -254,16 +677,27 @@ class Q4_0(__Quant, qtype=GGMLQuantizationType.Q4_0):
 
 class Q4_1(__Quant, qtype=GGMLQuantizationType.Q4_1):
     @classmethod
-    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=rows.shape[-1], factor=1)
+
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
         n_blocks = blocks.shape[0]
 
-        max = blocks.max(axis=-1, keepdims=True)
-        min = blocks.min(axis=-1, keepdims=True)
+        if weights is not None:
+            # same as quantize_row_q4_1_impl in ggml-quants.c
+            # (make_qkx3_quants is the same as make_qkx2_quants when given weights)
+            d, L, the_min = _make_qkx2_quants(blocks, weights, nmax=15, rmin=-0.9, rdelta=0.05, nstep=36, use_mad=False)
+            min = -the_min
+            qs = L.astype(np.uint8)
+        else:
+            max = blocks.max(axis=-1, keepdims=True)
+            min = blocks.min(axis=-1, keepdims=True)
 
-        d = (max - min) / 15
-        with np.errstate(divide="ignore"):
-            id = np.where(d == 0, 0, 1 / d)
-        qs = np.trunc((blocks - min) * id + np.float32(0.5), dtype=np.float32).astype(np.uint8).clip(0, 15)
+            d = (max - min) / 15
+            with np.errstate(divide="ignore"):
+                id = np.where(d == 0, 0, 1 / d)
+            qs = np.trunc((blocks - min) * id + np.float32(0.5), dtype=np.float32).astype(np.uint8).clip(0, 15)
 
         qs = qs.reshape((n_blocks, 2, cls.block_size // 2))
         qs = qs[..., 0, :] | (qs[..., 1, :] << np.uint8(4))
@@ -291,17 +725,26 @@ class Q4_1(__Quant, qtype=GGMLQuantizationType.Q4_1):
 
 class Q5_0(__Quant, qtype=GGMLQuantizationType.Q5_0):
     @classmethod
-    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=rows.shape[-1], factor=1)
+
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
         n_blocks = blocks.shape[0]
 
-        imax = abs(blocks).argmax(axis=-1, keepdims=True)
-        max = np.take_along_axis(blocks, imax, axis=-1)
+        if weights is not None:
+            # same as quantize_row_q5_0_impl in ggml-quants.c
+            d, L = _make_qx_quants(blocks, nmax=16, weights=weights)
+            q = L.astype(np.uint8)
+        else:
+            imax = abs(blocks).argmax(axis=-1, keepdims=True)
+            max = np.take_along_axis(blocks, imax, axis=-1)
 
-        d = max / -16
-        with np.errstate(divide="ignore"):
-            id = np.where(d == 0, 0, 1 / d)
-        # FIXME: Q5_0's reference rounding is cursed and depends on FMA
-        q = np.trunc((np.float64(blocks) * np.float64(id)) + np.float64(16.5), dtype=np.float32).astype(np.uint8).clip(0, 31)
+            d = max / -16
+            with np.errstate(divide="ignore"):
+                id = np.where(d == 0, 0, 1 / d)
+            # FIXME: Q5_0's reference rounding is cursed and depends on FMA
+            q = np.trunc((np.float64(blocks) * np.float64(id)) + np.float64(16.5), dtype=np.float32).astype(np.uint8).clip(0, 31)
 
         qs = q.reshape((n_blocks, 2, cls.block_size // 2))
         qs = (qs[..., 0, :] & np.uint8(0x0F)) | (qs[..., 1, :] << np.uint8(4))
@@ -334,16 +777,26 @@ class Q5_0(__Quant, qtype=GGMLQuantizationType.Q5_0):
 
 class Q5_1(__Quant, qtype=GGMLQuantizationType.Q5_1):
     @classmethod
-    def quantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=rows.shape[-1], factor=1)
+
+    @classmethod
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
         n_blocks = blocks.shape[0]
 
-        max = blocks.max(axis=-1, keepdims=True)
-        min = blocks.min(axis=-1, keepdims=True)
+        if weights is not None:
+            # same as quantize_row_q5_1_impl in ggml-quants.c
+            d, L, the_min = _make_qkx2_quants(blocks, weights, nmax=31, rmin=-0.9, rdelta=0.05, nstep=36, use_mad=False)
+            min = -the_min
+            q = L.astype(np.uint8)
+        else:
+            max = blocks.max(axis=-1, keepdims=True)
+            min = blocks.min(axis=-1, keepdims=True)
 
-        d = (max - min) / 31
-        with np.errstate(divide="ignore"):
-            id = np.where(d == 0, 0, 1 / d)
-        q = np.trunc((blocks - min) * id + np.float32(0.5), dtype=np.float32).astype(np.uint8).clip(0, 31)
+            d = (max - min) / 31
+            with np.errstate(divide="ignore"):
+                id = np.where(d == 0, 0, 1 / d)
+            q = np.trunc((blocks - min) * id + np.float32(0.5), dtype=np.float32).astype(np.uint8).clip(0, 31)
 
         qs = q.reshape((n_blocks, 2, cls.block_size // 2))
         qs = (qs[..., 0, :] & np.uint8(0x0F)) | (qs[..., 1, :] << np.uint8(4))
@@ -404,6 +857,60 @@ class Q8_0(__Quant, qtype=GGMLQuantizationType.Q8_0):
 
 
 class Q2_K(__Quant, qtype=GGMLQuantizationType.Q2_K):
+    @staticmethod
+    def pack_2bit(L: np.ndarray) -> np.ndarray:
+        n_blocks = L.shape[0]
+        L = L.astype(np.uint8).reshape((n_blocks, -1, 4, 32)) << np.array([0, 2, 4, 6], dtype=np.uint8).reshape((1, 1, 4, 1))
+        return np.bitwise_or.reduce(L, axis=-2).reshape((n_blocks, -1))
+
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=QK_K, factor=1)
+
+    @classmethod
+    # same as quantize_row_q2_K_ref in ggml-quants.c, or quantize_row_q2_K_impl with importance weights
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        # (n_blocks, 16, 16)
+        x = blocks.reshape((n_blocks, QK_K // 16, 16))
+        if weights is not None:
+            w = weights.reshape(x.shape)
+            scales, L, mins = _make_qkx2_quants(x, w, nmax=3, rmin=-0.9, rdelta=0.05, nstep=36, use_mad=False)
+            # the scales and mins are rounded with the total weight of their sub-block
+            sw = _seq_sum(w).reshape((n_blocks, QK_K // 16))
+            d, sc = _make_qp_quants(scales.reshape(sw.shape), nmax=15, weights=sw)
+            dmin, m = _make_qp_quants(mins.reshape(sw.shape), nmax=15, weights=sw)
+            sc = sc.astype(np.int32).reshape(scales.shape)
+            m = m.astype(np.int32).reshape(mins.shape)
+            d = d.reshape((n_blocks, 1, 1)).astype(np.float16)
+            dmin = dmin.reshape((n_blocks, 1, 1)).astype(np.float16)
+        else:
+            scales, L, mins = _make_qkx2_quants(x, abs(x), nmax=3, rmin=-0.5, rdelta=0.1, nstep=15, use_mad=True)
+
+            # as the min is deducted, the scales are always positive
+            max_scale = np.maximum(scales.max(axis=-2, keepdims=True), np.float32(0))
+            max_min = np.maximum(mins.max(axis=-2, keepdims=True), np.float32(0))
+
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                sc = np.where(max_scale > 0, _nearest_int((np.float32(15) / max_scale) * scales), 0).astype(np.int32)
+                m = np.where(max_min > 0, _nearest_int((np.float32(15) / max_min) * mins), 0).astype(np.int32)
+                d = np.where(max_scale > 0, max_scale / np.float32(15), 0).astype(np.float16)
+                dmin = np.where(max_min > 0, max_min / np.float32(15), 0).astype(np.float16)
+        sc = ((sc | (m << 4)) & 0xFF).astype(np.uint8)
+
+        dl = d.astype(np.float32) * (sc & np.uint8(0x0F)).astype(np.float32)
+        ml = dmin.astype(np.float32) * (sc >> np.uint8(4)).astype(np.float32)
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            L = np.where(dl != 0, _nearest_int((x + ml) / dl).clip(0, 3), L)
+
+        sc = sc.reshape((n_blocks, QK_K // 16))
+        qs = cls.pack_2bit(L)
+        d = d.reshape((n_blocks, 1)).view(np.uint8)
+        dmin = dmin.reshape((n_blocks, 1)).view(np.uint8)
+
+        return np.concatenate([sc, qs, d, dmin], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -431,6 +938,55 @@ class Q2_K(__Quant, qtype=GGMLQuantizationType.Q2_K):
 
 
 class Q3_K(__Quant, qtype=GGMLQuantizationType.Q3_K):
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=QK_K, factor=2)
+
+    @classmethod
+    # same as quantize_row_q3_K_ref in ggml-quants.c, or quantize_row_q3_K_impl with importance weights
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        # (n_blocks, 16, 16)
+        x = blocks.reshape((n_blocks, QK_K // 16, 16))
+        if weights is not None:
+            w = weights.reshape(x.shape)
+            scales, L = _make_qx_quants(x, nmax=4, weights=w)
+            scales = scales.reshape((n_blocks, QK_K // 16))
+            # the scales are quantized with the total weight of their sub-block
+            d, ls = _make_qx_quants(scales, nmax=32, weights=_seq_sum(w).reshape((n_blocks, QK_K // 16)))
+            d = d.astype(np.float16)
+            ls = ls.astype(np.uint8)
+        else:
+            scales, L = _make_q3_quants(x, nmax=4)
+            scales = scales.reshape((n_blocks, QK_K // 16))
+
+            imax = abs(scales).argmax(axis=-1, keepdims=True)
+            max_scale = np.take_along_axis(scales, imax, axis=-1)
+
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                iscale = np.float32(-32) / max_scale
+                # (n_blocks, 16)
+                ls = np.where(max_scale != 0, _nearest_int(iscale * scales).clip(-32, 31) + np.float32(32), 0).astype(np.uint8)
+                d = np.where(max_scale != 0, np.float32(1) / iscale, 0).astype(np.float16)
+
+        # see the packing pattern in dequantize_blocks
+        lscales = (ls[:, :8] & np.uint8(0x0F)) | ((ls[:, 8:] & np.uint8(0x0F)) << np.uint8(4))
+        hscales = (ls >> np.uint8(4)).reshape((n_blocks, 4, 4)) << np.array([0, 2, 4, 6], dtype=np.uint8).reshape((1, 4, 1))
+        hscales = np.bitwise_or.reduce(hscales, axis=-2)
+
+        dl = (d.astype(np.float32) * (ls.astype(np.int8) - np.int8(32)).astype(np.float32)).reshape((n_blocks, -1, 1))
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            L = np.where(dl != 0, _nearest_int(x / dl).clip(-4, 3) + np.float32(4), L)
+        L = L.astype(np.uint8).reshape((n_blocks, QK_K))
+
+        # the high bit of the first 32 quants goes into bit 0, the next 32 into bit 1, etc.
+        hbit = (L >> np.uint8(2)).reshape((n_blocks, 8, 32)) << np.array([i for i in range(8)], dtype=np.uint8).reshape((1, 8, 1))
+        hmask = np.bitwise_or.reduce(hbit, axis=-2)
+        qs = Q2_K.pack_2bit(L & np.uint8(3))
+
+        return np.concatenate([hmask, qs, lscales, hscales, d.view(np.uint8)], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -502,6 +1058,71 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
 
         return (sc.reshape((n_blocks, 8)), min.reshape((n_blocks, 8)))
 
+    @staticmethod
+    # common part of quantize_row_q4_K_ref and quantize_row_q5_K_ref in ggml-quants.c,
+    # or of quantize_row_q4_K_impl and quantize_row_q5_K_impl with importance weights
+    def quantize_scale_min(blocks: np.ndarray, nmax: int, rmin: float, nstep: int, weights: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        n_blocks = blocks.shape[0]
+
+        # (n_blocks, 8, 32)
+        x = blocks.reshape((n_blocks, QK_K // 32, 32))
+        if weights is not None:
+            w = weights.reshape(x.shape)
+            scales, L, mins = _make_qkx2_quants(x, w, nmax=nmax, rmin=-0.9, rdelta=0.05, nstep=36, use_mad=False)
+            # the scales and mins are rounded with the total weight of their sub-block
+            sw = _seq_sum(w).reshape((n_blocks, QK_K // 32))
+            max_scale, ls_f = _make_qp_quants(scales.reshape(sw.shape), nmax=63, weights=sw)
+            max_min, lm_f = _make_qp_quants(mins.reshape(sw.shape), nmax=63, weights=sw)
+            ls = np.minimum(ls_f.astype(np.int32) & 0xFF, 63).astype(np.uint8)
+            lm = np.minimum(lm_f.astype(np.int32) & 0xFF, 63).astype(np.uint8)
+            d = max_scale.astype(np.float16)
+            dmin = max_min.astype(np.float16)
+        else:
+            av_x = np.sqrt(_seq_sum(x * x) / np.float32(32))
+            scales, L, mins = _make_qkx2_quants(x, av_x + abs(x), nmax=nmax, rmin=rmin, rdelta=0.1, nstep=nstep, use_mad=False)
+            scales = scales.reshape((n_blocks, QK_K // 32))
+            mins = mins.reshape((n_blocks, QK_K // 32))
+
+            # as the min is deducted, the scales are always positive
+            max_scale = np.maximum(scales.max(axis=-1, keepdims=True), np.float32(0))
+            max_min = np.maximum(mins.max(axis=-1, keepdims=True), np.float32(0))
+
+            with np.errstate(divide="ignore"):
+                inv_scale = np.where(max_scale > 0, np.float32(63) / max_scale, 0).astype(np.float32)
+                inv_min = np.where(max_min > 0, np.float32(63) / max_min, 0).astype(np.float32)
+            ls = np.minimum(_nearest_int(inv_scale * scales).astype(np.int32) & 0xFF, 63).astype(np.uint8)
+            lm = np.minimum(_nearest_int(inv_min * mins).astype(np.int32) & 0xFF, 63).astype(np.uint8)
+            d = (max_scale / np.float32(63)).astype(np.float16)
+            dmin = (max_min / np.float32(63)).astype(np.float16)
+
+        # see the packing pattern in get_scale_min
+        d_s = ls[:, :4] | ((ls[:, 4:] >> np.uint8(4)) << np.uint8(6))
+        m_s = lm[:, :4] | ((lm[:, 4:] >> np.uint8(4)) << np.uint8(6))
+        m_d = (ls[:, 4:] & np.uint8(0x0F)) | ((lm[:, 4:] & np.uint8(0x0F)) << np.uint8(4))
+
+        dl = (d.astype(np.float32) * ls.astype(np.float32)).reshape((n_blocks, -1, 1))
+        ml = (dmin.astype(np.float32) * lm.astype(np.float32)).reshape((n_blocks, -1, 1))
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            L = np.where(dl != 0, _nearest_int((x + ml) / dl).clip(0, nmax), L)
+
+        return d.view(np.uint8), dmin.view(np.uint8), np.concatenate([d_s, m_s, m_d], axis=-1), L.astype(np.uint8)
+
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=QK_K, factor=2)
+
+    @classmethod
+    # same as quantize_row_q4_K_ref in ggml-quants.c
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        d, dmin, scales, L = cls.quantize_scale_min(blocks, nmax=15, rmin=-1.0, nstep=20, weights=weights)
+
+        L = L.reshape((n_blocks, -1, 2, 32))
+        qs = (L[:, :, 0] | (L[:, :, 1] << np.uint8(4))).reshape((n_blocks, -1))
+
+        return np.concatenate([d, dmin, scales, qs], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -525,6 +1146,24 @@ class Q4_K(__Quant, qtype=GGMLQuantizationType.Q4_K):
 
 
 class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=QK_K, factor=2)
+
+    @classmethod
+    # same as quantize_row_q5_K_ref in ggml-quants.c
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        d, dmin, scales, L = Q4_K.quantize_scale_min(blocks, nmax=31, rmin=-0.5, nstep=15, weights=weights)
+
+        qh = (L >> np.uint8(4)).reshape((n_blocks, 8, 32)) << np.array([i for i in range(8)], dtype=np.uint8).reshape((1, 8, 1))
+        qh = np.bitwise_or.reduce(qh, axis=-2)
+        ql = (L & np.uint8(0x0F)).reshape((n_blocks, -1, 2, 32))
+        ql = (ql[:, :, 0] | (ql[:, :, 1] << np.uint8(4))).reshape((n_blocks, -1))
+
+        return np.concatenate([d, dmin, scales, qh, ql], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -552,6 +1191,43 @@ class Q5_K(__Quant, qtype=GGMLQuantizationType.Q5_K):
 
 
 class Q6_K(__Quant, qtype=GGMLQuantizationType.Q6_K):
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        # the importance is used as-is
+        return np.broadcast_to(qw, rows.shape)
+
+    @classmethod
+    # same as quantize_row_q6_K_ref in ggml-quants.c, or quantize_row_q6_K_impl with importance weights
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        n_blocks = blocks.shape[0]
+
+        # (n_blocks, 16, 16)
+        x = blocks.reshape((n_blocks, QK_K // 16, 16))
+        scales, L = _make_qx_quants(x, nmax=32, weights=weights.reshape(x.shape) if weights is not None else None)
+        scales = scales.reshape((n_blocks, QK_K // 16))
+
+        imax = abs(scales).argmax(axis=-1, keepdims=True)
+        max_scale = np.take_along_axis(scales, imax, axis=-1)
+        # blocks with only near-zero scales are zeroed entirely
+        all_zero = abs(max_scale) < np.float32(1e-15)
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            iscale = np.float32(-128) / max_scale
+            d = np.where(all_zero, 0, np.float32(1) / iscale).astype(np.float16)
+            sc = np.where(all_zero, 0, np.minimum(_nearest_int(iscale * scales), 127)).astype(np.int8)
+
+        dl = (d.astype(np.float32) * sc.astype(np.float32)).reshape((n_blocks, -1, 1))
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            L = np.where(dl != 0, _nearest_int(x / dl).clip(-32, 31) + np.float32(32), L)
+        L = np.where(all_zero.reshape((n_blocks, 1, 1)), 0, L).astype(np.uint8).reshape((n_blocks, -1, 4, 32))
+
+        lo = L & np.uint8(0x0F)
+        ql = (lo[:, :, :2] | (lo[:, :, 2:] << np.uint8(4))).reshape((n_blocks, -1))
+        qh = (L >> np.uint8(4)) << np.array([0, 2, 4, 6], dtype=np.uint8).reshape((1, 1, 4, 1))
+        qh = np.bitwise_or.reduce(qh, axis=-2).reshape((n_blocks, -1))
+
+        return np.concatenate([ql, qh, sc.view(np.uint8), d.view(np.uint8)], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -1222,6 +1898,44 @@ class IQ1_M(__Quant, qtype=GGMLQuantizationType.IQ1_M):
 class IQ4_NL(__Quant, qtype=GGMLQuantizationType.IQ4_NL):
     kvalues = (-127, -104, -83, -65, -49, -35, -22, -10, 1, 13, 25, 38, 53, 69, 89, 113)
 
+    @classmethod
+    def importance_weights(cls, rows: np.ndarray, qw: np.ndarray) -> np.ndarray:
+        return _importance_weights(rows, qw, group_size=cls.block_size, factor=2)
+
+    @classmethod
+    # same as quantize_iq4_nl in ggml-quants.c, with or without importance weights
+    def quantize_blocks(cls, blocks: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        values = np.array(cls.kvalues, dtype=np.float32)
+        ntry = 7
+
+        ax = abs(blocks)
+        imax = ax.argmax(axis=-1, keepdims=True)
+        max = np.take_along_axis(blocks, imax, axis=-1)
+        all_zero = np.take_along_axis(ax, imax, axis=-1) < np.float32(1e-15)
+        w = blocks * blocks if weights is None else weights
+
+        def sums(id: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            q = values[_best_index(values, id * blocks)]
+            wq = w * q
+            return _seq_sum(wq * blocks), _seq_sum(wq * q)
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            sumqx, sumq2 = sums(np.float32(1) / (-max / values[0]))
+            d = sumqx / sumq2
+            best = d * sumqx
+            for itry in range(-ntry, ntry + 1):
+                sumqx, sumq2 = sums(np.float32(itry + cls.kvalues[0]) / max)
+                better = (sumq2 > 0) & (sumqx * sumqx > best * sumq2)
+                d = np.where(better, sumqx / sumq2, d)
+                best = np.where(better, d * sumqx, best)
+            d = np.where(all_zero, np.float32(0), d)
+            id = np.where(d != 0, np.float32(1) / d, np.float32(0))
+
+        L = _best_index(values, id * blocks).astype(np.uint8)
+        qs = L[:, :cls.block_size // 2] | (L[:, cls.block_size // 2:] << np.uint8(4))
+
+        return np.concatenate([d.astype(np.float16).view(np.uint8), qs], axis=-1)
+
     @classmethod
     def dequantize_blocks(cls, blocks: np.ndarray) -> np.ndarray:
         n_blocks = blocks.shape[0]
@@ -4,12 +4,11 @@ from __future__ import annotations
 import logging
 import argparse
 import os
+import shutil
 import sys
 from tqdm import tqdm
 from pathlib import Path
 
-import numpy as np
-
 # Necessary to load the local gguf package
 if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent.parent / 'gguf-py').exists():
     sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -32,32 +31,34 @@ def convert_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None
         sys.exit(0)
     logger.info("* Checking tensors for conversion compatibility")
     for tensor in reader.tensors:
-        if tensor.tensor_type not in (
-            gguf.GGMLQuantizationType.F32,
-            gguf.GGMLQuantizationType.F16,
-            gguf.GGMLQuantizationType.Q8_0,
-            gguf.GGMLQuantizationType.Q4_K,
-            gguf.GGMLQuantizationType.Q6_K,
-        ):
+        if not gguf.quants.can_byteswap(tensor.tensor_type):
             raise ValueError(f"Cannot handle type {tensor.tensor_type.name} for tensor {repr(tensor.name)}")
     logger.info(f"* Preparing to convert from {file_endian} to {order}")
     if args.dry_run:
         return
-    logger.warning("*** Warning *** Warning *** Warning **")
-    logger.warning("* This conversion process may damage the file. Ensure you have a backup.")
-    if order != host_endian:
-        logger.warning("* Requested endian differs from host, you will not be able to load the model on this machine.")
-    logger.warning("* The file will be modified immediately, so if conversion fails or is interrupted")
-    logger.warning("* the file will be corrupted. Enter exactly YES if you are positive you want to proceed:")
-    response = input("YES, I am sure> ")
-    if response != "YES":
-        logger.warning("You didn't enter YES. Okay then, see ya!")
-        sys.exit(0)
+    if args.output is not None:
+        logger.info(f"* Copying to {args.output}")
+        shutil.copyfile(args.model, args.output)
+        reader = gguf.GGUFReader(args.output, 'r+')
+    else:
+        logger.warning("*** Warning *** Warning *** Warning **")
+        logger.warning("* This conversion process may damage the file. Ensure you have a backup.")
+        if order != host_endian:
+            logger.warning("* Requested endian differs from host, you will not be able to load the model on this machine.")
+        logger.warning("* The file will be modified immediately, so if conversion fails or is interrupted")
+        logger.warning("* the file will be corrupted. Enter exactly YES if you are positive you want to proceed:")
+        response = input("YES, I am sure> ")
+        if response != "YES":
+            logger.warning("You didn't enter YES. Okay then, see ya!")
+            sys.exit(0)
     logger.info(f"* Converting fields ({len(reader.fields)})")
     for idx, field in enumerate(reader.fields.values()):
         logger.info(f"- {idx:4}: Converting field {repr(field.name)}, part count: {len(field.parts)}")
-        for part in field.parts:
-            part.byteswap(inplace=True)
+        if isinstance(field.parts, gguf.ReaderArrayParts):
+            field.parts.byteswap()
+        else:
+            for part in field.parts:
+                part.byteswap(inplace=True)
     logger.info(f"* Converting tensors ({len(reader.tensors)})")
 
     for idx, tensor in enumerate(pbar := tqdm(reader.tensors, desc="Converting tensor")):
@@ -71,85 +72,12 @@ def convert_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None
         for part in tensor.field.parts:
             part.byteswap(inplace=True)
 
-        # Byte-swap tensor data if necessary
-        if tensor.tensor_type == gguf.GGMLQuantizationType.Q8_0:
-            # Handle Q8_0 tensor blocks (block_q8_0)
-            # Specific handling of block_q8_0 is required.
-            # Each block_q8_0 consists of an f16 delta (scaling factor) followed by 32 int8 quantizations.
-
-            block_size = 34 # 34 bytes = <f16 delta scaling factor> + 32 * <int8 quant>
-
-            n_blocks = len(tensor.data) // block_size
-            for block_num in (inner_pbar := tqdm(range(n_blocks), desc="Byte-swapping Blocks", leave=False)):
-                block_offs = block_num * block_size
-
-                # Byte-Swap f16 sized delta field
-                delta = tensor.data[block_offs:block_offs + 2].view(dtype=np.uint16)
-                delta.byteswap(inplace=True)
-
-                # Byte-Swap Q8 weights
-                if block_num % 100000 == 0:
-                    inner_pbar.set_description(f"Byte-swapping Blocks [{(n_blocks - block_num) // n_blocks}]")
-
-        elif tensor.tensor_type == gguf.GGMLQuantizationType.Q4_K:
-            # Handle Q4_K tensor blocks (block_q4_k)
-            # Specific handling of block_q4_k is required.
-            # Each block_q4_k consists of 2 f16 values followed by 140 int8 values.
-
-            # first flatten structure
-            newshape = 1
-            for i in tensor.data.shape:
-                newshape *= i
-
-            tensor.data.resize(newshape)
-
-            block_size = 144
-            n_blocks = len(tensor.data) // block_size
-            for block_num in (inner_pbar := tqdm(range(n_blocks), desc="Byte-swapping Blocks", leave=False)):
-                block_offs = block_num * block_size
-
-                # Byte-Swap f16 sized fields
-                delta = tensor.data[block_offs:block_offs + 2].view(dtype=np.uint16)
-                delta.byteswap(inplace=True)
-
-                delta = tensor.data[block_offs + 2:block_offs + 4].view(dtype=np.uint16)
-                delta.byteswap(inplace=True)
-
-                # Byte-Swap
-                if block_num % 100000 == 0:
-                    inner_pbar.set_description(f"Byte-swapping Blocks [{(n_blocks - block_num) // n_blocks}]")
-
-        elif tensor.tensor_type == gguf.GGMLQuantizationType.Q6_K:
-            # Handle Q6_K tensor blocks (block_q6_k)
-            # Specific handling of block_q6_k is required.
-            # Each block_q6_k consists of 208 int8 values followed by 1 f16 value.
-
-            # first flatten structure
-            newshape = 1
-            for i in tensor.data.shape:
-                newshape *= i
-
-            tensor.data.resize(newshape)
-
-            block_size = 210
-            n_blocks = len(tensor.data) // block_size
-            for block_num in (inner_pbar := tqdm(range(n_blocks), desc="Byte-swapping Blocks", leave=False)):
-                block_offs = block_num * block_size
-
-                # Byte-Swap f16 sized field
-                delta = tensor.data[block_offs + 208:block_offs + 210].view(dtype=np.uint16)
-                delta.byteswap(inplace=True)
-
-                # Byte-Swap
-                if block_num % 100000 == 0:
-                    inner_pbar.set_description(f"Byte-swapping Blocks [{(n_blocks - block_num) // n_blocks}]")
-
-        else:
-            # Handle other tensor types
-            tensor.data.byteswap(inplace=True)
+        # Byte-swap the multi-byte fields of all the blocks at once
+        gguf.quants.byteswap_tensor_data(tensor.data, tensor.tensor_type)
 
         pbar.set_description(log_message)
 
+    reader.data.flush()
     logger.info("* Completion")
 
 
@@ -163,6 +91,10 @@ def main() -> None:
         "order", type=str, choices=['big', 'little', 'native'],
         help="Requested byte order",
     )
+    parser.add_argument(
+        "--output", type=str, default=None,
+        help="Write the converted model to this file instead of modifying the input in place",
+    )
     parser.add_argument(
         "--dry-run", action="store_true",
         help="Don't actually change anything",
@@ -174,7 +106,7 @@ def main() -> None:
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
     logger.info(f'* Loading: {args.model}')
-    reader = gguf.GGUFReader(args.model, 'r' if args.dry_run else 'r+')
+    reader = gguf.GGUFReader(args.model, 'r' if args.dry_run or args.output is not None else 'r+')
     convert_byteorder(reader, args)
 
 
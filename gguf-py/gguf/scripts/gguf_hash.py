@@ -16,7 +16,7 @@ from tqdm import tqdm
 if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent.parent / 'gguf-py').exists():
     sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from gguf import GGUFReader  # noqa: E402
+from gguf import GGUFReader, HashCache, hash_ranges_and_concatenation  # noqa: E402
 
 
 logger = logging.getLogger("gguf-hash")
@@ -25,65 +25,53 @@ logger = logging.getLogger("gguf-hash")
 UUID_NAMESPACE_LLAMA_CPP = uuid.UUID('ef001206-dadc-5f6d-a15f-3359e577d4e5')
 
 
-# For more information about what field.parts and field.data represent,
-# please see the comments in the modify_gguf.py example.
-def gguf_hash(reader: GGUFReader, filename: str, disable_progress_bar: bool, no_layer: bool) -> None:
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
+# Tensors which are not part of the model weights
+SKIPPED_TENSOR_SUFFIXES = (".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")
+
+
+def _uuidv5_sha1() -> hashlib._Hash:
     uuidv5_sha1 = hashlib.sha1()
     uuidv5_sha1.update(UUID_NAMESPACE_LLAMA_CPP.bytes)
+    return uuidv5_sha1
 
-    # Total Weight Calculation For Progress Bar
-    total_weights = 0
-    for n, tensor in enumerate(reader.tensors, 1):
 
-        # We don't need these
-        if tensor.name.endswith((".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")):
-            continue
+# For more information about what field.parts and field.data represent,
+# please see the comments in the modify_gguf.py example.
+def gguf_hash(
+    reader: GGUFReader, filename: str, disable_progress_bar: bool, no_layer: bool,
+    thread_count: int | None = None, cache: HashCache | None = None,
+) -> None:
+    tensors = [tensor for tensor in reader.tensors if not tensor.name.endswith(SKIPPED_TENSOR_SUFFIXES)]
+    ranges = [(int(tensor.data_offset), int(tensor.n_bytes)) for tensor in tensors]
 
-        # Calculate Tensor Volume
-        sum_weights_in_tensor = 1
-        for dim in tensor.shape:
-            sum_weights_in_tensor *= dim
-        total_weights += sum_weights_in_tensor
+    # Total Weight Calculation For Progress Bar
+    total_weights = sum(int(tensor.n_elements) for tensor in tensors)
 
     # Hash Progress Bar
     bar = tqdm(desc="Hashing", total=total_weights, unit="weights", unit_scale=True, disable=disable_progress_bar)
 
-    # Hashing Process
-    for tensor in reader.tensors:
-
-        # We don't need these
-        if tensor.name.endswith((".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")):
-            continue
-
-        # Progressbar
-        sum_weights_in_tensor = 1
-        for dim in tensor.shape:
-            sum_weights_in_tensor *= dim
-        bar.update(sum_weights_in_tensor)
-
-        if not no_layer:
-
-            sha1_layer = hashlib.sha1()
-            sha1_layer.update(tensor.data.data)
-            print("sha1      {0}  {1}:{2}".format(sha1_layer.hexdigest(), filename, tensor.name)) # noqa: NP100
-
-            sha256_layer = hashlib.sha256()
-            sha256_layer.update(tensor.data.data)
-            print("sha256    {0}  {1}:{2}".format(sha256_layer.hexdigest(), filename, tensor.name)) # noqa: NP100
-
-        sha1.update(tensor.data.data)
-        sha256.update(tensor.data.data)
-        uuidv5_sha1.update(tensor.data.data)
+    # Each tensor is hashed on its own, and all the tensors in order for the whole model hashes,
+    # from a single read of each tensor, with the hashers running in parallel
+    layer_digests, model_digests = hash_ranges_and_concatenation(
+        filename, ranges,
+        {} if no_layer else {"sha1": hashlib.sha1, "sha256": hashlib.sha256},
+        {"sha1": hashlib.sha1, "sha256": hashlib.sha256, "uuidv5-sha1": _uuidv5_sha1},
+        thread_count=thread_count, cache=cache, cache_key="tensors",
+        on_done=lambda i: bar.update(int(tensors[i].n_elements)),
+    )
+    if not no_layer:
+        for tensor, digests in zip(tensors, layer_digests):
+            print("sha1      {0}  {1}:{2}".format(digests["sha1"], filename, tensor.name)) # noqa: NP100
+            print("sha256    {0}  {1}:{2}".format(digests["sha256"], filename, tensor.name)) # noqa: NP100
 
     # Flush Hash Progress Bar
     bar.close()
 
     # Display Hash Output
-    print("sha1      {0}  {1}".format(sha1.hexdigest(), filename)) # noqa: NP100
-    print("sha256    {0}  {1}".format(sha256.hexdigest(), filename)) # noqa: NP100
-    print("uuid      {0}  {1}".format(uuid.UUID(bytes=uuidv5_sha1.digest()[:16], version=5), filename)) # noqa: NP100
+    uuidv5 = uuid.UUID(bytes=bytes.fromhex(model_digests["uuidv5-sha1"])[:16], version=5)
+    print("sha1      {0}  {1}".format(model_digests["sha1"], filename)) # noqa: NP100
+    print("sha256    {0}  {1}".format(model_digests["sha256"], filename)) # noqa: NP100
+    print("uuid      {0}  {1}".format(uuidv5, filename)) # noqa: NP100
 
 
 def main() -> None:
@@ -92,10 +80,15 @@ def main() -> None:
     parser.add_argument("--no-layer",    action="store_true", help="exclude per layer hash")
     parser.add_argument("--verbose",     action="store_true", help="increase output verbosity")
     parser.add_argument("--progressbar", action="store_true", help="enable progressbar")
+    parser.add_argument("--threads",     type=int,            help="number of threads hashing each tensor (default: number of CPUs)")
+    parser.add_argument("--cache",       type=Path,           help="JSON file caching the hashes, reused while the model file is unchanged")
     args = parser.parse_args(None if len(sys.argv) > 1 else ["--help"])
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     reader = GGUFReader(args.model, 'r')
-    gguf_hash(reader, args.model, not args.progressbar, args.no_layer)
+    cache = HashCache(args.cache) if args.cache is not None else None
+    gguf_hash(reader, args.model, not args.progressbar, args.no_layer, args.threads, cache)
+    if cache is not None:
+        cache.save()
 
 
 if __name__ == '__main__':
@@ -8,7 +8,6 @@ import sys
 import json
 from pathlib import Path
 
-from tqdm import tqdm
 from typing import Any, Sequence, NamedTuple
 
 # Necessary to load the local gguf package
@@ -41,67 +40,41 @@ def find_token(token_list: Sequence[int], token: str) -> Sequence[int]:
     return token_ids
 
 
-def copy_with_new_metadata(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str]) -> None:
-    for field in reader.fields.values():
-        # Suppress virtual fields and fields written by GGUFWriter
-        if field.name == gguf.Keys.General.ARCHITECTURE or field.name.startswith('GGUF.'):
-            logger.debug(f'Suppressing {field.name}')
-            continue
-
-        # Skip old chat templates if we have new ones
-        if field.name.startswith(gguf.Keys.Tokenizer.CHAT_TEMPLATE) and gguf.Keys.Tokenizer.CHAT_TEMPLATE in new_metadata:
-            logger.debug(f'Skipping {field.name}')
-            continue
-
-        if field.name in remove_metadata:
-            logger.debug(f'Removing {field.name}')
-            continue
-
-        old_val = MetadataDetails(field.types[0], field.contents())
-        val = new_metadata.get(field.name, old_val)
-
-        if field.name in new_metadata:
-            logger.debug(f'Modifying {field.name}: "{old_val.value}" -> "{val.value}" {val.description}')
-            del new_metadata[field.name]
-        elif val.value is not None:
-            logger.debug(f'Copying {field.name}')
-
-        if val.value is not None:
-            writer.add_key_value(field.name, val.value, val.type)
+def get_metadata_changes(reader: gguf.GGUFReader, arch: str, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str]) -> tuple[dict[str, gguf.GGUFValue], list[str]]:
+    # The keys to set and to remove, as input for gguf.patch_metadata
+    remove = [name for name in reader.fields if name in remove_metadata]
 
+    # Remove old chat templates if we have new ones
     if gguf.Keys.Tokenizer.CHAT_TEMPLATE in new_metadata:
-        logger.debug('Adding chat template(s)')
-        writer.add_chat_template(new_metadata[gguf.Keys.Tokenizer.CHAT_TEMPLATE].value)
-        del new_metadata[gguf.Keys.Tokenizer.CHAT_TEMPLATE]
+        remove += [name for name in reader.fields if name.startswith(gguf.Keys.Tokenizer.CHAT_TEMPLATE)]
 
-    for key, val in new_metadata.items():
-        logger.debug(f'Adding {key}: "{val.value}" {val.description}')
-        writer.add_key_value(key, val.value, val.type)
+    # Collect the new values with a writer, which knows how to store e.g. multiple chat templates
+    writer = gguf.GGUFWriter(None, arch=arch, endianess=reader.endianess)
 
-    total_bytes = 0
-
-    for tensor in reader.tensors:
-        total_bytes += tensor.n_bytes
-        writer.add_tensor_info(tensor.name, tensor.data.shape, tensor.data.dtype, tensor.data.nbytes, tensor.tensor_type)
-
-    bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
+    for key, val in new_metadata.items():
+        if key == gguf.Keys.Tokenizer.CHAT_TEMPLATE:
+            logger.debug('Adding chat template(s)')
+            writer.add_chat_template(val.value)
+        elif key in reader.fields:
+            logger.debug(f'Modifying {key}: "{get_field_data(reader, key)}" -> "{val.value}" {val.description}')
+            writer.add_key_value(key, val.value, val.type)
+        else:
+            logger.debug(f'Adding {key}: "{val.value}" {val.description}')
+            writer.add_key_value(key, val.value, val.type)
 
-    writer.write_header_to_file()
-    writer.write_kv_data_to_file()
-    writer.write_ti_data_to_file()
+    set_values = {key: val for key, val in writer.kv_data[0].items() if key != gguf.Keys.General.ARCHITECTURE}
 
-    for tensor in reader.tensors:
-        writer.write_tensor_data(tensor.data)
-        bar.update(tensor.n_bytes)
+    for key in remove:
+        logger.debug(f'Removing {key}')
 
-    writer.close()
+    return set_values, [key for key in remove if key not in set_values]
 
 
 def main() -> None:
     tokenizer_metadata = (getattr(gguf.Keys.Tokenizer, n) for n in gguf.Keys.Tokenizer.__dict__.keys() if not n.startswith('_'))
     token_names = dict((n.split('.')[-1][:-len('_token_id')], n) for n in tokenizer_metadata if n.endswith('_token_id'))
 
-    parser = argparse.ArgumentParser(description="Make a copy of a GGUF file with new metadata")
+    parser = argparse.ArgumentParser(description="Make a copy of a GGUF file with new metadata (the output can be the input, to change it in place; an interrupted in-place change leaves the file corrupt)")
     parser.add_argument("input",                                       type=Path, help="GGUF format model input filename")
     parser.add_argument("output",                                      type=Path, help="GGUF format model output filename")
     parser.add_argument("--general-name",                              type=str,  help="The models general.name", metavar='"name"')
@@ -112,6 +85,7 @@ def main() -> None:
     parser.add_argument("--remove-metadata",      action="append",     type=str,  help="Remove metadata (by key name) from output model", metavar='general.url')
     parser.add_argument("--special-token",        action="append",     type=str,  help="Special token by value", nargs=2, metavar=(' | '.join(token_names.keys()), '"<token>"'))
     parser.add_argument("--special-token-by-id",  action="append",     type=str,  help="Special token by id", nargs=2, metavar=(' | '.join(token_names.keys()), '0'))
+    parser.add_argument("--reserve",              type=int, default=0,            help="Bytes of slack to reserve when the file has to be copied, for later in-place changes", metavar='N')
     parser.add_argument("--force",                action="store_true",            help="Bypass warnings without confirmation")
     parser.add_argument("--verbose",              action="store_true",            help="Increase output verbosity")
     args = parser.parse_args(None if len(sys.argv) > 2 else ["--help"])
@@ -153,7 +127,7 @@ def main() -> None:
                 sys.exit(0)
 
     logger.info(f'* Loading: {args.input}')
-    reader = gguf.GGUFReader(args.input, 'r')
+    reader = gguf.GGUFReader(args.input, 'r', lazy=True)
 
     arch = get_field_data(reader, gguf.Keys.General.ARCHITECTURE)
 
@@ -193,14 +167,11 @@ def main() -> None:
             sys.exit(0)
 
     logger.info(f'* Writing: {args.output}')
-    writer = gguf.GGUFWriter(args.output, arch=arch, endianess=reader.endianess)
-
-    alignment = get_field_data(reader, gguf.Keys.General.ALIGNMENT)
-    if alignment is not None:
-        logger.debug(f'Setting custom alignment: {alignment}')
-        writer.data_alignment = alignment
+    set_values, remove = get_metadata_changes(reader, arch, new_metadata, remove_metadata)
+    reader.close()
 
-    copy_with_new_metadata(reader, writer, new_metadata, remove_metadata)
+    if gguf.patch_metadata(args.input, set_values, remove, output=args.output, reserve=args.reserve):
+        logger.info('* Metadata changed in place')
 
 
 if __name__ == '__main__':
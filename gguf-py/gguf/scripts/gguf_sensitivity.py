@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import os
+import re
+import shlex
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+import gguf  # noqa: E402
+from gguf import GGUFReader, ReaderTensor  # noqa: E402
+
+
+logger = logging.getLogger("gguf-sensitivity")
+
+
+DEFAULT_TYPES = "f16,q8_0,q6_k,q5_k,q4_k,q3_k,q2_k"
+
+
+@dataclass
+class TensorSensitivity:
+    name: str
+    # NumPy order
+    shape: tuple[int, ...]
+    # size in the input file
+    nbytes: int
+    # of each candidate type which fits the rows of the tensor, empty for the tensors which are kept as they are
+    errors: list[gguf.QuantErrorStats]
+
+    def quantized_nbytes(self, qtype: gguf.GGMLQuantizationType) -> int:
+        block_size, type_size = gguf.GGML_QUANT_SIZES[qtype]
+        return math.prod(self.shape) // block_size * type_size
+
+
+def parse_size(size: str) -> int:
+    # like --split-max-size of convert_hf_to_gguf.py, e.g. 4.5G, 800M or a number of bytes
+    units = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4}
+    size = size.strip().upper()
+    try:
+        if size[-1:] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size {size!r}, expected a number of bytes with an optional K, M, G or T suffix")
+
+
+def measure_tensor(tensor: ReaderTensor, qtypes: list[gguf.GGMLQuantizationType], imatrix: gguf.IMatrixFile | None, max_rows: int) -> list[gguf.QuantErrorStats]:
+    shape = tuple(reversed(tensor.shape.tolist()))
+    qtypes = [qtype for qtype in qtypes if shape[-1] % gguf.GGML_QUANT_SIZES[qtype][0] == 0]
+    if len(qtypes) == 0:
+        return []
+    qw = imatrix.get(tensor.name, shape) if imatrix is not None else None
+    n_matrices = qw.shape[0] if qw is not None else 1
+
+    # sample the rows evenly, from each matrix, before dequantizing them
+    raw = tensor.data.reshape(n_matrices, -1, tensor.data.shape[-1])
+    if max_rows > 0 and raw.shape[0] * raw.shape[1] > max_rows:
+        step = -(-raw.shape[0] * raw.shape[1] // max_rows)
+        raw = raw[:, ::step]
+    data = gguf.quants.dequantize(np.ascontiguousarray(raw), tensor.tensor_type)
+
+    return [gguf.measure_quant_error(data, qtype, imatrix=qw) for qtype in qtypes]
+
+
+def measure(reader: GGUFReader, qtypes: list[gguf.GGMLQuantizationType], imatrix: gguf.IMatrixFile | None, max_rows: int,
+            n_threads: int | None, show_progress: bool) -> list[TensorSensitivity]:
+    tensors = list(reader.tensors)
+    candidates = [t for t in tensors if gguf.is_quantizable(t.name, tuple(reversed(t.shape.tolist())))]
+    for tensor in candidates:
+        if tensor.tensor_type not in (gguf.GGMLQuantizationType.F32, gguf.GGMLQuantizationType.F16, gguf.GGMLQuantizationType.BF16):
+            logger.warning(f"{tensor.name} is already quantized to {tensor.tensor_type.name}, its errors are relative to that")
+
+    # the tensors are measured in parallel rather than the rows of each one
+    quant_threads = gguf.quants.get_thread_count()
+    gguf.quants.set_thread_count(1)
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="gguf-sensitivity") as executor:
+            futures = {t.name: executor.submit(measure_tensor, t, qtypes, imatrix, max_rows) for t in candidates}
+            bar = tqdm(total=len(futures), desc="Measuring", disable=not show_progress)
+            results: list[TensorSensitivity] = []
+            for tensor in tensors:
+                errors = futures[tensor.name].result() if tensor.name in futures else []
+                if tensor.name in futures:
+                    bar.update(1)
+                results.append(TensorSensitivity(tensor.name, tuple(reversed(tensor.shape.tolist())), int(tensor.n_bytes), errors))
+            bar.close()
+    finally:
+        gguf.quants.set_thread_count(quant_threads)
+    return results
+
+
+def allocate(tensors: list[TensorSensitivity], target_bytes: float | None, target_bytes_per_token: float | None,
+             expert_ratio: float) -> dict[str, gguf.QuantErrorStats]:
+    tied_embeddings = all(t.name != "output.weight" for t in tensors)
+
+    def cost(t: TensorSensitivity, nbytes: int) -> float:
+        if target_bytes_per_token is not None:
+            return gguf.tensor_bytes_per_token(t.name, t.shape, nbytes, expert_ratio, tied_embeddings)
+        return float(nbytes)
+
+    budget = target_bytes_per_token if target_bytes_per_token is not None else target_bytes
+    assert budget is not None
+    # the tensors which are kept as they are still count
+    budget -= sum(cost(t, t.nbytes) for t in tensors if len(t.errors) == 0)
+    candidates = [t for t in tensors if len(t.errors) > 0]
+    # the sum of the relative errors of the tensors is minimized
+    options = [[(cost(t, t.quantized_nbytes(e.qtype)), e.relative_error) for e in t.errors] for t in candidates]
+    choice = gguf.allocate_qtypes(options, budget)
+    return {t.name: t.errors[i] for t, i in zip(candidates, choice)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure the quantization error of each tensor of a GGUF model for each candidate type, "
+                    "then choose the types which minimize the error within a size budget.",
+    )
+    parser.add_argument("model", type=Path, help="GGUF model in F32, F16 or BF16 (e.g. from convert_hf_to_gguf.py --outtype f16)")
+    budget = parser.add_mutually_exclusive_group(required=True)
+    budget.add_argument("--target-size", type=parse_size, help="size of the tensor data, e.g. 4.5G")
+    budget.add_argument("--target-bpw", type=float, help="average bits per weight of the model, e.g. 4.5")
+    budget.add_argument("--target-bytes-per-token", type=parse_size,
+                        help="size of the tensors read to generate one token, e.g. 2G (counts only the used experts and one row of the token embeddings)")
+    parser.add_argument("--types", type=str, default=DEFAULT_TYPES, help=f"comma-separated candidate types (default: {DEFAULT_TYPES})")
+    parser.add_argument("--imatrix", type=Path, help="importance matrix from llama-imatrix, to weigh the errors of each column")
+    parser.add_argument("--max-rows", type=int, default=1024, help="number of rows sampled from each tensor, 0 for all of them (default: 1024)")
+    parser.add_argument("--threads", type=int, help="number of tensors measured at once (default: number of CPUs)")
+    parser.add_argument("--output", type=Path, help="recipe for convert_hf_to_gguf.py --recipe")
+    parser.add_argument("--llama-quantize-args", type=Path,
+                        help="--tensor-type arguments for llama-quantize, e.g. eval llama-quantize $(cat args.txt) model-f16.gguf model.gguf q8_0")
+    parser.add_argument("--metrics", type=Path, help="JSON file with the errors of each tensor for each candidate type")
+    parser.add_argument("--progressbar", action="store_true", help="enable progressbar")
+    parser.add_argument("--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args(None if len(sys.argv) > 1 else ["--help"])
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    try:
+        qtypes = [gguf.parse_qtype(name.strip()) for name in args.types.split(",") if name.strip() != ""]
+    except ValueError as e:
+        parser.error(str(e))
+    for qtype in qtypes:
+        try:
+            gguf.quants.quantize(np.zeros(gguf.GGML_QUANT_SIZES[qtype][0], dtype=np.float32), qtype)
+        except NotImplementedError:
+            parser.error(f"Quantization to {qtype.name} is not implemented in gguf-py")
+
+    reader = GGUFReader(args.model, 'r')
+    imatrix = gguf.IMatrixFile(args.imatrix) if args.imatrix is not None else None
+
+    expert_ratio = 1.0
+    if (arch_field := reader.get_field(gguf.Keys.General.ARCHITECTURE)) is not None:
+        arch = arch_field.contents()
+        expert_count = reader.get_field(gguf.Keys.LLM.EXPERT_COUNT.format(arch=arch))
+        expert_used_count = reader.get_field(gguf.Keys.LLM.EXPERT_USED_COUNT.format(arch=arch))
+        if expert_count is not None and expert_used_count is not None and expert_count.contents() > 0:
+            expert_ratio = expert_used_count.contents() / expert_count.contents()
+
+    tensors = measure(reader, qtypes, imatrix, args.max_rows, args.threads, args.progressbar)
+
+    if args.metrics is not None:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            json.dump({
+                t.name: {
+                    e.qtype.name.lower(): {"bytes": t.quantized_nbytes(e.qtype), "rmse": e.rmse, "snr_db": e.snr_db}
+                    for e in t.errors
+                }
+                for t in tensors if len(t.errors) > 0
+            }, f, indent=2)
+            f.write("\n")
+
+    target_bytes = args.target_size
+    if args.target_bpw is not None:
+        target_bytes = args.target_bpw * sum(math.prod(t.shape) for t in tensors) / 8
+    try:
+        chosen = allocate(tensors, target_bytes, args.target_bytes_per_token, expert_ratio)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    for t in tensors:
+        if t.name in chosen:
+            stats = chosen[t.name]
+            logger.info(f"{t.name:<40} {stats.qtype.name:<6} {t.quantized_nbytes(stats.qtype) / 1e6:>10.2f} MB, SNR {stats.snr_db:6.2f} dB, RMSE {stats.rmse:.3g}")
+    estimate = gguf.SizeEstimate.from_tensors(
+        (t.name, t.shape, t.quantized_nbytes(chosen[t.name].qtype) if t.name in chosen else t.nbytes) for t in tensors
+    )
+    n_params = sum(math.prod(t.shape) for t in tensors)
+    mean_snr = sum(stats.snr_db for stats in chosen.values()) / len(chosen) if len(chosen) > 0 else math.inf
+    logger.info(f"{estimate.total_bytes / 1e6:.2f} MB of tensor data ({estimate.total_bytes * 8 / n_params:.3f} bits per weight), "
+                f"{estimate.bytes_per_token / 1e6:.2f} MB read per generated token, mean SNR {mean_snr:.2f} dB")
+
+    rules = [gguf.QuantRecipeRule((stats.qtype,), pattern=re.compile(f"^{re.escape(name)}$")) for name, stats in chosen.items()]
+    if args.output is not None:
+        gguf.QuantRecipe(rules).save(args.output)
+        logger.info(f"Wrote the recipe of {len(rules)} tensors to {args.output}")
+    if args.llama_quantize_args is not None:
+        with open(args.llama_quantize_args, "w", encoding="utf-8") as f:
+            for rule in rules:
+                assert rule.pattern is not None
+                f.write(f"--tensor-type {shlex.quote(f'{rule.pattern.pattern}={rule.qtypes[0].name.lower()}')}\n")
+        logger.info(f"Wrote the llama-quantize arguments of {len(rules)} tensors to {args.llama_quantize_args}")
+
+
+if __name__ == '__main__':
+    main()
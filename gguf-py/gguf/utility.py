@@ -1,10 +1,27 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Literal
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, ClassVar, Iterable, Literal, Mapping, Sequence
 
+import hashlib
+import logging
 import os
 import json
+import random
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .quants import BF16_BITS
+
+if TYPE_CHECKING:
+    import requests
+
+logger = logging.getLogger(__name__)
 
 
 def fill_templated_filename(filename: str, output_type: str | None) -> str:
@@ -80,9 +97,12 @@ class RemoteTensor:
     offset_start: int
     size: int
     url: str
+    # when set, the data is read through it instead of with a request of its own
+    fetcher: RemoteFetcher | None = field(default=None, repr=False, compare=False)
 
     def data(self) -> bytearray:
-        # TODO: handle request errors (maybe with limited retries?)
+        if self.fetcher is not None:
+            return self.fetcher.read(self.url, self.offset_start, self.size)
         # NOTE: using a bytearray, otherwise PyTorch complains the buffer is not writeable
         data = bytearray(SafetensorRemote.get_data_by_range(url=self.url, start=self.offset_start, size=self.size))
         return data
@@ -262,3 +282,455 @@ class SafetensorRemote:
         if os.environ.get("HF_TOKEN"):
             headers["Authorization"] = f"Bearer {os.environ['HF_TOKEN']}"
         return headers
+
+
+class RemoteFetcher:
+    """
+    Reads ranges of remote files in fixed-size blocks, with parallel range requests over a pooled session.
+
+    Blocks are retried with exponential backoff on connection errors and on 429 and 5xx responses,
+    and are kept in cache_dir when given, so that reading the same files again does not download anything.
+    The cached blocks are keyed by the ETag (or commit) and size of the file, so that a file which changed
+    upstream is downloaded again instead of mixing old and new blocks.
+
+    Once the order in which the tensors will be read is known (see attach), reading a tensor
+    also starts fetching the blocks of the next read_ahead tensors.
+
+    Example:
+        fetcher = RemoteFetcher(max_workers=8, cache_dir="~/.cache/gguf-remote")
+        tensors = fetcher.attach(SafetensorRemote.get_list_tensors_hf_model(model_id))
+        for name, tensor in tensors.items():
+            data = tensor.data()
+    """
+
+    RETRY_STATUS = frozenset((429, 500, 502, 503, 504))
+
+    def __init__(self, max_workers: int = 8, read_ahead: int = 4, block_size: int = 16 * 1024 * 1024,
+                 max_retries: int = 5, backoff: float = 0.5, timeout: float = 60.0,
+                 cache_dir: os.PathLike[str] | str | None = None):
+        import requests
+
+        if block_size <= 0:
+            raise ValueError(f"Invalid block size: {block_size}")
+        self.block_size = block_size
+        self.read_ahead = read_ahead
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir is not None else None
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(SafetensorRemote._get_request_headers())
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="remote-fetch")
+        self._lock = threading.Lock()
+        # blocks being fetched or fetched but still needed by upcoming reads, with the number of these reads
+        self._blocks: dict[tuple[str, int], Future[bytes]] = {}
+        self._block_refs: dict[tuple[str, int], int] = {}
+        # order of the upcoming reads, and those of them whose blocks were already requested
+        self._order: list[tuple[str, int, int]] = []
+        self._position: dict[tuple[str, int, int], int] = {}
+        self._prefetched: set[int] = set()
+        # directory of the cached blocks of each url, None when its version can't be known
+        self._cache_dirs: dict[str, Path | None] = {}
+
+    def close(self) -> None:
+        with self._lock:
+            # the pending requests are not needed anymore (Executor.shutdown(cancel_futures=True) needs Python 3.9)
+            for future in self._blocks.values():
+                future.cancel()
+            self._blocks.clear()
+            self._block_refs.clear()
+            self._prefetched.clear()
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def __enter__(self) -> RemoteFetcher:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def attach(self, tensors: Mapping[str, RemoteTensor]) -> Mapping[str, RemoteTensor]:
+        """Make the tensors read their data through this fetcher, expecting them to be read in this order."""
+        for tensor in tensors.values():
+            tensor.fetcher = self
+        self.schedule((tensor.url, tensor.offset_start, tensor.size) for tensor in tensors.values())
+        return tensors
+
+    def schedule(self, ranges: Iterable[tuple[str, int, int]]) -> None:
+        """Append (url, start, size) ranges to the order of the upcoming reads."""
+        with self._lock:
+            for r in ranges:
+                self._position.setdefault(r, len(self._order))
+                self._order.append(r)
+
+    def _block_indices(self, start: int, size: int) -> range:
+        if size <= 0:
+            return range(0)
+        return range(start // self.block_size, (start + size - 1) // self.block_size + 1)
+
+    def _acquire(self, url: str, start: int, size: int) -> None:
+        # must be called with the lock held
+        for i in self._block_indices(start, size):
+            key = (url, i)
+            self._block_refs[key] = self._block_refs.get(key, 0) + 1
+            if key not in self._blocks:
+                self._blocks[key] = self._executor.submit(self._get_block, url, i)
+
+    def _release(self, url: str, start: int, size: int) -> None:
+        # must be called with the lock held
+        for i in self._block_indices(start, size):
+            key = (url, i)
+            self._block_refs[key] -= 1
+            if self._block_refs[key] == 0:
+                del self._block_refs[key]
+                del self._blocks[key]
+
+    def _release_skipped(self, position: int) -> None:
+        # must be called with the lock held
+        # Reads prefetched well before the current one were most likely skipped (e.g. tensors which are not converted),
+        # so their blocks are not kept until the end. If they are read after all, their blocks are requested again.
+        for skipped in [p for p in self._prefetched if p < position - self.read_ahead]:
+            r = self._order[skipped]
+            if self._position.get(r) == skipped:
+                del self._position[r]
+            self._prefetched.remove(skipped)
+            self._release(*r)
+
+    def _prefetch(self, first: int, last: int) -> None:
+        # must be called with the lock held
+        for position in range(first, min(last, len(self._order))):
+            r = self._order[position]
+            if self._position.get(r) == position and position not in self._prefetched:
+                self._acquire(*r)
+                self._prefetched.add(position)
+
+    def read(self, url: str, start: int, size: int) -> bytearray:
+        """Read size bytes of url at offset start."""
+        r = (url, start, size)
+        with self._lock:
+            position = self._position.pop(r, None)
+            if position is not None and position in self._prefetched:
+                # its blocks were already requested by a previous read
+                self._prefetched.remove(position)
+            else:
+                self._acquire(url, start, size)
+            if position is not None:
+                self._release_skipped(position)
+                self._prefetch(position + 1, position + 1 + self.read_ahead)
+            blocks = [(i, self._blocks[(url, i)]) for i in self._block_indices(start, size)]
+
+        # NOTE: using a bytearray, otherwise PyTorch complains the buffer is not writeable
+        data = bytearray(size)
+        try:
+            for i, future in blocks:
+                block = future.result()
+                block_start = i * self.block_size
+                lo = max(start, block_start)
+                hi = min(start + size, block_start + self.block_size)
+                if block_start + len(block) < hi:
+                    raise ValueError(f"Range {start}-{start + size - 1} is past the end of {url}")
+                data[lo - start:hi - start] = block[lo - block_start:hi - block_start]
+        finally:
+            with self._lock:
+                self._release(url, start, size)
+        return data
+
+    def _cache_path(self, url: str, index: int) -> Path | None:
+        if self.cache_dir is None:
+            return None
+        with self._lock:
+            known = url in self._cache_dirs
+            cache_dir = self._cache_dirs.get(url)
+        if not known:
+            # e.g. resolve/main URLs point to the latest version of the file, so the URL alone is not enough
+            response = self._request("HEAD", url, {})
+            response.raise_for_status()
+            headers = [r.headers for r in response.history] + [response.headers]
+            # on Hugging Face, the first response (before the redirection to the CDN) has the details of the LFS file
+            etag = next((h[k] for h in headers for k in ("X-Linked-Etag", "ETag") if k in h), None)
+            commit = next((h["X-Repo-Commit"] for h in headers if "X-Repo-Commit" in h), None)
+            size = next((h[k] for h in headers for k in ("X-Linked-Size", "Content-Length") if k in h), None)
+            if etag is None and commit is None:
+                logger.warning(f"Not caching the blocks of {url}, its version is unknown")
+                cache_dir = None
+            else:
+                url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+                version_hash = hashlib.sha256(f"{commit}:{etag}:{size}".encode("utf-8")).hexdigest()[:32]
+                cache_dir = self.cache_dir / url_hash / version_hash
+            with self._lock:
+                self._cache_dirs[url] = cache_dir
+        if cache_dir is None:
+            return None
+        return cache_dir / f"{self.block_size}-{index}"
+
+    def _get_block(self, url: str, index: int) -> bytes:
+        cache_path = self._cache_path(url, index)
+        if cache_path is not None and cache_path.is_file():
+            return cache_path.read_bytes()
+
+        data = self._fetch(url, index * self.block_size, self.block_size)
+
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # write then rename, so that an interrupted run never leaves a truncated block
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, cache_path)
+        return data
+
+    def _fetch(self, url: str, start: int, size: int) -> bytes:
+        response = self._request("GET", url, {"Range": f"bytes={start}-{start + size - 1}"})
+        if response.status_code == 416:
+            # the range starts past the end of the file
+            return b""
+        response.raise_for_status()
+        if response.status_code == 206:
+            return response.content
+        # the server ignored the range and sent the whole file
+        return response.content[start:start + size]
+
+    def _request(self, method: str, url: str, headers: dict[str, str]) -> requests.Response:
+        import requests
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, headers=headers, allow_redirects=True, timeout=self.timeout)
+                if response.status_code not in self.RETRY_STATUS:
+                    return response
+                error: Exception = requests.HTTPError(f"{response.status_code} for {url}", response=response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            delay = self.backoff * (2 ** attempt) * (1 + random.random())
+            logger.debug(f"Retrying {method} {headers.get('Range', '')} of {url} in {delay:.1f}s: {error}")
+            time.sleep(delay)
+        raise AssertionError("unreachable")
+
+
+@dataclass
+class LocalTensor:
+    dtype: str
+    shape: tuple[int, ...]
+    # raw little-endian bytes of the tensor, as a view of the memory-mapped file
+    raw: np.ndarray = field(repr=False, compare=False)
+
+    # safetensors dtypes which have a NumPy equivalent
+    # ref: https://github.com/huggingface/safetensors/blob/079781fd0dc455ba0fe851e2b4507c33d0c0d407/bindings/python/src/lib.rs#L1046
+    _dtype_str_map: ClassVar[dict[str, np.dtype[Any]]] = {
+        "F64": np.dtype("<f8"),
+        "F32": np.dtype("<f4"),
+        "F16": np.dtype("<f2"),
+        "U64": np.dtype("<u8"),
+        "I64": np.dtype("<i8"),
+        "U32": np.dtype("<u4"),
+        "I32": np.dtype("<i4"),
+        "U16": np.dtype("<u2"),
+        "I16": np.dtype("<i2"),
+        "U8": np.dtype(np.uint8),
+        "I8": np.dtype(np.int8),
+        "BOOL": np.dtype(np.bool_),
+    }
+
+    # NumPy has no BF16 or F8 types, these are decoded to F32
+    _decoded_dtypes = ("BF16", "F8_E4M3", "F8_E5M2")
+
+    def numpy_dtype(self, raw_bf16: bool = False) -> np.dtype:
+        """dtype of the array returned by numpy()"""
+        if raw_bf16 and self.dtype == "BF16":
+            return BF16_BITS
+        if self.dtype in self._decoded_dtypes:
+            return np.dtype(np.float32)
+        if self.dtype not in self._dtype_str_map:
+            raise ValueError(f"Unsupported safetensors dtype {self.dtype!r}")
+        return self._dtype_str_map[self.dtype]
+
+    def numpy(self, raw_bf16: bool = False) -> np.ndarray:
+        """
+        Get the tensor as a NumPy array.
+
+        For dtypes NumPy has, this is a read-only view of the memory-mapped file (no copy),
+        and BF16 and F8 tensors are decoded to a new F32 array.
+        With raw_bf16, BF16 tensors are instead viewed as their bits, with the BF16_BITS type (see quants.py).
+        """
+        if raw_bf16 and self.dtype == "BF16":
+            data = self.raw.view(BF16_BITS)
+        elif self.dtype == "BF16":
+            # BF16 is the upper half of a F32
+            data = (self.raw.view("<u2").astype(np.uint32) << 16).view(np.float32)
+        elif self.dtype == "F8_E5M2":
+            # F8_E5M2 is the upper half of a F16
+            data = (self.raw.astype(np.uint16) << 8).view(np.float16).astype(np.float32)
+        elif self.dtype == "F8_E4M3":
+            data = _f8_e4m3_table()[self.raw]
+        else:
+            data = self.raw.view(self.numpy_dtype())
+        return data.reshape(self.shape)
+
+
+def _f8_e4m3_table() -> np.ndarray:
+    # F32 value of each of the 256 F8_E4M3 (fn variant: no infinities, only S.1111.111 is NaN) bit patterns
+    global _F8_E4M3_TABLE
+    if _F8_E4M3_TABLE is None:
+        n = np.arange(256, dtype=np.uint8)
+        exp = ((n >> 3) & 0xF).astype(np.int32)
+        mant = (n & 0x7).astype(np.float32)
+        # subnormals when the exponent is 0, with a bias of 7
+        table = np.where(exp == 0, np.ldexp(mant / 8, -6), np.ldexp(1 + mant / 8, exp - 7))
+        table = np.where((n & 0x7F) == 0x7F, np.nan, table)
+        table = np.where(n & 0x80, -table, table)
+        _F8_E4M3_TABLE = table.astype(np.float32)
+    return _F8_E4M3_TABLE
+
+
+_F8_E4M3_TABLE: np.ndarray | None = None
+
+
+class SafetensorsLocal:
+    """
+    Read-only access to a local safetensors file without PyTorch.
+
+    The file is memory-mapped, and the tensors are zero-copy views of the map,
+    so only the pages which are actually read are loaded.
+
+    Example:
+        with SafetensorsLocal("model.safetensors") as st:
+            for name, tensor in st.tensors.items():
+                data = tensor.numpy()
+    """
+
+    def __init__(self, path: os.PathLike[str] | str):
+        self.path = Path(path)
+        self._mmap: np.memmap | None = np.memmap(self.path, dtype=np.uint8, mode="r")
+        self.tensors: dict[str, LocalTensor] = {}
+        self.metadata: dict[str, str] = {}
+
+        # First 8 bytes contain the header length as u64 little-endian
+        if len(self._mmap) < 8:
+            raise ValueError(f"Not enough data to read the header size of {self.path}")
+        header_length = int.from_bytes(self._mmap[:8].tobytes(), byteorder="little")
+        data_start_offset = 8 + header_length
+        if len(self._mmap) < data_start_offset:
+            raise ValueError(f"Could not read the complete header of {self.path}")
+        try:
+            header = json.loads(self._mmap[8:data_start_offset].tobytes().decode("utf-8"))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Failed to parse the safetensors header of {self.path} as JSON: {e}")
+
+        for name, meta in header.items():
+            if name == "__metadata__":
+                self.metadata = meta
+                continue
+            if not isinstance(meta, dict):
+                raise ValueError(f"Invalid metadata for tensor '{name}': {meta}")
+            try:
+                dtype = meta["dtype"]
+                shape = tuple(meta["shape"])
+                offset_start, offset_end = meta["data_offsets"]
+            except KeyError as e:
+                raise ValueError(f"Missing key in metadata for tensor '{name}': {e}, meta = {meta}")
+            if data_start_offset + offset_end > len(self._mmap):
+                raise ValueError(f"Data of tensor '{name}' is past the end of {self.path}")
+            raw = self._mmap[data_start_offset + offset_start:data_start_offset + offset_end]
+            self.tensors[name] = LocalTensor(dtype=dtype, shape=shape, raw=raw)
+
+    def keys(self) -> Iterable[str]:
+        return self.tensors.keys()
+
+    def close(self) -> None:
+        # the tensors keep the map alive for as long as they are used
+        self._mmap = None
+
+    def __enter__(self) -> SafetensorsLocal:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class IMatrixFile:
+    """
+    Importance matrix computed by llama-imatrix, in its binary format (imatrix.dat).
+
+    Each entry is named after the GGUF tensor whose inputs were measured,
+    and has the mean of the squared activations of each of its columns,
+    one matrix after the other for stacked tensors (e.g. for each expert of MoE models).
+    The values are normalized by the number of calls like in llama-quantize.
+
+    Example:
+        imatrix = IMatrixFile("imatrix.dat")
+        data = quantize(data, GGMLQuantizationType.Q4_K, imatrix=imatrix.get(name, data.shape))
+    """
+
+    def __init__(self, path: os.PathLike[str] | str):
+        self.path = Path(path)
+        self.entries: dict[str, np.ndarray] = {}
+        # number of chunks of the dataset the importance matrix was computed on, and the name of that dataset
+        self.chunks_count: int = 0
+        self.dataset: str | None = None
+
+        data = self.path.read_bytes()
+        offset = 0
+
+        def read_i32() -> int:
+            nonlocal offset
+            if offset + 4 > len(data):
+                raise ValueError(f"Unexpected end of {self.path} at offset {offset}")
+            value = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            return value
+
+        def read_str(length: int) -> str:
+            nonlocal offset
+            if length < 0 or offset + length > len(data):
+                raise ValueError(f"Invalid string length {length} in {self.path} at offset {offset}")
+            value = data[offset:offset + length].decode("utf-8", errors="replace")
+            offset += length
+            return value
+
+        n_entries = read_i32()
+        if n_entries < 1:
+            raise ValueError(f"No data in {self.path}")
+        for _ in range(n_entries):
+            name = read_str(read_i32())
+            ncall = read_i32()
+            nval = read_i32()
+            if nval < 1 or offset + nval * 4 > len(data):
+                raise ValueError(f"Invalid number of values ({nval}) for entry {name!r} of {self.path}")
+            values = np.frombuffer(data, dtype="<f4", count=nval, offset=offset).astype(np.float32)
+            offset += nval * 4
+            if ncall > 0:
+                values /= np.float32(ncall)
+            self.entries[name] = values
+
+        # older files end here
+        if offset + 4 <= len(data):
+            self.chunks_count = read_i32()
+            if offset + 4 <= len(data):
+                self.dataset = read_str(read_i32())
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, name: str, shape: Sequence[int]) -> np.ndarray | None:
+        """
+        Importance of the columns of the tensor with the given name and (NumPy) shape,
+        with one row for each matrix of the tensor, or None when the tensor has no entry.
+        """
+        values = self.entries.get(name)
+        if values is None:
+            return None
+        n_matrices = 1
+        for dim in shape[:-2]:
+            n_matrices *= dim
+        if values.size != n_matrices * shape[-1]:
+            raise ValueError(f"imatrix entry {name!r} has {values.size} values, but the tensor with shape {tuple(shape)} needs {n_matrices * shape[-1]}")
+        return values.reshape((n_matrices, shape[-1]))
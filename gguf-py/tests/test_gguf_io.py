@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import hashlib
+import json
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+def make_lazy_tensors(n: int) -> list[tuple[str, gguf.LazyNumpyTensor]]:
+    rng = np.random.default_rng(0)
+    tensors = []
+    for i in range(n):
+        data = gguf.LazyNumpyTensor.from_eager(rng.standard_normal((8 + i, 64), dtype=np.float32))
+        tensors.append((f"blk.{i}.ffn_up.weight", gguf.quants.quantize(data * 2, gguf.GGMLQuantizationType.Q8_0)))
+    return tensors
+
+
+def pack_int4(values: np.ndarray, axis: int, order=tuple(range(8))) -> np.ndarray:
+    # the inverse of gguf.unpack_int4
+    v = np.moveaxis(values.astype(np.uint32), axis, -1)
+    v = v.reshape(*v.shape[:-1], -1, 8)
+    words = np.zeros(v.shape[:-1], dtype=np.uint32)
+    for i, pos in enumerate(order):
+        words |= v[..., pos] << np.uint32(4 * i)
+    return np.ascontiguousarray(np.moveaxis(words, -1, axis)).view(np.int32)
+
+
+class TestGGUFWriter(unittest.TestCase):
+
+    def write_model(self, path: Path, **kwargs) -> None:
+        writer = gguf.GGUFWriter(path, "llama", **kwargs)
+        writer.add_block_count(12)
+        for name, tensor in make_lazy_tensors(12):
+            writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file()
+        writer.close()
+
+    def test_threaded_writing_is_deterministic(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            serial = Path(tmpdir) / "serial.gguf"
+            threaded = Path(tmpdir) / "threaded.gguf"
+            budget = Path(tmpdir) / "budget.gguf"
+            self.write_model(serial)
+            self.write_model(threaded, thread_count=4)
+            # a budget smaller than any tensor still has to make progress
+            self.write_model(budget, thread_count=4, max_mem=1)
+            self.assertEqual(serial.read_bytes(), threaded.read_bytes())
+            self.assertEqual(serial.read_bytes(), budget.read_bytes())
+
+    def test_threaded_writing_evaluates_shared_nodes_once(self):
+        calls = []
+
+        def fused(x: np.ndarray) -> np.ndarray:
+            calls.append(1)
+            return x * 2
+
+        rng = np.random.default_rng(0)
+        source = gguf.LazyNumpyTensor.from_eager(rng.standard_normal((24, 64), dtype=np.float32))
+        qkv = gguf.LazyNumpyTensor(meta=source._meta, args=(source,), func=fused)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = gguf.GGUFWriter(Path(tmpdir) / "split.gguf", "llama", thread_count=3)
+            for i, name in enumerate(("attn_q", "attn_k", "attn_v")):
+                writer.add_tensor(f"blk.0.{name}.weight", qkv[8 * i:8 * (i + 1)])
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_tensors_to_file()
+            writer.close()
+        self.assertEqual(len(calls), 1)
+
+    def test_streaming_writing_matches_buffered(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            buffered = Path(tmpdir) / "buffered.gguf"
+            streamed = Path(tmpdir) / "streamed.gguf"
+            self.write_model(buffered)
+
+            writer = gguf.GGUFWriter(streamed, "llama", streaming=True)
+            writer.add_block_count(12)
+            for name, tensor in make_lazy_tensors(12):
+                writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_ti_data_to_file()
+            tensors = make_lazy_tensors(12)
+            with self.assertRaises(ValueError):
+                # out of order
+                writer.add_tensor(tensors[1][0], tensors[1][1], raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            for name, tensor in tensors:
+                writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            writer.close()
+
+            self.assertEqual(buffered.read_bytes(), streamed.read_bytes())
+
+            reader = gguf.GGUFReader(streamed)
+            self.assertEqual(len(reader.tensors), 12)
+            for rt, (name, tensor) in zip(reader.tensors, make_lazy_tensors(12)):
+                self.assertEqual(rt.name, name)
+                np.testing.assert_array_equal(rt.data, gguf.LazyNumpyTensor.to_eager(tensor))
+
+    def test_pack_arrays(self):
+        tokens = [f"tok{i}" for i in range(50)] + [b"\xff", bytearray(b"ab"), "é✓"]
+        types = [gguf.TokenType.NORMAL, gguf.TokenType.CONTROL, 3]
+        for endianess, prefix in ((gguf.GGUFEndian.LITTLE, "<"), (gguf.GGUFEndian.BIG, ">")):
+            writer = gguf.GGUFWriter(None, "llama", endianess=endianess)
+
+            def packed(val) -> bytes:
+                return bytes(writer._pack_val(val, gguf.GGUFValueType.ARRAY, add_vtype=False))
+
+            def header(ltype: gguf.GGUFValueType, n: int) -> bytes:
+                return struct.pack(f"{prefix}IQ", ltype, n)
+
+            encoded = [t.encode() if isinstance(t, str) else bytes(t) for t in tokens]
+            strings = b"".join(struct.pack(f"{prefix}Q", len(t)) + t for t in encoded)
+            self.assertEqual(packed(tokens), header(gguf.GGUFValueType.STRING, len(tokens)) + strings)
+            self.assertEqual(packed([0.5, -1.25, 3.0]), header(gguf.GGUFValueType.FLOAT32, 3) + struct.pack(f"{prefix}3f", 0.5, -1.25, 3.0))
+            self.assertEqual(packed(types), header(gguf.GGUFValueType.INT32, 3) + struct.pack(f"{prefix}3i", 1, 3, 3))
+            self.assertEqual(packed([True, False]), header(gguf.GGUFValueType.BOOL, 2) + b"\x01\x00")
+            self.assertEqual(packed(np.arange(4, dtype=np.uint64)), header(gguf.GGUFValueType.UINT64, 4) + struct.pack(f"{prefix}4Q", 0, 1, 2, 3))
+            self.assertEqual(packed(np.array([1.5, 2], dtype=">f4")), header(gguf.GGUFValueType.FLOAT32, 2) + struct.pack(f"{prefix}2f", 1.5, 2))
+            self.assertEqual(packed([[1, 2], [3]]), header(gguf.GGUFValueType.ARRAY, 2) + packed([1, 2]) + packed([3]))
+
+            for invalid in ([1, 2.0], [1, True], ["a", 1], [2 ** 31], np.zeros((2, 2), dtype=np.int32), np.zeros(2, dtype=np.float16)):
+                with self.assertRaises((ValueError, OverflowError)):
+                    packed(invalid)
+
+    def test_profiling(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            profiler = gguf.profiling.enable()
+            try:
+                self.write_model(Path(tmpdir) / "profiled.gguf", thread_count=2)
+            finally:
+                gguf.profiling.disable()
+            summary = profiler.summary()
+            for stage in ("materialize", "write", "lazy_compute", "lazy_quantize"):
+                self.assertEqual(summary[stage]["count"], 12)
+            total_bytes = sum(t.nbytes for _, t in make_lazy_tensors(12))
+            self.assertEqual(summary["write"]["nbytes"], total_bytes)
+
+            trace_path = Path(tmpdir) / "trace.json"
+            profiler.write_chrome_trace(trace_path)
+            with open(trace_path, "r", encoding="utf-8") as f:
+                trace = json.load(f)
+            spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+            self.assertEqual(sorted(e["name"] for e in spans if e["cat"] == "write"), sorted(name for name, _ in make_lazy_tensors(12)))
+            self.assertEqual(trace["otherData"]["summary"], json.loads(json.dumps(summary)))
+
+    def test_profiling_nested_args(self):
+        def leaf(value: float) -> gguf.LazyNumpyTensor:
+            meta = gguf.LazyNumpyTensor.meta_with_dtype_and_shape(np.float32, (4,))
+            return gguf.LazyNumpyTensor(meta=meta, args=(value,), func=lambda v: np.full(4, v, dtype=np.float32))
+
+        meta = gguf.LazyNumpyTensor.meta_with_dtype_and_shape(np.float32, (4,))
+        # nodes whose lazy arguments are in a list, or pending, are not leaves
+        summed = gguf.LazyNumpyTensor(meta=meta, args=([leaf(1), leaf(2)],), func=lambda ts: ts[0] + ts[1])
+        pending = gguf.LazyNumpyTensor(meta=meta, args=(gguf.LazyPending([leaf(3)]),), func=lambda p: gguf.LazyNumpyTensor.to_eager(p.tensors[0]))
+        profiler = gguf.profiling.enable()
+        try:
+            eager = gguf.LazyNumpyTensor.to_eager([summed, pending])
+        finally:
+            gguf.profiling.disable()
+        np.testing.assert_array_equal(eager[0] + eager[1], np.full(4, 6, dtype=np.float32))
+        summary = profiler.summary()
+        self.assertEqual(summary["lazy_read"]["count"], 3)
+        self.assertEqual(summary["lazy_compute"]["count"], 2)
+
+
+class TestGGUFReader(unittest.TestCase):
+
+    def test_lazy_reader_matches_eager(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "model.gguf"
+            writer = gguf.GGUFWriter(path, "llama")
+            writer.add_block_count(12)
+            writer.add_token_list([f"tok{i}" for i in range(100)])
+            writer.add_token_scores([float(i) for i in range(100)])
+            writer.add_array("test.nested", [[1, 2], [3]])
+            for name, tensor in make_lazy_tensors(12):
+                writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_tensors_to_file()
+            writer.close()
+
+            eager = gguf.GGUFReader(path)
+            lazy = gguf.GGUFReader(path, lazy=True)
+
+            self.assertEqual(lazy.data_offset, eager.data_offset)
+            self.assertEqual(list(lazy.fields.keys()), list(eager.fields.keys()))
+            for key, field in eager.fields.items():
+                lazy_field = lazy.fields[key]
+                self.assertEqual(lazy_field.offset, field.offset)
+                self.assertEqual(lazy_field.types, field.types)
+                self.assertEqual(lazy_field.data, field.data)
+                self.assertEqual(lazy_field.contents(), field.contents())
+
+            self.assertEqual(len(lazy.tensors), len(eager.tensors))
+            for tensor in eager.tensors:
+                lazy_tensor = lazy.get_tensor_by_name(tensor.name)
+                assert lazy_tensor is not None
+                self.assertEqual(lazy_tensor.data_offset, tensor.data_offset)
+                self.assertEqual(lazy_tensor.tensor_type, tensor.tensor_type)
+                np.testing.assert_array_equal(lazy_tensor.data, tensor.data)
+            self.assertIsNone(lazy.get_tensor_by_name("missing.weight"))
+
+    @unittest.skipUnless(Path("/proc/self/maps").exists(), "needs /proc/self/maps")
+    def test_close_unmaps_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "model.gguf"
+            writer = gguf.GGUFWriter(path, "llama")
+            writer.add_block_count(12)
+            for name, tensor in make_lazy_tensors(2):
+                writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_tensors_to_file()
+            writer.close()
+
+            def is_mapped() -> bool:
+                return str(path) in Path("/proc/self/maps").read_text()
+
+            reader = gguf.GGUFReader(path, lazy=True)
+            self.assertEqual(reader.fields[gguf.Keys.LLM.BLOCK_COUNT.format(arch="llama")].contents(), 12)
+            self.assertTrue(is_mapped())
+            reader.close()
+            self.assertFalse(is_mapped())
+
+    def test_array_fields(self):
+        tokens = [f"tok{i}" for i in range(100)] + ["", "é✓"]
+        scores = [float(i) / 2 for i in range(len(tokens))]
+        for endianess in (gguf.GGUFEndian.LITTLE, gguf.GGUFEndian.BIG):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = Path(tmpdir) / "model.gguf"
+                writer = gguf.GGUFWriter(path, "llama", endianess=endianess)
+                writer.add_token_list(tokens)
+                writer.add_token_scores(scores)
+                writer.add_array("test.nested", [[1, 2], [3]])
+                writer.write_header_to_file()
+                writer.write_kv_data_to_file()
+                writer.write_tensors_to_file()
+                writer.close()
+
+                reader = gguf.GGUFReader(path, "r+")
+                field = reader.fields[gguf.Keys.Tokenizer.LIST]
+                self.assertEqual(field.contents(), tokens)
+                self.assertEqual(field.contents(-1), tokens[-1])
+                self.assertEqual(field.contents(slice(3, 9, 2)), tokens[3:9:2])
+                self.assertEqual(len(field.data), len(tokens))
+                self.assertEqual(len(field.parts), 5 + 2 * len(tokens))
+                self.assertEqual([str(bytes(field.parts[idx]), encoding="utf-8") for idx in field.data], tokens)
+                self.assertEqual([int(field.parts[idx - 1][0]) for idx in field.data], [len(t.encode()) for t in tokens])
+                self.assertEqual(str(bytes(field.parts[-1 - (len(tokens) - 3 - 1) * 2]), encoding="utf-8"), tokens[3])
+
+                field = reader.fields[gguf.Keys.Tokenizer.SCORES]
+                self.assertEqual(field.contents(), scores)
+                self.assertEqual(field.contents(7), scores[7])
+                self.assertEqual([field.parts[idx][0] for idx in field.data], scores)
+                self.assertEqual(len(list(field.parts)), len(field.parts))
+                # parts are still views of the file
+                field.parts[field.data[1]][0] = 42.0
+                self.assertEqual(reader.fields["test.nested"].contents(), [1, 2, 3])
+
+                reader = gguf.GGUFReader(path)
+                self.assertEqual(reader.fields[gguf.Keys.Tokenizer.SCORES].contents(1), 42.0)
+
+    def test_byteswap_tensor_data(self):
+        rng = np.random.default_rng(0)
+        for qtype, (block_size, type_size) in gguf.GGML_QUANT_SIZES.items():
+            self.assertTrue(gguf.quants.can_byteswap(qtype), qtype.name)
+            data = rng.integers(0, 256, (3, 4 * type_size), dtype=np.uint8)
+            swapped = data.copy()
+            gguf.quants.byteswap_tensor_data(swapped, qtype)
+            gguf.quants.byteswap_tensor_data(swapped, qtype)
+            np.testing.assert_array_equal(swapped, data, err_msg=qtype.name)
+
+        data = rng.standard_normal((4, 64)).astype(np.float16)
+        swapped = data.copy()
+        gguf.quants.byteswap_tensor_data(swapped, gguf.GGMLQuantizationType.F16)
+        np.testing.assert_array_equal(swapped, data.byteswap())
+
+        data = gguf.quants.quantize(rng.standard_normal((4, 64), dtype=np.float32), gguf.GGMLQuantizationType.Q8_0)
+        swapped = data.copy()
+        gguf.quants.byteswap_tensor_data(swapped, gguf.GGMLQuantizationType.Q8_0)
+        blocks, swapped_blocks = data.reshape(-1, 34), swapped.reshape(-1, 34)
+        np.testing.assert_array_equal(swapped_blocks[:, :2], blocks[:, 1::-1])
+        np.testing.assert_array_equal(swapped_blocks[:, 2:], blocks[:, 2:])
+
+
+class TestGGUFPatch(unittest.TestCase):
+
+    def write_model(self, path: Path, **kwargs) -> None:
+        writer = gguf.GGUFWriter(path, "llama", **kwargs)
+        writer.add_block_count(12)
+        writer.add_name("model")
+        writer.add_token_list([f"tok{i}" for i in range(100)])
+        for name, tensor in make_lazy_tensors(4):
+            writer.add_tensor(name, tensor, raw_dtype=gguf.GGMLQuantizationType.Q8_0)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file()
+        writer.close()
+
+    def check_model(self, path: Path, name: str, template: str | None) -> None:
+        reader = gguf.GGUFReader(path)
+        self.assertEqual(reader.fields[gguf.Keys.General.NAME].contents(), name)
+        self.assertEqual(reader.fields[gguf.Keys.LLM.BLOCK_COUNT.format(arch="llama")].contents(), 12)
+        self.assertEqual(reader.fields[gguf.Keys.Tokenizer.LIST].contents(), [f"tok{i}" for i in range(100)])
+        if template is None:
+            self.assertNotIn(gguf.Keys.Tokenizer.CHAT_TEMPLATE, reader.fields)
+        else:
+            self.assertEqual(reader.fields[gguf.Keys.Tokenizer.CHAT_TEMPLATE].contents(), template)
+        for rt, (name, tensor) in zip(reader.tensors, make_lazy_tensors(4)):
+            self.assertEqual(rt.name, name)
+            np.testing.assert_array_equal(rt.data, gguf.LazyNumpyTensor.to_eager(tensor))
+
+    def test_patch_metadata(self):
+        template = gguf.GGUFValue("{% for m in messages %}{{ m.content }}{% endfor %}", gguf.GGUFValueType.STRING)
+        name = gguf.GGUFValue("patched", gguf.GGUFValueType.STRING)
+        for endianess in (gguf.GGUFEndian.LITTLE, gguf.GGUFEndian.BIG):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = Path(tmpdir) / "model.gguf"
+                self.write_model(path, endianess=endianess, metadata_reserve=1024)
+                size = path.stat().st_size
+
+                # fits in the reserved slack
+                self.assertTrue(gguf.patch_metadata(path, {gguf.Keys.Tokenizer.CHAT_TEMPLATE: template, gguf.Keys.General.NAME: name}))
+                self.assertEqual(path.stat().st_size, size)
+                self.check_model(path, "patched", template.value)
+
+                self.assertTrue(gguf.patch_metadata(path, remove=[gguf.Keys.Tokenizer.CHAT_TEMPLATE]))
+                self.check_model(path, "patched", None)
+
+                # too big, the file has to be copied
+                big = gguf.GGUFValue("x" * 4096, gguf.GGUFValueType.STRING)
+                self.assertFalse(gguf.patch_metadata(path, {gguf.Keys.Tokenizer.CHAT_TEMPLATE: big}, reserve=64))
+                self.check_model(path, "patched", big.value)
+                self.assertTrue(gguf.patch_metadata(path, {gguf.Keys.Tokenizer.CHAT_TEMPLATE: template}))
+                self.check_model(path, "patched", template.value)
+
+                # to another file
+                copy = Path(tmpdir) / "copy.gguf"
+                self.assertFalse(gguf.patch_metadata(path, {gguf.Keys.General.NAME: gguf.GGUFValue("copy", gguf.GGUFValueType.STRING)}, output=copy))
+                self.check_model(path, "patched", template.value)
+                self.check_model(copy, "copy", template.value)
+
+
+class TestHashing(unittest.TestCase):
+
+    def test_parallel_cached_hashing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "data.bin"
+            data = np.random.default_rng(0).bytes(1 << 20)
+            path.write_bytes(data)
+            ranges = [(0, 1000), (1000, 300000), (300000, 0), (500000, (1 << 20) - 500000)]
+            hashers = {"sha1": hashlib.sha1, "sha256": hashlib.sha256}
+            cache_path = Path(tmpdir) / "cache.json"
+
+            for _ in range(2):
+                # the second pass is answered by the cache
+                cache = gguf.HashCache(cache_path)
+                digests = gguf.hash_ranges(path, ranges, hashers, thread_count=3, cache=cache)
+                concatenated = gguf.hash_concatenated_ranges(path, ranges, hashers, cache=cache)
+                cache.save()
+                for (offset, length), digest in zip(ranges, digests):
+                    self.assertEqual(digest["sha256"], hashlib.sha256(data[offset:offset + length]).hexdigest())
+                    self.assertEqual(digest["sha1"], hashlib.sha1(data[offset:offset + length]).hexdigest())
+                joined = b"".join(data[offset:offset + length] for offset, length in ranges)
+                self.assertEqual(concatenated["sha256"], hashlib.sha256(joined).hexdigest())
+                self.assertEqual(gguf.hash_files([path], hashlib.sha256, "sha256", cache=cache), [hashlib.sha256(data).hexdigest()])
+
+                # both at once, from a single read
+                done: list[int] = []
+                both, both_concatenated = gguf.hash_ranges_and_concatenation(path, ranges, hashers, hashers, thread_count=3, cache=cache, on_done=done.append)
+                self.assertEqual(both, digests)
+                self.assertEqual(both_concatenated, concatenated)
+                self.assertEqual(sorted(done), list(range(len(ranges))))
+                _, uncached = gguf.hash_ranges_and_concatenation(path, ranges, {}, {"md5": hashlib.md5})
+                self.assertEqual(uncached["md5"], hashlib.md5(joined).hexdigest())
+
+            # changing the file invalidates its cached digests
+            path.write_bytes(data[::-1] + b"x")
+            cache = gguf.HashCache(cache_path)
+            self.assertIsNone(cache.get(path, "file:sha256"))
+            self.assertEqual(gguf.hash_files([path], hashlib.sha256, "sha256", cache=cache), [hashlib.sha256(data[::-1] + b"x").hexdigest()])
+
+
+class TestQuantRecipe(unittest.TestCase):
+
+    def test_rules(self):
+        recipe = gguf.QuantRecipe.from_dict({"rules": [
+            {"tensor": ["attn_q", "ATTN_K"], "type": "q8_0"},
+            {"tensor": "output", "type": "f16"},
+            {"pattern": r"ffn_(gate|up|down)", "layers": "0-1,30", "type": "q8_0"},
+            {"pattern": r"ffn_", "type": "q4_k", "fallback": ["q5_0", "q8_0"]},
+        ]})
+        Q = gguf.GGMLQuantizationType
+        self.assertEqual(recipe.qtype_for("blk.3.attn_q.weight", (64, 64)), Q.Q8_0)
+        self.assertEqual(recipe.qtype_for("blk.3.attn_k.weight", (64, 64)), Q.Q8_0)
+        self.assertIsNone(recipe.qtype_for("blk.3.attn_v.weight", (64, 64)))
+        self.assertEqual(recipe.qtype_for("output.weight", (64, 64)), Q.F16)
+        self.assertEqual(recipe.qtype_for("blk.1.ffn_up.weight", (64, 256)), Q.Q8_0)
+        self.assertEqual(recipe.qtype_for("blk.30.ffn_up.weight", (64, 256)), Q.Q8_0)
+        self.assertEqual(recipe.qtype_for("blk.2.ffn_up.weight", (64, 256)), Q.Q4_K)
+        # rows which don't fit Q4_K blocks use the first fallback which fits
+        self.assertEqual(recipe.qtype_for("blk.2.ffn_down.weight", (256, 96)), Q.Q5_0)
+        self.assertEqual(recipe.unused_rules(), [])
+        # the rules can be saved and loaded again
+        self.assertEqual(gguf.QuantRecipe.from_dict(recipe.to_dict()).to_dict(), recipe.to_dict())
+        self.assertEqual(recipe.to_dict()["rules"][2]["layers"], "0-1,30")
+
+        with self.assertRaises(ValueError):
+            gguf.QuantRecipe.from_dict({"rules": [{"pattern": "ffn_", "type": "q4_2"}]})
+        with self.assertRaises(ValueError):
+            gguf.QuantRecipe.from_dict({"rules": [{"tensor": "not_a_tensor", "type": "q8_0"}]})
+
+    def test_size_estimate(self):
+        tensors = [
+            ("token_embd.weight", (1000, 64), 1000 * 68),
+            ("blk.0.attn_q.weight", (64, 64), 64 * 68),
+            ("blk.0.ffn_up_exps.weight", (8, 128, 64), 8 * 128 * 68),
+            ("blk.1.attn_q.weight", (64, 64), 64 * 68),
+            ("output.weight", (1000, 64), 1000 * 68),
+        ]
+        estimate = gguf.SizeEstimate.from_tensors(tensors, expert_count=8, expert_used_count=2)
+        self.assertEqual(estimate.n_tensors, 5)
+        self.assertEqual(estimate.total_bytes, sum(n + (-n % 32) for _, _, n in tensors))
+        self.assertEqual(estimate.layer_bytes, {None: 2 * 1000 * 68, 0: 64 * 68 + 8 * 128 * 68, 1: 64 * 68})
+        # only one row of the embeddings and the used experts are read for each token
+        self.assertEqual(estimate.bytes_per_token, 68 + 2 * 64 * 68 + 2 * 128 * 68 + 1000 * 68)
+
+    def test_quant_error(self):
+        Q = gguf.GGMLQuantizationType
+        rng = np.random.default_rng(0)
+        data = rng.standard_normal((4, 16, 256), dtype=np.float32)
+        errors = [gguf.measure_quant_error(data, qtype) for qtype in (Q.Q8_0, Q.Q4_K, Q.Q2_K)]
+        # fewer bits, more error
+        self.assertGreater(errors[0].snr_db, errors[1].snr_db)
+        self.assertGreater(errors[1].snr_db, errors[2].snr_db)
+        self.assertEqual(errors[0].sum_w, data.size)
+        # the errors of the columns which don't matter are ignored
+        imatrix = np.ones((4, 256), dtype=np.float32)
+        imatrix[:, 128:] = 0
+        weighted = gguf.measure_quant_error(data, Q.Q8_0, imatrix=imatrix)
+        half = gguf.measure_quant_error(np.ascontiguousarray(data[..., :128]), Q.Q8_0)
+        self.assertAlmostEqual(weighted.sum_w, half.sum_w)
+        self.assertAlmostEqual(weighted.sum_x2, half.sum_x2, places=3)
+
+        self.assertTrue(gguf.is_quantizable("blk.0.attn_q.weight", (64, 64)))
+        self.assertFalse(gguf.is_quantizable("blk.0.attn_norm.weight", (64,)))
+        self.assertFalse(gguf.is_quantizable("blk.0.ffn_gate_inp.weight", (8, 64)))
+
+    def test_allocate(self):
+        # (cost, error) of the types of each tensor
+        options = [
+            [(1, 1.0), (2, 0.5), (4, 0.1)],
+            [(1, 1.0), (2, 0.2), (4, 0.15)],
+            [(2, 0.3), (1, 0.3)],
+        ]
+        self.assertEqual(gguf.allocate_qtypes(options, 3), [0, 0, 1])
+        self.assertEqual(gguf.allocate_qtypes(options, 5), [1, 1, 1])
+        self.assertEqual(gguf.allocate_qtypes(options, 7), [2, 1, 1])
+        self.assertEqual(gguf.allocate_qtypes(options, 100), [2, 2, 1])
+        with self.assertRaises(ValueError):
+            gguf.allocate_qtypes(options, 2)
+
+
+class TestPackedInt4(unittest.TestCase):
+    n_in, n_out, group_size = 256, 64, 128
+
+    def make_int4(self, zeros=None):
+        rng = np.random.default_rng(0)
+        n_groups = self.n_in // self.group_size
+        q = rng.integers(0, 16, (self.n_in, self.n_out), dtype=np.uint8)
+        if zeros is None:
+            zeros = rng.integers(0, 16, (n_groups, self.n_out), dtype=np.uint8)
+        scales = rng.uniform(0.001, 0.01, (n_groups, self.n_out)).astype(np.float16)
+        # (n_out, n_in), like the weights of the linear layer
+        expected = ((q.astype(np.float32) - np.repeat(zeros, self.group_size, axis=0)) * np.repeat(scales.astype(np.float32), self.group_size, axis=0)).T
+        return q, zeros, scales, expected
+
+    def test_awq(self):
+        Q = gguf.GGMLQuantizationType
+        q, zeros, scales, expected = self.make_int4()
+        packed = gguf.PackedInt4.from_awq(pack_int4(q, 1, gguf.AWQ_PACK_ORDER), pack_int4(zeros, 1, gguf.AWQ_PACK_ORDER), scales)
+        np.testing.assert_array_equal(packed.dequantize(), expected)
+
+        data = packed.to_q4(Q.Q4_1)
+        self.assertEqual(data.shape, (self.n_out, self.n_in // 32 * 20))
+        # the same 4-bit values, only the minimum of each block is rounded to F16
+        np.testing.assert_allclose(gguf.quants.dequantize(data, Q.Q4_1), expected, rtol=0, atol=float(scales.max()) * 16 * 2**-11)
+        with self.assertRaises(gguf.QuantError):
+            packed.to_q4(Q.Q4_0)
+
+    def test_gptq(self):
+        Q = gguf.GGMLQuantizationType
+        n_groups = self.n_in // self.group_size
+        # symmetric, with zero points of 8 stored as 7
+        q, zeros, scales, expected = self.make_int4(np.full((n_groups, self.n_out), 8, dtype=np.uint8))
+        g_idx = np.arange(self.n_in, dtype=np.int32) // self.group_size
+        packed = gguf.PackedInt4.from_gptq(pack_int4(q, 0), pack_int4(zeros - 1, 1), scales, g_idx)
+        self.assertIsNone(packed.g_idx)
+        # exact with Q4_0
+        np.testing.assert_array_equal(gguf.quants.dequantize(packed.to_q4(Q.Q4_0), Q.Q4_0), expected)
+
+        # with desc_act, the groups are not made of consecutive columns
+        g_idx = np.random.default_rng(0).permutation(g_idx)
+        packed = gguf.PackedInt4.from_gptq(pack_int4(q, 0), pack_int4(zeros - 1, 1), scales, g_idx)
+        self.assertIsNotNone(packed.g_idx)
+        scales_by_col = scales.astype(np.float32)[g_idx].T
+        np.testing.assert_array_equal(packed.dequantize(), (q.T.astype(np.float32) - 8) * scales_by_col)
+        with self.assertRaises(gguf.QuantError):
+            packed.to_q4(Q.Q4_0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+class TestIMatrixFile(unittest.TestCase):
+    def test_read_and_quantize(self):
+        rng = np.random.default_rng(0)
+        entries = {
+            "blk.0.attn_q.weight": (4, rng.random(256, dtype=np.float32)),
+            "blk.0.ffn_up_exps.weight": (2, rng.random(2 * 256, dtype=np.float32)),
+        }
+        content = struct.pack("<i", len(entries))
+        for name, (ncall, values) in entries.items():
+            content += struct.pack("<i", len(name)) + name.encode("utf-8") + struct.pack("<ii", ncall, values.size) + values.tobytes()
+        content += struct.pack("<ii", 100, len("wiki.train")) + b"wiki.train"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "imatrix.dat"
+            path.write_bytes(content)
+            imatrix = gguf.utility.IMatrixFile(path)
+
+        self.assertEqual(len(imatrix), 2)
+        self.assertEqual(imatrix.chunks_count, 100)
+        self.assertEqual(imatrix.dataset, "wiki.train")
+        qw = imatrix.get("blk.0.attn_q.weight", (8, 256))
+        assert qw is not None
+        np.testing.assert_allclose(qw, entries["blk.0.attn_q.weight"][1].reshape((1, 256)) / 4)
+        self.assertIsNone(imatrix.get("output.weight", (8, 256)))
+        with self.assertRaises(ValueError):
+            imatrix.get("blk.0.attn_q.weight", (8, 128))
+        experts = imatrix.get("blk.0.ffn_up_exps.weight", (2, 4, 256))
+        assert experts is not None
+        self.assertEqual(experts.shape, (2, 256))
+
+        data = rng.standard_normal((2, 4, 256), dtype=np.float32)
+        for qtype in (
+            gguf.GGMLQuantizationType.Q4_0, gguf.GGMLQuantizationType.Q4_1,
+            gguf.GGMLQuantizationType.Q5_0, gguf.GGMLQuantizationType.Q5_1,
+            gguf.GGMLQuantizationType.Q2_K, gguf.GGMLQuantizationType.Q3_K, gguf.GGMLQuantizationType.Q4_K,
+            gguf.GGMLQuantizationType.Q5_K, gguf.GGMLQuantizationType.Q6_K, gguf.GGMLQuantizationType.IQ4_NL,
+        ):
+            with self.subTest(qtype=qtype.name):
+                q = gguf.quantize(data, qtype, imatrix=experts)
+                self.assertEqual(q.shape, gguf.quant_shape_to_byte_shape(data.shape, qtype))
+                # the importance is not ignored
+                self.assertFalse(np.array_equal(q, gguf.quantize(data, qtype)))
+                # each expert uses its own importance
+                np.testing.assert_array_equal(q[1], gguf.quantize(data[1], qtype, imatrix=experts[1]))
+                lazy = gguf.quantize(gguf.LazyNumpyTensor.from_eager(data), qtype, imatrix=experts)
+                np.testing.assert_array_equal(gguf.LazyNumpyTensor.to_eager(lazy), q)
+                self.assertTrue(np.isfinite(gguf.dequantize(q, qtype)).all())
+
+        # ignored by the types which don't use it
+        q8_0 = gguf.GGMLQuantizationType.Q8_0
+        np.testing.assert_array_equal(gguf.quantize(data, q8_0, imatrix=experts), gguf.quantize(data, q8_0))
+        with self.assertRaises(ValueError):
+            gguf.quantize(data, q8_0, imatrix=experts[:, :100])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -100,9 +100,11 @@ class GGMLQuants:
             dequant_func(tensor.ctypes.data_as(ctypes.c_void_p), result.ctypes.data_as(c_float_p), result.size)
         return result
 
-    def quantize(self, data: np.ndarray, qtype: GGMLQuantizationType) -> np.ndarray:
+    def quantize(self, data: np.ndarray, qtype: GGMLQuantizationType, imatrix: np.ndarray | None = None) -> np.ndarray:
         result = np.zeros(gguf.quant_shape_to_byte_shape(data.shape, qtype), dtype=np.uint8, order="C")
-        if self.libggml.ggml_quantize_requires_imatrix(qtype.value):
+        if imatrix is not None:
+            qw = imatrix.ctypes.data_as(c_float_p)
+        elif self.libggml.ggml_quantize_requires_imatrix(qtype.value):
             # TODO: is a column-wise sum of squares appropriate?
             qw = np.sum((data * data).reshape((-1, data.shape[-1])), axis=0).ctypes.data_as(c_float_p)
         else:
@@ -146,6 +148,13 @@ def do_test(libggml_path: Path, quick: bool = False):
     np.set_printoptions(precision=None, threshold=(4 * 256) + 1, formatter={"int": lambda n: "0x%02X" % n})
 
     r = np.random.randn(8, 1024, 1024).astype(np.float32, copy=False)
+    qw = np.random.random(r.shape[-1]).astype(np.float32, copy=False)
+    # types whose importance-weighted quantization is the same as in ggml-quants.c
+    imatrix_qtypes = (
+        GGMLQuantizationType.Q4_0, GGMLQuantizationType.Q4_1, GGMLQuantizationType.Q5_0, GGMLQuantizationType.Q5_1,
+        GGMLQuantizationType.Q2_K, GGMLQuantizationType.Q3_K, GGMLQuantizationType.Q4_K, GGMLQuantizationType.Q5_K, GGMLQuantizationType.Q6_K,
+        GGMLQuantizationType.IQ4_NL,
+    )
 
     for qtype in (GGMLQuantizationType.F16, *gguf.quants._type_traits.keys()):
         has_dequantize = False
@@ -192,6 +201,18 @@ def do_test(libggml_path: Path, quick: bool = False):
             else:
                 logger.info(f"Quantization to {qtype.name} matches exactly ✅")
 
+            if qtype in imatrix_qtypes:
+                logger.debug(f"Quantizing to {qtype.name} with an importance matrix with Python")
+                pyq = gguf.quants.quantize(rc, qtype, imatrix=qw)
+
+                logger.debug(f"Quantizing to {qtype.name} with an importance matrix with C")
+                ggq = ggml_quants.quantize(rc, qtype, imatrix=qw)
+
+                if not compare_tensors(pyq, ggq, qtype):
+                    logger.error(f"Quantization to {qtype.name} with an importance matrix does not match ❌")
+                else:
+                    logger.info(f"Quantization to {qtype.name} with an importance matrix matches exactly ✅")
+
         if has_dequantize:
             if ggq is None and not quick:
                 logger.debug(f"Quantizing to {qtype.name} with C")
@@ -230,9 +251,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test Python (de)quantization against the reference C implementation")
     parser.add_argument("--libggml", type=Path, default=Path(__file__).parent.parent.parent / "build" / "ggml" / "src" / "libggml.so", help="The path to libggml.so")
     parser.add_argument("--quick", action="store_true", help="Don't quantize with C when it's not strictly necessary")
+    parser.add_argument("--threads", type=int, default=0, help="Number of threads used by the Python (de)quantization (default: all cores)")
 
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
+    gguf.quants.set_thread_count(args.threads)
+
     do_test(args.libggml, args.quick)
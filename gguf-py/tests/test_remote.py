@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+def make_safetensors(n: int) -> tuple[bytes, dict[str, np.ndarray]]:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.weight": rng.standard_normal((3 + i, 100 * i + 7), dtype=np.float32) for i in range(n)}
+    header: dict = {}
+    offset = 0
+    for name, data in tensors.items():
+        header[name] = {"dtype": "F32", "shape": list(data.shape), "data_offsets": [offset, offset + data.nbytes]}
+        offset += data.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % gguf.utility.SafetensorRemote.ALIGNMENT)
+    content = len(header_bytes).to_bytes(8, "little") + header_bytes + b"".join(t.tobytes() for t in tensors.values())
+    return content, tensors
+
+
+class RangeServer:
+    """Serves a single file with support for byte ranges, failing the first requests when asked to"""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.etag: str | None = '"v1"'
+        self.n_requests = 0
+        self.n_failures = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(server.content)))
+                if server.etag is not None:
+                    self.send_header("ETag", server.etag)
+                self.end_headers()
+
+            def do_GET(self):
+                with server.lock:
+                    server.n_requests += 1
+                    fail = server.n_failures > 0
+                    server.n_failures -= fail
+                if fail:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                m = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+                if m is None:
+                    body, status = server.content, 200
+                else:
+                    start, end = int(m.group(1)), int(m.group(2))
+                    body, status = server.content[start:end + 1], 206
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/model.safetensors"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestRemoteFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.content, self.tensors = make_safetensors(12)
+        self.server = RangeServer(self.content)
+
+    def tearDown(self):
+        self.server.close()
+
+    def read_all(self, fetcher: gguf.utility.RemoteFetcher) -> None:
+        remote_tensors = fetcher.attach(gguf.utility.SafetensorRemote.get_list_tensors(self.server.url))
+        self.assertEqual(list(remote_tensors), list(self.tensors))
+        for name, remote_tensor in remote_tensors.items():
+            data = np.frombuffer(remote_tensor.data(), dtype=np.float32).reshape(remote_tensor.shape)
+            np.testing.assert_array_equal(data, self.tensors[name])
+        # nothing is kept once everything was read
+        self.assertEqual(fetcher._blocks, {})
+
+    def test_parallel_reads(self):
+        with gguf.utility.RemoteFetcher(max_workers=4, read_ahead=3, block_size=1000) as fetcher:
+            self.read_all(fetcher)
+            # reads which were not scheduled, including ranges crossing blocks and the end of the file
+            for start, size in ((0, 8), (999, 2), (len(self.content) - 5, 5), (1234, 0)):
+                self.assertEqual(fetcher.read(self.server.url, start, size), self.content[start:start + size])
+            with self.assertRaises(ValueError):
+                fetcher.read(self.server.url, len(self.content) - 5, 10)
+
+    def test_retry(self):
+        self.server.n_failures = 3
+        with gguf.utility.RemoteFetcher(max_workers=2, block_size=4096, backoff=0.001) as fetcher:
+            self.assertEqual(fetcher.read(self.server.url, 100, 5000), self.content[100:5100])
+        self.server.n_failures = 10
+        with gguf.utility.RemoteFetcher(max_workers=1, block_size=4096, max_retries=2, backoff=0.001) as fetcher:
+            with self.assertRaises(Exception):
+                fetcher.read(self.server.url, 0, 10)
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with gguf.utility.RemoteFetcher(max_workers=4, block_size=2048, cache_dir=cache_dir) as fetcher:
+                self.read_all(fetcher)
+            n_requests = self.server.n_requests
+            with gguf.utility.RemoteFetcher(max_workers=4, block_size=2048, cache_dir=cache_dir) as fetcher:
+                self.read_all(fetcher)
+            # only the metadata was requested again
+            self.assertEqual(self.server.n_requests - n_requests, 1)
+
+            # a new version of the file upstream doesn't reuse the old blocks
+            self.content, self.tensors = make_safetensors(13)
+            self.server.content, self.server.etag = self.content, '"v2"'
+            with gguf.utility.RemoteFetcher(max_workers=4, block_size=2048, cache_dir=cache_dir) as fetcher:
+                self.read_all(fetcher)
+
+    def test_skipped_reads(self):
+        with gguf.utility.RemoteFetcher(max_workers=4, read_ahead=2, block_size=512) as fetcher:
+            remote_tensors = fetcher.attach(gguf.utility.SafetensorRemote.get_list_tensors(self.server.url))
+            for i, (name, remote_tensor) in enumerate(remote_tensors.items()):
+                if 3 <= i < 6:
+                    # e.g. tensors which are not converted
+                    continue
+                data = np.frombuffer(remote_tensor.data(), dtype=np.float32).reshape(remote_tensor.shape)
+                np.testing.assert_array_equal(data, self.tensors[name])
+            # the blocks prefetched for the skipped tensors were released
+            self.assertEqual(fetcher._blocks, {})
+            # and can still be read
+            remote_tensor = remote_tensors["blk.4.weight"]
+            np.testing.assert_array_equal(np.frombuffer(remote_tensor.data(), dtype=np.float32).reshape(remote_tensor.shape), self.tensors["blk.4.weight"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+
+def make_safetensors(raw: dict[str, tuple[str, np.ndarray]]) -> bytes:
+    """The content of a safetensors file with the raw bits of each (dtype, data) tensor"""
+    header: dict = {}
+    offset = 0
+    for name, (dtype, data) in raw.items():
+        header[name] = {"dtype": dtype, "shape": list(data.shape), "data_offsets": [offset, offset + data.nbytes]}
+        offset += data.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    return len(header_bytes).to_bytes(8, "little") + header_bytes + b"".join(data.tobytes() for _, data in raw.values())
+
+
+class TestSafetensorsLocal(unittest.TestCase):
+    def test_read(self):
+        rng = np.random.default_rng(0)
+        tensors = {f"blk.{i}.weight": rng.standard_normal((3 + i, 100 * i + 7), dtype=np.float32) for i in range(5)}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "model.safetensors"
+            path.write_bytes(make_safetensors({name: ("F32", data) for name, data in tensors.items()}))
+            with gguf.utility.SafetensorsLocal(path) as st:
+                self.assertEqual(list(st.keys()), list(tensors.keys()))
+                for name, expected in tensors.items():
+                    data = st.tensors[name].numpy()
+                    self.assertEqual(st.tensors[name].numpy_dtype(), np.float32)
+                    self.assertFalse(data.flags.owndata)
+                    np.testing.assert_array_equal(data, expected)
+
+    def test_decode(self):
+        rng = np.random.default_rng(0)
+        f32 = rng.standard_normal((4, 33), dtype=np.float32)
+        # values which are exact in BF16
+        bf16 = (f32.view(np.uint32) >> 16).astype(np.uint16)
+        f32_exact = (bf16.astype(np.uint32) << 16).view(np.float32)
+        f8_e5m2 = np.arange(256, dtype=np.uint8)
+        f8_e4m3 = np.array([0x00, 0x01, 0x07, 0x08, 0x38, 0x3F, 0x40, 0x7E, 0x7F, 0x80, 0xB8, 0xFE, 0xFF], dtype=np.uint8)
+        raw = {"BF16": bf16, "F8_E5M2": f8_e5m2, "F8_E4M3": f8_e4m3}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "model.safetensors"
+            path.write_bytes(make_safetensors({name: (name, data) for name, data in raw.items()}))
+            with gguf.utility.SafetensorsLocal(path) as st:
+                np.testing.assert_array_equal(st.tensors["BF16"].numpy(), f32_exact)
+                # the bits are kept as-is when written as BF16
+                bf16_bits = st.tensors["BF16"].numpy(raw_bf16=True).T
+                self.assertEqual(bf16_bits.dtype, gguf.BF16_BITS)
+                np.testing.assert_array_equal(gguf.quantize(bf16_bits, gguf.GGMLQuantizationType.BF16).view(np.uint16), bf16.T)
+                np.testing.assert_array_equal(gguf.quantize(bf16_bits, gguf.GGMLQuantizationType.F32), f32_exact.T)
+                # F8_E5M2 has the same layout as the upper half of a F16
+                e5m2 = st.tensors["F8_E5M2"].numpy()
+                np.testing.assert_array_equal(e5m2, (f8_e5m2.astype(np.uint16) << 8).view(np.float16).astype(np.float32))
+                e4m3 = st.tensors["F8_E4M3"].numpy()
+                expected = [0.0, 2.0 ** -9, 7 * 2.0 ** -9, 2.0 ** -6, 1.0, 1.875, 2.0, 448.0, np.nan, -0.0, -1.0, -448.0, np.nan]
+                np.testing.assert_array_equal(e4m3, np.array(expected, dtype=np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
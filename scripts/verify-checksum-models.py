@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import argparse
 import logging
 import os
+import sys
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("verify-checksum-models")
 
@@ -25,6 +28,11 @@ def sha256sum(file):
 # Define the path to the llama directory (parent folder of script directory)
 llama_path = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
 
+parser = argparse.ArgumentParser(description="Verify the checksums of the models listed in SHA256SUMS")
+parser.add_argument("--threads", type=int, help="number of files hashed in parallel (default: number of CPUs)")
+parser.add_argument("--cache", type=str, help="JSON file caching the checksums, reused for the files which did not change since the last run (needs gguf-py)")
+args = parser.parse_args()
+
 # Define the file with the list of hashes and filenames
 hash_list_file = os.path.join(llama_path, "SHA256SUMS")
 
@@ -37,27 +45,34 @@ if not os.path.exists(hash_list_file):
 with open(hash_list_file, "r") as f:
     hash_list = f.read().splitlines()
 
+# Split each line into hash and filename, and get the full path of the file by joining the llama path and the filename
+entries = [line.split("  ") for line in hash_list]
+file_paths = [os.path.join(llama_path, filename) for _, filename in entries]
+existing = [file_path for file_path in file_paths if os.path.exists(file_path)]
+
+# Calculate the SHA256 checksums of the existing files in parallel
+# (hashlib releases the GIL while hashing), optionally reusing those of the unchanged files
+logger.info(f"Verifying the checksums of {len(existing)} files")
+if args.cache is not None:
+    if 'NO_LOCAL_GGUF' not in os.environ:
+        sys.path.insert(1, os.path.join(llama_path, 'gguf-py'))
+    import gguf
+
+    cache = gguf.HashCache(args.cache)
+    file_hashes = dict(zip(existing, gguf.hash_files(existing, hashlib.sha256, "sha256", thread_count=args.threads, cache=cache)))
+    cache.save()
+else:
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        file_hashes = dict(zip(existing, executor.map(sha256sum, existing)))
+
 # Create an array to store the results
 results = []
 
-# Loop over each line in the hash list
-for line in hash_list:
-    # Split the line into hash and filename
-    hash_value, filename = line.split("  ")
-
-    # Get the full path of the file by joining the llama path and the filename
-    file_path = os.path.join(llama_path, filename)
-
-    # Informing user of the progress of the integrity check
-    logger.info(f"Verifying the checksum of {file_path}")
-
+for (hash_value, filename), file_path in zip(entries, file_paths):
     # Check if the file exists
-    if os.path.exists(file_path):
-        # Calculate the SHA256 checksum of the file using hashlib
-        file_hash = sha256sum(file_path)
-
+    if file_path in file_hashes:
         # Compare the file hash with the expected hash
-        if file_hash == hash_value:
+        if file_hashes[file_path] == hash_value:
             valid_checksum = "V"
             file_missing = ""
         else:
@@ -74,7 +89,6 @@ for line in hash_list:
         "file missing": file_missing
     })
 
-
 # Print column headers for results table
 print("filename".ljust(40) + "valid checksum".center(20) + "file missing".center(20)) # noqa: NP100
 print("-" * 80) # noqa: NP100
@@ -10,81 +10,119 @@ import numpy as np
 from transformers import LlamaForCausalLM, LlamaTokenizer
 import os
 import json
-from tqdm import tqdm
 import argparse
+import logging
 
-def get_activation_stats(model, tokenizer, dataset_path=None, n_samples=512, seq_len=128):
+import smoothquant_calibration as calibration
+
+def get_activation_stats(model, tokenizer, dataset_path=None, n_samples=512, seq_len=128,
+                         batch_size=1, percentile=95.0, checkpoint_path=None, text_key="text", seed=0):
     """
     Collect activation statistics for SmoothQuant
     Returns scales for each linear layer
+
+    Calibration uses a .jsonl or plain text dataset when dataset_path is given,
+    random token sequences otherwise. Statistics are streamed (see smoothquant_calibration),
+    and checkpointed to checkpoint_path so that an interrupted run can resume.
     """
     print("🔍 Collecting activation statistics...")
-    
-    # Simple calibration dataset
+
     if dataset_path is None:
         # Use model's own vocabulary as calibration data
         vocab_size = min(len(tokenizer), 32000)
-        calibration_data = []
-        for i in range(n_samples):
-            # Generate random sequences for calibration
-            tokens = torch.randint(1, vocab_size, (seq_len,))
-            calibration_data.append(tokens)
-    
-    activation_scales = {}
-    hooks = []
-    
-    def get_activation_hook(name):
-        def hook(module, input, output):
-            # Collect input activations (before the linear layer)
-            if hasattr(input, '__len__') and len(input) > 0:
-                x = input[0].detach()
-                if len(x.shape) == 3:  # [batch, seq, hidden]
-                    # Calculate per-channel max activation
-                    act_max = x.abs().view(-1, x.shape[-1]).max(dim=0)[0]
-                    
-                    if name not in activation_scales:
-                        activation_scales[name] = []
-                    activation_scales[name].append(act_max.cpu().float())  # Convert to float
-        return hook
-    
-    # Register hooks for all linear layers
-    for name, module in model.named_modules():
-        if isinstance(module, nn.Linear) and 'lm_head' not in name:
-            hook = module.register_forward_hook(get_activation_hook(name))
-            hooks.append(hook)
-    
-    model.eval()
-    with torch.no_grad():
-        for i, tokens in enumerate(tqdm(calibration_data[:n_samples//4], desc="Calibrating")):
-            try:
-                tokens = tokens.unsqueeze(0).to(model.device)
-                model(tokens)
-                if i > 0 and i % 10 == 0:
-                    torch.cuda.empty_cache()  # Clear GPU memory
-            except Exception as e:
-                print(f"⚠️  Error in calibration sample {i}: {e}")
-                continue
-    
-    # Remove hooks
-    for hook in hooks:
-        hook.remove()
-    
-    # Calculate final scales (95th percentile)
-    final_scales = {}
-    for name, scales in activation_scales.items():
-        if scales:
-            all_scales = torch.stack(scales).float()  # Ensure float dtype
-            # Use 95th percentile for robustness
-            scale = torch.quantile(all_scales, 0.95, dim=0)
-            final_scales[name] = scale
-            print(f"📊 {name}: scale range [{scale.min():.4f}, {scale.max():.4f}]")
-    
+        samples = calibration.random_samples(vocab_size, seq_len, n_samples, seed=seed)
+        source = {"dataset": None, "seed": seed}
+    else:
+        texts = calibration.load_texts(dataset_path, text_key=text_key)
+        samples = calibration.text_samples(tokenizer, texts, seq_len, n_samples)
+        source = {"dataset": os.path.abspath(dataset_path), "text_key": text_key}
+
+    final_scales = calibration.calibrate(
+        model, samples, n_samples,
+        batch_size=batch_size,
+        percentile=percentile,
+        checkpoint_path=checkpoint_path,
+        config=dict(source, seq_len=seq_len),
+    )
+
+    for name, scale in final_scales.items():
+        print(f"📊 {name}: scale range [{scale.min():.4f}, {scale.max():.4f}]")
+
     return final_scales
 
+def get_smoothing_groups(model):
+    """
+    Find the linear layers sharing an input, with the RMSNorm producing that input
+    Returns a list of (norm_name, norm, [(linear_name, linear), ...])
+    """
+    groups = []
+    for name, module in model.named_modules():
+        attn = getattr(module, "self_attn", None)
+        mlp = getattr(module, "mlp", None)
+        if attn is None or mlp is None:
+            continue
+        prefix = f"{name}." if name else ""
+        if hasattr(module, "input_layernorm"):
+            groups.append((f"{prefix}input_layernorm", module.input_layernorm, [
+                (f"{prefix}self_attn.{proj}", getattr(attn, proj)) for proj in ("q_proj", "k_proj", "v_proj")
+            ]))
+        if hasattr(module, "post_attention_layernorm"):
+            groups.append((f"{prefix}post_attention_layernorm", module.post_attention_layernorm, [
+                (f"{prefix}mlp.{proj}", getattr(mlp, proj)) for proj in ("gate_proj", "up_proj")
+            ]))
+    return groups
+
+def apply_grouped_smoothquant(model, activation_scales, alpha=0.5):
+    """
+    Apply SmoothQuant with one scale per group of linear layers sharing an input
+    (Q/K/V and gate/up), folding 1/s into the preceding RMSNorm weight
+
+    X @ W.T == (X / s) @ (W * s).T, and X / s is what the scaled norm now outputs,
+    so the model output is unchanged and no extra per-token multiply is needed at runtime
+    """
+    print(f"🔧 Applying grouped SmoothQuant with alpha={alpha}...")
+
+    scale_dict = {}
+
+    for norm_name, norm, linears in get_smoothing_groups(model):
+        names = [name for name, _ in linears]
+        if not all(name in activation_scales for name in names):
+            print(f"⚠️  Skipping {norm_name}: missing activation statistics")
+            continue
+
+        device = norm.weight.device
+        with torch.no_grad():
+            # All members see the same input, so their statistics should match
+            act_scales = torch.stack([activation_scales[name].to(device).float() for name in names]).amax(dim=0)
+            weight_scales = torch.stack([
+                linear.weight.abs().max(dim=0)[0].to(device).float() for _, linear in linears
+            ]).amax(dim=0)
+
+            # Avoid division by zero
+            act_scales = torch.clamp(act_scales, min=1e-5)
+            weight_scales = torch.clamp(weight_scales, min=1e-5)
+
+            smooth_scales = (act_scales ** alpha) / (weight_scales ** (1 - alpha))
+
+            # Work in float32 then convert back
+            norm.weight.data = (norm.weight.data.float() / smooth_scales).to(norm.weight.dtype)
+            for _, linear in linears:
+                s = smooth_scales.to(linear.weight.device)
+                linear.weight.data = (linear.weight.data.float() * s.unsqueeze(0)).to(linear.weight.dtype)
+
+        for name in names:
+            scale_dict[name] = smooth_scales.cpu()
+
+        print(f"✅ Applied SmoothQuant to {', '.join(names)} (folded into {norm_name}), scale range: [{smooth_scales.min():.4f}, {smooth_scales.max():.4f}]")
+
+    return scale_dict
+
 def apply_smoothquant(model, activation_scales, alpha=0.5):
     """
     Apply SmoothQuant scaling to the model
     alpha: smoothing factor (0.5 is good default)
+    Each linear layer is scaled independently, see apply_grouped_smoothquant
+    for scales shared between layers and folded into the preceding norms
     """
     print(f"🔧 Applying SmoothQuant with alpha={alpha}...")
     
@@ -120,12 +158,18 @@ def apply_smoothquant(model, activation_scales, alpha=0.5):
     
     return scale_dict
 
-def save_smoothquant_model(model, tokenizer, scales, output_dir):
-    """Save the SmoothQuant processed model"""
+def save_smoothquant_model(model, tokenizer, scales, output_dir, alpha, folded):
+    """
+    Save the SmoothQuant processed model
+    folded: whether the scales are folded into the RMSNorms (grouped mode), in which case
+    the model needs nothing else at runtime; this is recorded in config.json for convert_hf_to_gguf.py
+    """
     print(f"💾 Saving model to {output_dir}...")
     
     os.makedirs(output_dir, exist_ok=True)
     
+    model.config.smoothquant = {"alpha": alpha, "folded": folded}
+
     # Save model and tokenizer
     model.save_pretrained(output_dir, safe_serialization=True, max_shard_size="2GB")
     tokenizer.save_pretrained(output_dir)
@@ -153,8 +197,25 @@ def main():
                        help='SmoothQuant alpha parameter (default: 0.5)')
     parser.add_argument('--n_samples', type=int, default=64,
                        help='Number of calibration samples (default: 64)')
+    parser.add_argument('--dataset', type=str, default=None,
+                       help='Calibration dataset, .jsonl or plain text (default: random tokens)')
+    parser.add_argument('--text_key', type=str, default='text',
+                       help='Key of the text in .jsonl records (default: text)')
+    parser.add_argument('--seq_len', type=int, default=128,
+                       help='Tokens per calibration sample (default: 128)')
+    parser.add_argument('--batch_size', type=int, default=1,
+                       help='Calibration samples per forward pass (default: 1)')
+    parser.add_argument('--percentile', type=float, default=95.0,
+                       help='Percentile of the per-sample channel maxima, 100 for the max (default: 95)')
+    parser.add_argument('--independent', action='store_true',
+                       help='Scale each linear layer on its own instead of sharing scales per input '
+                            'and folding them into the RMSNorms')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                       help='Save calibration statistics here, and resume from it if it exists')
     
     args = parser.parse_args()
+    # Show the progress messages of the calibration module along with ours
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     
     print("🚀 Starting SmoothQuant for Llama-2-7B")
     print(f"📍 Model path: {args.model_path}")
@@ -185,14 +246,24 @@ def main():
     
     # Collect activation statistics
     activation_scales = get_activation_stats(
-        model, tokenizer, n_samples=args.n_samples
+        model, tokenizer,
+        dataset_path=args.dataset,
+        n_samples=args.n_samples,
+        seq_len=args.seq_len,
+        batch_size=args.batch_size,
+        percentile=args.percentile,
+        checkpoint_path=args.checkpoint,
+        text_key=args.text_key,
     )
     
     # Apply SmoothQuant
-    smooth_scales = apply_smoothquant(model, activation_scales, alpha=args.alpha)
+    if args.independent:
+        smooth_scales = apply_smoothquant(model, activation_scales, alpha=args.alpha)
+    else:
+        smooth_scales = apply_grouped_smoothquant(model, activation_scales, alpha=args.alpha)
     
     # Save the processed model
-    save_smoothquant_model(model, tokenizer, smooth_scales, args.output_path)
+    save_smoothquant_model(model, tokenizer, smooth_scales, args.output_path, alpha=args.alpha, folded=not args.independent)
     
     print("🎉 SmoothQuant application completed!")
     print(f"📂 Output model saved to: {args.output_path}")
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+SmoothQuant calibration engine
+Collects per-channel activation statistics of every nn.Linear input with
+streaming estimators, so that memory does not grow with the number of samples
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
+
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+logger = logging.getLogger("smoothquant-calibration")
+
+
+class RunningMax:
+    """Per-channel maximum over all the samples seen so far"""
+
+    def __init__(self, n_channels):
+        self.value = torch.zeros(n_channels, dtype=torch.float32)
+
+    def update(self, x):
+        # x: [n_samples, n_channels], one row of per-channel absolute maxima per sample
+        self.value = torch.maximum(self.value, x.amax(dim=0))
+
+    def result(self):
+        return self.value.clone()
+
+    def state_dict(self):
+        return {"value": self.value}
+
+    def load_state_dict(self, state):
+        self.value = state["value"].float()
+
+
+class StreamingQuantile:
+    """
+    Exact per-channel quantile over a known number of samples
+    Only the largest values which can still be part of the result are kept,
+    which is a small fraction of the samples for high quantiles
+    """
+
+    def __init__(self, n_channels, q, n_total):
+        if not 0.0 <= q <= 1.0:
+            raise ValueError(f"quantile must be in [0, 1], got {q}")
+        if n_total < 1:
+            raise ValueError(f"need at least one sample, got {n_total}")
+        self.q = q
+        self.n_total = n_total
+        self.n_seen = 0
+        # Same interpolation as torch.quantile: between ascending ranks floor(pos) and ceil(pos)
+        pos = q * (n_total - 1)
+        self.k = n_total - math.floor(pos)
+        self.top = torch.empty((0, n_channels), dtype=torch.float32)
+
+    def update(self, x):
+        self.n_seen += x.shape[0]
+        if self.n_seen > self.n_total:
+            raise ValueError(f"got more than the expected {self.n_total} samples")
+        top = torch.cat([self.top, x.float()], dim=0)
+        if top.shape[0] > self.k:
+            top = top.topk(self.k, dim=0).values
+        self.top = top
+
+    def result(self):
+        if self.n_seen == 0:
+            raise ValueError("no samples seen")
+        # Finalize over the samples actually seen (e.g. a dataset shorter than requested)
+        n = self.n_seen
+        pos = self.q * (n - 1)
+        lo, frac = math.floor(pos), pos - math.floor(pos)
+        desc = self.top.sort(dim=0, descending=True).values
+        last = desc.shape[0] - 1
+        v_lo = desc[min(n - 1 - lo, last)]
+        v_hi = desc[min(max(n - 2 - lo, 0), last)]
+        return v_lo + (v_hi - v_lo) * frac
+
+    def state_dict(self):
+        return {"q": self.q, "n_total": self.n_total, "n_seen": self.n_seen, "top": self.top}
+
+    def load_state_dict(self, state):
+        if state["q"] != self.q or state["n_total"] != self.n_total:
+            raise ValueError("checkpoint was made with a different quantile or sample count")
+        self.n_seen = state["n_seen"]
+        self.top = state["top"].float()
+
+
+Estimator = Union[RunningMax, StreamingQuantile]
+
+
+def make_estimator_factory(percentile, n_total) -> Callable[[int], Estimator]:
+    """percentile is in [0, 100]; None or 100 means a running max"""
+    if percentile is None or percentile >= 100:
+        return lambda n_channels: RunningMax(n_channels)
+    return lambda n_channels: StreamingQuantile(n_channels, percentile / 100.0, n_total)
+
+
+def load_texts(dataset_path, text_key="text"):
+    """
+    Read calibration documents from a .jsonl file (one object per line, text in text_key)
+    or from a plain text file (documents separated by blank lines)
+    """
+    path = Path(dataset_path)
+    if path.suffix in (".jsonl", ".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    yield record
+                elif text_key in record:
+                    yield record[text_key]
+                else:
+                    raise KeyError(f"{path}:{line_no}: no {text_key!r} key in record")
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            doc = []
+            for line in f:
+                if line.strip():
+                    doc.append(line)
+                elif doc:
+                    yield "".join(doc)
+                    doc = []
+            if doc:
+                yield "".join(doc)
+
+
+def text_samples(tokenizer, texts, seq_len, n_samples, tokenize_batch_size=64):
+    """
+    Tokenize documents in batches, concatenate them (separated by EOS)
+    and cut the token stream into windows of seq_len tokens
+    """
+    eos = [tokenizer.eos_token_id] if tokenizer.eos_token_id is not None else []
+    buffer = []
+    produced = 0
+    texts = iter(texts)
+    while produced < n_samples:
+        batch = [t for _, t in zip(range(tokenize_batch_size), texts)]
+        if not batch:
+            break
+        for ids in tokenizer(batch, add_special_tokens=False)["input_ids"]:
+            buffer.extend(ids)
+            buffer.extend(eos)
+        while len(buffer) >= seq_len and produced < n_samples:
+            yield torch.tensor(buffer[:seq_len], dtype=torch.long)
+            del buffer[:seq_len]
+            produced += 1
+    if produced < n_samples:
+        logger.warning(f"⚠️  Dataset only has enough tokens for {produced} of {n_samples} samples")
+
+
+def random_samples(vocab_size, seq_len, n_samples, seed=0):
+    """Random token sequences, reproducible so that a resumed run sees the same samples"""
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(n_samples):
+        yield torch.randint(1, vocab_size, (seq_len,), generator=generator)
+
+
+def batched(samples: Iterable[torch.Tensor], batch_size: int) -> Iterator[torch.Tensor]:
+    batch = []
+    for sample in samples:
+        batch.append(sample)
+        if len(batch) == batch_size:
+            yield torch.stack(batch)
+            batch = []
+    if batch:
+        yield torch.stack(batch)
+
+
+def default_layer_filter(name, module):
+    return isinstance(module, nn.Linear) and "lm_head" not in name
+
+
+class ActivationCollector:
+    """Hooks the inputs of the selected layers and feeds per-sample channel maxima to one estimator per layer"""
+
+    def __init__(self, model, estimator_factory: Callable[[int], Estimator], layer_filter=default_layer_filter):
+        self.model = model
+        self.estimator_factory = estimator_factory
+        self.layer_filter = layer_filter
+        self.estimators: dict[str, Estimator] = {}
+        self.n_seen = 0
+        self.hooks: list[torch.utils.hooks.RemovableHandle] = []
+
+    def _hook(self, name):
+        def hook(module, inputs, output):
+            if not inputs:
+                return
+            x = inputs[0].detach()
+            if x.dim() < 2:
+                return
+            # [batch, ..., hidden] -> [batch, hidden]
+            act_max = x.abs().reshape(x.shape[0], -1, x.shape[-1]).amax(dim=1).float().cpu()
+            estimator = self.estimators.get(name)
+            if estimator is None:
+                estimator = self.estimators[name] = self.estimator_factory(x.shape[-1])
+            estimator.update(act_max)
+        return hook
+
+    def __enter__(self):
+        for name, module in self.model.named_modules():
+            if self.layer_filter(name, module):
+                self.hooks.append(module.register_forward_hook(self._hook(name)))
+        return self
+
+    def __exit__(self, *args):
+        for hook in self.hooks:
+            hook.remove()
+        self.hooks = []
+
+    def results(self):
+        return {name: estimator.result() for name, estimator in self.estimators.items()}
+
+    def state_dict(self):
+        return {
+            "n_seen": self.n_seen,
+            "estimators": {name: est.state_dict() for name, est in self.estimators.items()},
+        }
+
+    def load_state_dict(self, state):
+        self.n_seen = state["n_seen"]
+        self.estimators = {}
+        for name, est_state in state["estimators"].items():
+            n_channels = (est_state["top"] if "top" in est_state else est_state["value"]).shape[-1]
+            estimator = self.estimator_factory(n_channels)
+            estimator.load_state_dict(est_state)
+            self.estimators[name] = estimator
+
+    def save_checkpoint(self, path, config):
+        # Write then rename, so that an interruption never leaves a truncated checkpoint
+        tmp_path = f"{path}.tmp"
+        torch.save({"config": config, "state": self.state_dict()}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path, config):
+        checkpoint = torch.load(path, map_location="cpu")
+        if checkpoint["config"] != config:
+            raise ValueError(f"checkpoint {path} was made with a different configuration: {checkpoint['config']}")
+        self.load_state_dict(checkpoint["state"])
+
+
+def calibrate(model, samples, n_samples, batch_size=1, percentile=95.0,
+              checkpoint_path=None, checkpoint_every=16, config=None,
+              layer_filter=default_layer_filter):
+    """
+    Run the calibration samples through the model in batches and return
+    the per-channel activation scale of every hooked layer input
+
+    With checkpoint_path, the statistics are saved every checkpoint_every batches
+    and an existing checkpoint is resumed, skipping the samples it already covers.
+    samples must then yield the same sequence on every run.
+    """
+    collector = ActivationCollector(model, make_estimator_factory(percentile, n_samples), layer_filter)
+    config = dict(config or {}, n_samples=n_samples, percentile=percentile)
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        collector.load_checkpoint(checkpoint_path, config)
+        logger.info(f"♻️  Resuming calibration from {checkpoint_path} after {collector.n_seen} samples")
+
+    samples = iter(samples)
+    # Skip what the checkpoint already covers
+    for _ in range(collector.n_seen):
+        next(samples, None)
+
+    device = next(model.parameters()).device
+    model.eval()
+    progress = tqdm(total=n_samples, initial=collector.n_seen, desc="Calibrating")
+    with torch.no_grad(), collector:
+        for i, batch in enumerate(batched(samples, batch_size)):
+            batch = batch[:n_samples - collector.n_seen]
+            if len(batch) == 0:
+                break
+            model(batch.to(device))
+            collector.n_seen += len(batch)
+            progress.update(len(batch))
+            if checkpoint_path is not None and (i + 1) % checkpoint_every == 0:
+                collector.save_checkpoint(checkpoint_path, config)
+            if collector.n_seen >= n_samples:
+                break
+    progress.close()
+
+    if checkpoint_path is not None:
+        collector.save_checkpoint(checkpoint_path, config)
+    if collector.n_seen == 0:
+        raise ValueError("no calibration samples were processed")
+
+    return collector.results()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# End-to-end tests of convert_hf_to_gguf.py on tiny checkpoints.
+# Run with: python -m pytest tests/test_convert_hf_to_gguf.py (or python tests/test_convert_hf_to_gguf.py)
+
+from __future__ import annotations
+
+import json
+import tempfile
+import unittest
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+import torch
+from safetensors.torch import save_file
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+if "NO_LOCAL_GGUF" not in os.environ:
+    sys.path.insert(1, str(Path(__file__).parent.parent / 'gguf-py'))
+
+import gguf  # noqa: E402
+import convert_hf_to_gguf  # noqa: E402
+
+
+GROUP_SIZE = 32
+
+
+def pack_int4(values: np.ndarray, axis: int, order=tuple(range(8))) -> np.ndarray:
+    # the inverse of gguf.unpack_int4
+    v = np.moveaxis(values.astype(np.uint32), axis, -1)
+    v = v.reshape(*v.shape[:-1], -1, 8)
+    words = np.zeros(v.shape[:-1], dtype=np.uint32)
+    for i, pos in enumerate(order):
+        words |= v[..., pos] << np.uint32(4 * i)
+    return np.ascontiguousarray(np.moveaxis(words, -1, axis)).view(np.int32)
+
+
+def make_checkpoints(dir_model: Path, arch: str, quant_method: str) -> Path:
+    """A tiny 4-bit checkpoint in dir_model / quant_method, and the same weights dequantized in dir_model / "ref"."""
+    hparams = {
+        "architectures": [arch], "model_type": "llama" if arch == "LlamaForCausalLM" else "qwen2",
+        "hidden_size": 64, "intermediate_size": 128, "num_hidden_layers": 1,
+        "num_attention_heads": 4, "num_key_value_heads": 2, "vocab_size": 32,
+        "max_position_embeddings": 64, "rms_norm_eps": 1e-6, "rope_theta": 10000.0, "tie_word_embeddings": False,
+    }
+    rng = np.random.default_rng(0)
+    shapes = {
+        "self_attn.q_proj": (64, 64), "self_attn.k_proj": (32, 64), "self_attn.v_proj": (32, 64), "self_attn.o_proj": (64, 64),
+        "mlp.gate_proj": (128, 64), "mlp.up_proj": (128, 64), "mlp.down_proj": (64, 128),
+    }
+    ref: dict[str, torch.Tensor] = {
+        "model.embed_tokens.weight": torch.from_numpy(rng.standard_normal((32, 64), dtype=np.float32)),
+        "model.norm.weight": torch.ones(64),
+        "lm_head.weight": torch.from_numpy(rng.standard_normal((32, 64), dtype=np.float32)),
+        "model.layers.0.input_layernorm.weight": torch.ones(64),
+        "model.layers.0.post_attention_layernorm.weight": torch.ones(64),
+    }
+    quantized = dict(ref)
+    for layer, (n_out, n_in) in shapes.items():
+        name = f"model.layers.0.{layer}"
+        q = rng.integers(0, 16, (n_out, n_in), dtype=np.uint8)
+        scales = rng.uniform(0.005, 0.02, (n_out, n_in // GROUP_SIZE)).astype(np.float16)
+        if quant_method == "awq":
+            zeros = rng.integers(0, 16, scales.shape, dtype=np.uint8)
+            quantized[name + ".qweight"] = torch.from_numpy(pack_int4(q.T, 1, gguf.AWQ_PACK_ORDER))
+            quantized[name + ".qzeros"] = torch.from_numpy(pack_int4(zeros.T, 1, gguf.AWQ_PACK_ORDER))
+        else:
+            # symmetric, stored with the offset of 1 of the original GPTQ format
+            zeros = np.full(scales.shape, 8, dtype=np.uint8)
+            quantized[name + ".qweight"] = torch.from_numpy(pack_int4(q.T, 0))
+            quantized[name + ".qzeros"] = torch.from_numpy(pack_int4((zeros - 1).T, 1))
+            quantized[name + ".g_idx"] = torch.arange(n_in, dtype=torch.int32) // GROUP_SIZE
+        quantized[name + ".scales"] = torch.from_numpy(np.ascontiguousarray(scales.T))
+        deq = (q.astype(np.float32) - np.repeat(zeros, GROUP_SIZE, 1)) * np.repeat(scales.astype(np.float32), GROUP_SIZE, 1)
+        ref[name + ".weight"] = torch.from_numpy(deq)
+
+    quant_config = {"quant_method": "awq", "bits": 4, "group_size": GROUP_SIZE, "zero_point": True, "version": "gemm"} if quant_method == "awq" else \
+        {"quant_method": "gptq", "bits": 4, "group_size": GROUP_SIZE, "desc_act": False, "sym": True, "checkpoint_format": "gptq"}
+    for subdir, tensors, config in ((quant_method, quantized, {**hparams, "quantization_config": quant_config}), ("ref", ref, hparams)):
+        (dir_model / subdir).mkdir()
+        save_file(tensors, str(dir_model / subdir / "model.safetensors"), metadata={"format": "pt"})
+        with open(dir_model / subdir / "config.json", "w", encoding="utf-8") as f:
+            json.dump(config, f)
+    return dir_model / quant_method
+
+
+def convert(dir_model: Path, arch: str) -> dict[str, tuple[gguf.GGMLQuantizationType, np.ndarray]]:
+    """The type and data of the tensors of a lazy conversion to F32, without writing them."""
+    model_class = convert_hf_to_gguf.ModelBase.from_model_architecture(arch)
+    model = model_class(dir_model, gguf.LlamaFileType.ALL_F32, dir_model / "model.gguf", eager=False)
+    model.prepare_tensors()
+    return {
+        name: (ti.dtype, gguf.LazyNumpyTensor.to_eager(ti.tensor))
+        for tensors in model.gguf_writer.tensors for name, ti in tensors.items()
+    }
+
+
+class TestConvertInt4(unittest.TestCase):
+    def test_lazy_conversion(self):
+        # Llama is read as NumPy arrays, and Qwen2 as PyTorch tensors
+        for arch in ("LlamaForCausalLM", "Qwen2ForCausalLM"):
+            for quant_method, qtype in (("awq", gguf.GGMLQuantizationType.Q4_1), ("gptq", gguf.GGMLQuantizationType.Q4_0)):
+                with self.subTest(arch=arch, quant_method=quant_method), tempfile.TemporaryDirectory() as tmp:
+                    dir_model = make_checkpoints(Path(tmp), arch, quant_method)
+                    tensors = convert(dir_model, arch)
+                    ref_tensors = convert(Path(tmp) / "ref", arch)
+                    self.assertEqual(tensors.keys(), ref_tensors.keys())
+                    for name, (ref_qtype, ref_data) in ref_tensors.items():
+                        data_qtype, data = tensors[name]
+                        if name.startswith("blk.") and not name.endswith("_norm.weight"):
+                            # transcoded as-is, including through the permutations of modify_tensors
+                            self.assertEqual(data_qtype, qtype, name)
+                            data = gguf.dequantize(data, qtype)
+                            # exact with Q4_0, while the minimums of Q4_1 (zero point times scale) are rounded to F16
+                            atol = 0 if qtype == gguf.GGMLQuantizationType.Q4_0 else 15 * 0.02 * 2 ** -11
+                            np.testing.assert_allclose(data, ref_data, rtol=0, atol=atol, err_msg=name)
+                        else:
+                            self.assertEqual(data_qtype, ref_qtype, name)
+                            np.testing.assert_array_equal(data, ref_data, err_msg=name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,13 @@
+import argparse
+import asyncio
+import json
 import sys
-#import json
+import time
 #import struct
 import requests
 import re
 import struct
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
 
 
 def fill_hann_window(size, periodic=True):
@@ -14,87 +16,99 @@ def fill_hann_window(size, periodic=True):
     return np.hanning(size)
 
 
-def irfft(n_fft, complex_input):
-    return np.fft.irfft(complex_input, n=n_fft)
+def embd_to_frames(embd, n_fft, hann):
+    # embd: [n_codes, n_embd], log-magnitudes in the first half of each row and phases in the second half
+    half_embd = embd.shape[1] // 2
+    mag = np.clip(np.exp(embd[:, :half_embd]), 0, 1e2)
+    phi = embd[:, half_embd:2*half_embd]
 
+    S = np.zeros((embd.shape[0], half_embd + 1), dtype=np.complex64)
+    S[:, :half_embd] = mag * np.exp(1j * phi)
 
-def fold(buffer, n_out, n_win, n_hop, n_pad):
-    result = np.zeros(n_out)
-    n_frames = len(buffer) // n_win
+    # one inverse FFT over all the frames
+    return np.fft.irfft(S, n=n_fft, axis=-1) * hann
 
-    for i in range(n_frames):
-        start = i * n_hop
-        end = start + n_win
-        result[start:end] += buffer[i * n_win:(i + 1) * n_win]
 
-    return result[n_pad:-n_pad] if n_pad > 0 else result
+def overlap_add(frames, n_hop):
+    # frames: [n_frames, n_win] -> n_hop * (n_frames - 1) + n_win samples
+    n_frames, n_win = frames.shape
+    assert n_win % n_hop == 0, "the window must be a multiple of the hop size"
+    n_overlap = n_win // n_hop
 
+    # each frame covers n_overlap consecutive hops, so add the frames shifted by one hop at a time
+    hops = frames.reshape(n_frames, n_overlap, n_hop)
+    result = np.zeros((n_frames + n_overlap - 1, n_hop), dtype=frames.dtype)
+    for j in range(n_overlap):
+        result[j:j + n_frames] += hops[:, j]
 
-def process_frame(args):
-    l, n_fft, ST, hann = args
-    frame = irfft(n_fft, ST[l])
-    frame = frame * hann
-    hann2 = hann * hann
-    return frame, hann2
+    return result.reshape(-1)
 
 
-def embd_to_audio(embd, n_codes, n_embd, n_thread=4):
-    embd = np.asarray(embd, dtype=np.float32).reshape(n_codes, n_embd)
-
-    n_fft = 1280
-    n_hop = 320
-    n_win = 1280
-    n_pad = (n_win - n_hop) // 2
-    n_out = (n_codes - 1) * n_hop + n_win
+class Vocoder:
+    """
+    Converts spectrogram embeddings to audio as they arrive
+    Only the samples which no later frame overlaps are returned by push(), the rest is kept for the next call
+    """
 
-    hann = fill_hann_window(n_fft, True)
+    def __init__(self, n_fft=1280, n_hop=320, n_win=1280):
+        self.n_fft = n_fft
+        self.n_hop = n_hop
+        self.n_pad = (n_win - n_hop) // 2
+        self.hann = fill_hann_window(n_fft, True)
+        self.audio_tail = np.zeros(n_win - n_hop)
+        self.env_tail = np.zeros(n_win - n_hop)
+        self.n_skip = self.n_pad
 
-    E = np.zeros((n_embd, n_codes), dtype=np.float32)
-    for l in range(n_codes):
-        for k in range(n_embd):
-            E[k, l] = embd[l, k]
+    def _finish(self, audio, env):
+        mask = env > 1e-10
+        audio[mask] /= env[mask]
 
-    half_embd = n_embd // 2
-    S = np.zeros((n_codes, half_embd + 1), dtype=np.complex64)
+        # the first n_pad samples are dropped
+        n_skip = min(self.n_skip, len(audio))
+        self.n_skip -= n_skip
+        return audio[n_skip:]
 
-    for k in range(half_embd):
-        for l in range(n_codes):
-            mag = E[k, l]
-            phi = E[k + half_embd, l]
+    def push(self, embd):
+        embd = np.asarray(embd, dtype=np.float32)
+        n_codes = embd.shape[0]
+        if n_codes == 0:
+            return np.zeros(0)
 
-            mag = np.clip(np.exp(mag), 0, 1e2)
-            S[l, k] = mag * np.exp(1j * phi)
+        frames = embd_to_frames(embd, self.n_fft, self.hann)
+        hann2 = np.broadcast_to(self.hann * self.hann, frames.shape)
 
-    res = np.zeros(n_codes * n_fft)
-    hann2_buffer = np.zeros(n_codes * n_fft)
+        audio = overlap_add(frames, self.n_hop)
+        env = overlap_add(hann2, self.n_hop)
+        audio[:len(self.audio_tail)] += self.audio_tail
+        env[:len(self.env_tail)] += self.env_tail
 
-    with ThreadPoolExecutor(max_workers=n_thread) as executor:
-        args = [(l, n_fft, S, hann) for l in range(n_codes)]
-        results = list(executor.map(process_frame, args))
+        n_done = n_codes * self.n_hop
+        self.audio_tail = audio[n_done:].copy()
+        self.env_tail = env[n_done:].copy()
+        return self._finish(audio[:n_done], env[:n_done])
 
-        for l, (frame, hann2) in enumerate(results):
-            res[l*n_fft:(l+1)*n_fft] = frame
-            hann2_buffer[l*n_fft:(l+1)*n_fft] = hann2
+    def flush(self):
+        # the last n_pad samples are dropped
+        n_keep = len(self.audio_tail) - self.n_pad
+        return self._finish(self.audio_tail[:n_keep].copy(), self.env_tail[:n_keep].copy())
 
-    audio = fold(res, n_out, n_win, n_hop, n_pad)
-    env = fold(hann2_buffer, n_out, n_win, n_hop, n_pad)
 
-    mask = env > 1e-10
-    audio[mask] /= env[mask]
+def embd_to_audio(embd, n_codes, n_embd):
+    embd = np.asarray(embd, dtype=np.float32).reshape(n_codes, n_embd)
 
-    return audio
+    vocoder = Vocoder()
+    return np.concatenate([vocoder.push(embd), vocoder.flush()])
 
 
-def save_wav(filename, audio_data, sample_rate):
+def wav_header(sample_rate, data_size):
     num_channels = 1
     bits_per_sample = 16
     bytes_per_sample = bits_per_sample // 8
-    data_size = len(audio_data) * bytes_per_sample
     byte_rate = sample_rate * num_channels * bytes_per_sample
     block_align = num_channels * bytes_per_sample
     chunk_size = 36 + data_size  # 36 = size of header minus first 8 bytes
 
-    header = struct.pack(
+    return struct.pack(
         '<4sI4s4sIHHIIHH4sI',
         b'RIFF',
         chunk_size,
@@ -111,14 +125,190 @@ def save_wav(filename, audio_data, sample_rate):
         data_size
     )
 
+
+def to_pcm(audio_data):
     audio_data = np.clip(audio_data * 32767, -32768, 32767)
-    pcm_data = audio_data.astype(np.int16)
+    return audio_data.astype(np.int16)
+
+
+def save_wav(filename, audio_data, sample_rate):
+    pcm_data = to_pcm(audio_data)
 
     with open(filename, 'wb') as f:
-        f.write(header)
+        f.write(wav_header(sample_rate, pcm_data.nbytes))
         f.write(pcm_data.tobytes())
 
 
+class WavWriter:
+    """Appends audio to a WAV file as it is generated, the sizes in the header are filled in on close"""
+
+    def __init__(self, filename, sample_rate):
+        self.sample_rate = sample_rate
+        self.data_size = 0
+        self.f = open(filename, 'wb')
+        self.f.write(wav_header(sample_rate, 0))
+
+    def write(self, audio_data):
+        pcm_data = to_pcm(audio_data)
+        self.f.write(pcm_data.tobytes())
+        self.f.flush()
+        self.data_size += pcm_data.nbytes
+
+    def close(self):
+        self.f.seek(0)
+        self.f.write(wav_header(self.sample_rate, self.data_size))
+        self.f.close()
+
+
+# special tokens of the OuteTTS vocabulary
+TOKEN_CODE_END = 151670
+TOKEN_CODE_FIRST = 151672
+TOKEN_CODE_LAST = 155772
+
+
+def decode(host_dec, codes):
+    response = requests.post(
+        host_dec + "/embeddings",
+        json={
+            "input": [*codes],
+        }
+    )
+
+    response_json = response.json()
+
+    #print(json.dumps(response_json, indent=4))
+
+    # spectrogram
+    return response_json[0]["embedding"]
+
+
+def stream_completion(host_llm, payload, on_token):
+    # server-sent events, each partial result carries the sampled token
+    with requests.post(host_llm + "/completion", json={**payload, "stream": True}, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+            chunk = json.loads(data)
+            for token in chunk.get("tokens", []):
+                on_token(token)
+            if chunk.get("stop"):
+                break
+
+
+class LatencyStats:
+    """Time of the first occurrence of each pipeline event, and the time spent in each stage"""
+
+    def __init__(self):
+        self.t_start = time.perf_counter()
+        self.events = {}
+        self.decode_times = []
+        self.vocoder_time = 0.0
+
+    def mark(self, event):
+        self.events.setdefault(event, time.perf_counter() - self.t_start)
+
+    def report(self, n_codes, n_samples, sample_rate):
+        def at(event):
+            return '%.3f s' % self.events[event] if event in self.events else '-'
+
+        print('latency:')
+        print('  llm:     first token %s, first code %s, done %s (%d codes)' % (at('first token'), at('first code'), at('generation done'), n_codes))
+        if self.decode_times:
+            print('  decoder: %d requests, mean %.3f s, max %.3f s, total %.3f s' % (
+                len(self.decode_times), np.mean(self.decode_times), np.max(self.decode_times), np.sum(self.decode_times)))
+        print('  vocoder: %.3f s' % self.vocoder_time)
+        print('  audio:   first audio %s, done %s, %.2f s of audio' % (at('first audio'), at('done'), n_samples / sample_rate))
+
+
+async def stream_tts(host_llm, host_dec, payload, writer, n_zero, window=64, overlap=16, max_decodes=4):
+    """
+    Generate the codes, decode them and convert them to audio concurrently
+
+    The codes are cut into windows of at least `window` codes at <|code_end|> boundaries.
+    Each window is sent to the decoder with `overlap` codes of context on both sides, which are dropped from its
+    spectrogram, so a window is sent once the codes of its right context are generated.
+    Up to `max_decodes` windows are decoded at the same time, and their audio is written in order.
+    """
+    loop = asyncio.get_running_loop()
+    stats = LatencyStats()
+    tokens = asyncio.Queue()
+    decodes = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max_decodes)
+
+    def generate():
+        try:
+            stream_completion(host_llm, payload, lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token))
+        finally:
+            loop.call_soon_threadsafe(tokens.put_nowait, None)
+
+    async def decode_window(codes, n_skip, n_keep):
+        async with semaphore:
+            t_start = time.perf_counter()
+            embd = await asyncio.to_thread(decode, host_dec, codes)
+            stats.decode_times.append(time.perf_counter() - t_start)
+        return embd[n_skip:n_skip + n_keep]
+
+    codes = []
+    ends = []  # ends of the windows waiting for their right context
+    start = 0  # start of the next window
+
+    def submit(end):
+        nonlocal start
+        lo = max(start - overlap, 0)
+        hi = min(end + overlap, len(codes))
+        decodes.put_nowait(asyncio.create_task(decode_window(codes[lo:hi], start - lo, end - start)))
+        start = end
+
+    async def split():
+        while (token := await tokens.get()) is not None:
+            stats.mark('first token')
+            if TOKEN_CODE_FIRST <= token <= TOKEN_CODE_LAST:
+                stats.mark('first code')
+                codes.append(token - TOKEN_CODE_FIRST)
+            elif token == TOKEN_CODE_END and len(codes) - (ends[-1] if ends else start) >= window:
+                ends.append(len(codes))
+            while ends and len(codes) >= ends[0] + overlap:
+                submit(ends.pop(0))
+        stats.mark('generation done')
+
+        for end in ends:
+            submit(end)
+        if start < len(codes):
+            submit(len(codes))
+        decodes.put_nowait(None)
+
+    n_samples = 0
+
+    def write(audio):
+        nonlocal n_samples
+        if n_samples < n_zero:
+            audio[:n_zero - n_samples] = 0.0
+        if len(audio) > 0:
+            stats.mark('first audio')
+        n_samples += len(audio)
+        writer.write(audio)
+
+    async def stitch():
+        vocoder = Vocoder()
+        while (task := await decodes.get()) is not None:
+            embd = await task
+            t_start = time.perf_counter()
+            audio = vocoder.push(embd)
+            stats.vocoder_time += time.perf_counter() - t_start
+            write(audio)
+        write(vocoder.flush())
+        stats.mark('done')
+
+    await asyncio.gather(asyncio.to_thread(generate), split(), stitch())
+
+    stats.report(len(codes), n_samples, writer.sample_rate)
+    return n_samples
+
+
 def process_text(text: str):
     text = re.sub(r'\d+(\.\d+)?', lambda x: x.group(), text.lower()) # TODO this needs to be fixed
     text = re.sub(r'[-_/,\.\\]', ' ', text)
@@ -128,14 +318,22 @@ def process_text(text: str):
 
 # usage:
 # python tts-outetts.py http://server-llm:port http://server-dec:port "text"
-
-if len(sys.argv) <= 3:
-    print("usage: python tts-outetts.py http://server-llm:port http://server-dec:port \"text\"")
-    exit(1)
-
-host_llm = sys.argv[1]
-host_dec = sys.argv[2]
-text = sys.argv[3]
+# python tts-outetts.py --stream http://server-llm:port http://server-dec:port "text"
+
+parser = argparse.ArgumentParser(description="Generate speech with OuteTTS using a LLM server and a decoder server")
+parser.add_argument("host_llm", help="URL of the LLM server, e.g. http://server-llm:port")
+parser.add_argument("host_dec", help="URL of the decoder server, e.g. http://server-dec:port")
+parser.add_argument("text", help="text to speak")
+parser.add_argument("--output", default="output.wav", help="output WAV file (default: output.wav)")
+parser.add_argument("--stream", action="store_true", help="decode and convert the codes while they are generated, writing the audio as it is converted")
+parser.add_argument("--batch-size", type=int, default=64, help="minimum number of codes per decoder request in streaming mode (default: 64)")
+parser.add_argument("--overlap", type=int, default=16, help="codes of context on each side of a decoder request in streaming mode (default: 16)")
+parser.add_argument("--max-decodes", type=int, default=4, help="maximum number of concurrent decoder requests in streaming mode (default: 4)")
+args = parser.parse_args()
+
+host_llm = args.host_llm
+host_dec = args.host_dec
+text = args.text
 
 prefix = """<|im_start|>
 <|text_start|>the<|text_sep|>overall<|text_sep|>package<|text_sep|>from<|text_sep|>just<|text_sep|>two<|text_sep|>people<|text_sep|>is<|text_sep|>pretty<|text_sep|>remarkable<|text_sep|>sure<|text_sep|>i<|text_sep|>have<|text_sep|>some<|text_sep|>critiques<|text_sep|>about<|text_sep|>some<|text_sep|>of<|text_sep|>the<|text_sep|>gameplay<|text_sep|>aspects<|text_sep|>but<|text_sep|>its<|text_sep|>still<|text_sep|>really<|text_sep|>enjoyable<|text_sep|>and<|text_sep|>it<|text_sep|>looks<|text_sep|>lovely<|text_sep|>"""
@@ -241,17 +439,36 @@ suffix = [ 151667, 198, 1782, 155780, 151669, 151929, 152412, 152308, 152585, 15
           152512, 153287, 153141, 153052, 151840, 152589, 152508, 153499, 152109, 152255, 151739, 152267, 152759,
           153318, 153165, 153349, 151670, ]
 
+payload = {
+    "prompt": [prefix + words, *suffix],
+    "n_predict": 1024,
+    "cache_prompt": True,
+    "return_tokens": True,
+    "samplers": ["top_k"],
+    "top_k": 16,
+    "seed": 1003,
+}
+
+filename = args.output
+sample_rate = 24000 # sampling rate
+
+# zero out first 0.25 seconds
+n_zero = sample_rate // 4
+
+if args.stream:
+    writer = WavWriter(filename, sample_rate)
+    try:
+        n_samples = asyncio.run(stream_tts(host_llm, host_dec, payload, writer, n_zero,
+                                           window=args.batch_size, overlap=args.overlap, max_decodes=args.max_decodes))
+    finally:
+        writer.close()
+    print('audio generated: %d samples' % n_samples)
+    print('audio written to file "%s"' % filename)
+    sys.exit(0)
+
 response = requests.post(
     host_llm + "/completion",
-    json={
-        "prompt": [prefix + words, *suffix],
-        "n_predict": 1024,
-        "cache_prompt": True,
-        "return_tokens": True,
-        "samplers": ["top_k"],
-        "top_k": 16,
-        "seed": 1003,
-    }
+    json=payload,
 )
 
 response_json = response.json()
@@ -263,21 +480,9 @@ response_json = response.json()
 
 codes = response_json["tokens"]
 
-codes = [t - 151672 for t in codes if t >= 151672 and t <= 155772]
+codes = [t - TOKEN_CODE_FIRST for t in codes if t >= TOKEN_CODE_FIRST and t <= TOKEN_CODE_LAST]
 
-response = requests.post(
-    host_dec + "/embeddings",
-    json={
-        "input": [*codes],
-    }
-)
-
-response_json = response.json()
-
-#print(json.dumps(response_json, indent=4))
-
-# spectrogram
-embd = response_json[0]["embedding"]
+embd = decode(host_dec, codes)
 
 n_codes = len(embd)
 n_embd = len(embd[0])
@@ -289,11 +494,7 @@ print('converting to audio ...')
 audio = embd_to_audio(embd, n_codes, n_embd)
 print('audio generated: %d samples' % len(audio))
 
-filename = "output.wav"
-sample_rate = 24000 # sampling rate
-
-# zero out first 0.25 seconds
-audio[:24000 // 4] = 0.0
+audio[:n_zero] = 0.0
 
 save_wav(filename, audio, sample_rate)
 print('audio written to file "%s"' % filename)